@@ -0,0 +1,253 @@
+"""
+Offline benchmarks of the degpy hot paths on synthetic data
+
+Every benchmark is timed (best of --repeat runs) and run once more under
+tracemalloc for its peak Python/numpy memory, for each data size (seconds
+of continuous data). Synthetic sessions are written with degpy.synthetic
+and kept in --data-dir, so later runs reuse them.
+
+    python benchmarks/run.py
+    python benchmarks/run.py --sizes 60 600 3600 --out results.json
+    python benchmarks/run.py --baseline results.json --threshold 1.25
+
+With --baseline, results more than --threshold times slower or larger than
+the baseline are reported and the exit status is 1.
+"""
+
+import os
+import sys
+import gc
+import json
+import time
+import platform
+import argparse
+import datetime
+import tempfile
+import tracemalloc
+from collections import OrderedDict
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from degpy.neuralynx_io import load_ncs, load_nev
+from degpy.terminal import Terminal
+from degpy.session.session import Session
+from degpy.scraper.scraper import Scraper
+from degpy.synthetic import write_session, write_dataset, PROTOCOL_EVENTS
+
+
+BENCHMARKS = OrderedDict()
+
+DEFAULT_SIZES = (60, 600)
+CRAWL_SESSION_SEC = 1  # Length of each session of the crawled data tree
+
+
+def benchmark(name):
+    # Register a benchmark. The decorated function takes the prepared data and returns (setup, run): setup is called
+    # untimed before every run and its result is passed to run, which is the code measured.
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def _terminal(data):
+    events = load_nev(data['nev'])
+    return Terminal(data['ncs'], events['event_strings'], events['events']['TimeStamp'], cache=False)
+
+
+def _loaded_terminal(data):
+    terminal = _terminal(data)
+    terminal.data
+    return terminal
+
+
+@benchmark('load_ncs')
+def _load_ncs(data):
+    return None, lambda _: load_ncs(data['ncs'], cache=False)
+
+
+@benchmark('load_nev')
+def _load_nev(data):
+    return None, lambda _: load_nev(data['nev'])
+
+
+@benchmark('Terminal')
+def _terminal_load(data):
+    # Construction is lazy, so include loading the data and the target
+    def run(_):
+        terminal = _terminal(data)
+        return terminal.data, terminal.target
+    return None, run
+
+
+@benchmark('get_dataframe')
+def _get_dataframe(data):
+    terminal = _loaded_terminal(data)
+
+    def setup():
+        terminal.invalidate('target')
+        return terminal
+    return setup, lambda terminal: terminal.get_dataframe()
+
+
+@benchmark('get_target_binary_matrix')
+def _get_target_binary_matrix(data):
+    terminal = _loaded_terminal(data)
+
+    def setup():
+        terminal.invalidate('target')
+        return terminal
+    return setup, lambda terminal: terminal.get_target_binary_matrix()
+
+
+@benchmark('bandpower_splits')
+def _bandpower_splits(data):
+    terminal = _loaded_terminal(data)
+
+    def setup():
+        terminal.invalidate('_psds')
+        return terminal
+    return setup, lambda terminal: terminal.bandpower_splits([4, 12])
+
+
+@benchmark('Session.epochs')
+def _epochs(data):
+    session = Session(data['session'])
+    return None, lambda _: session.epochs(['s1', 'o1'], -1, 3)
+
+
+@benchmark('Scraper.crawl_files')
+def _crawl_files(data):
+    return None, lambda _: Scraper.crawl_files(data['root'])
+
+
+def prepare_data(data_dir, size_sec, sampling_rate):
+    """
+    Writes (or reuses) the synthetic data of one size: a session of
+    size_sec seconds with the full exposure protocol, and a data tree of
+    one short session per minute of data for crawling
+
+    :return: dict of paths, 'session', 'ncs', 'nev' and 'root'
+    """
+    base = os.path.join(data_dir, '{}Hz_{}s'.format(sampling_rate, size_sec))
+    session = os.path.join(base, 'session', '080602_ps01_160614', '2016-06-14_09-39-10')
+    root = os.path.join(base, 'tree')
+    done = os.path.join(base, 'complete')
+
+    if not os.path.exists(done):
+        write_session(session, duration_sec=size_sec, sampling_rate=sampling_rate, n_channels=1,
+                      events=PROTOCOL_EVENTS)
+        write_dataset(root, degu_ids=['0806{:02d}'.format(i) for i in range(max(1, size_sec // 60))],
+                      sessions_per_degu=1, duration_sec=CRAWL_SESSION_SEC, n_channels=4)
+        open(done, 'w').close()
+
+    return {'session': session, 'ncs': os.path.join(session, 'LFP1.ncs'), 'nev': os.path.join(session, 'Events.nev'),
+            'root': root}
+
+
+def measure(prepare, data, repeat):
+    """
+    Times a benchmark and measures its peak traced memory
+
+    :return: dict, 'time_sec' (best of repeat runs) and 'peak_bytes'
+    """
+    setup, run = prepare(data)
+    setup = setup or (lambda: None)
+
+    times = []
+    for _ in range(repeat):
+        state = setup()
+        gc.collect()
+        start = time.perf_counter()
+        result = run(state)
+        times.append(time.perf_counter() - start)
+        del result
+
+    state = setup()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = run(state)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    del result
+
+    return {'time_sec': min(times), 'peak_bytes': peak}
+
+
+def compare(results, baseline, threshold, min_time):
+    """
+    Lists the results that regressed against a baseline run
+
+    :return: list of str, one line per regression
+    """
+    previous = dict(((r['benchmark'], r['size_sec'], r['sampling_rate']), r) for r in baseline['results'])
+    regressions = []
+    for result in results:
+        base = previous.get((result['benchmark'], result['size_sec'], result['sampling_rate']))
+        if base is None:
+            continue
+        if result['time_sec'] > max(base['time_sec'], min_time) * threshold:
+            regressions.append('{} ({} s): time {:.4f} s vs {:.4f} s'.format(
+                result['benchmark'], result['size_sec'], result['time_sec'], base['time_sec']))
+        if result['peak_bytes'] > base['peak_bytes'] * threshold and result['peak_bytes'] > 1e6:
+            regressions.append('{} ({} s): peak memory {:.1f} MB vs {:.1f} MB'.format(
+                result['benchmark'], result['size_sec'], result['peak_bytes'] / 1e6, base['peak_bytes'] / 1e6))
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='seconds of continuous data (default: %(default)s)')
+    parser.add_argument('--sampling-rate', type=int, default=2000, help='Hz (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per benchmark (default: %(default)s)')
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), help='benchmarks to run (default: all)')
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'degpy-benchmarks'),
+                        help='where synthetic data is written (default: %(default)s)')
+    parser.add_argument('--out', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='slowdown or memory ratio reported as a regression (default: %(default)s)')
+    parser.add_argument('--min-time', type=float, default=0.005,
+                        help='baseline times below this (s) are compared as this value (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    names = args.only or list(BENCHMARKS)
+    results = []
+    print('{:<28}{:>10}{:>12}{:>14}'.format('benchmark', 'size (s)', 'time (s)', 'peak (MB)'))
+    for size in args.sizes:
+        data = prepare_data(args.data_dir, size, args.sampling_rate)
+        for name in names:
+            result = measure(BENCHMARKS[name], data, args.repeat)
+            result.update({'benchmark': name, 'size_sec': size, 'sampling_rate': args.sampling_rate})
+            results.append(result)
+            print('{:<28}{:>10}{:>12.4f}{:>14.1f}'.format(name, size, result['time_sec'], result['peak_bytes'] / 1e6))
+
+    report = {
+        'created': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'results': results,
+    }
+    if args.out:
+        with open(args.out, 'w') as fid:
+            json.dump(report, fid, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as fid:
+            regressions = compare(results, json.load(fid), args.threshold, args.min_time)
+        for line in regressions:
+            print('REGRESSION ' + line)
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
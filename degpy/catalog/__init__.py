@@ -0,0 +1 @@
+from .catalog import Catalog
\ No newline at end of file
@@ -0,0 +1,231 @@
+"""
+This module contains a header-only metadata catalog of a degu ephys data tree,
+kept in a local SQLite database
+
+data
+    080602                              <- degu_id
+        080602_ps01_160614              <- session (ps01)
+            2016-06-14_09-39-10         <- recording
+                LFP1.ncs                <- channel
+
+Only the 16 kB header of each file is read, and rescans only re-read files
+whose size or modification time changed.
+"""
+
+import os
+import json
+import sqlite3
+import warnings
+
+from degpy.neuralynx_io import read_header, parse_header, estimate_record_count
+from degpy.neuralynx_io.neuralynx_io import RECORD_DTYPES
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    extension TEXT,
+    degu_id TEXT,
+    session TEXT,
+    recording TEXT,
+    channel TEXT,
+    acq_ent_name TEXT,
+    sampling_rate REAL,
+    ad_bit_volts REAL,
+    time_opened TEXT,
+    time_closed TEXT,
+    record_count INTEGER,
+    header TEXT
+);
+CREATE INDEX IF NOT EXISTS files_degu_id ON files (degu_id);
+CREATE INDEX IF NOT EXISTS files_sampling_rate ON files (sampling_rate);
+CREATE INDEX IF NOT EXISTS files_time_opened ON files (time_opened);
+"""
+
+_COLUMNS = ('path', 'size', 'mtime_ns', 'extension', 'degu_id', 'session', 'recording', 'channel', 'acq_ent_name',
+            'sampling_rate', 'ad_bit_volts', 'time_opened', 'time_closed', 'record_count', 'header')
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _path_fields(file_path):
+    # Degu ID, session and recording from .../<degu>/<degu>_<session>_<date>/<recording>/<file>
+    recording_dir = os.path.dirname(file_path)
+    session_dir = os.path.basename(os.path.dirname(recording_dir))
+    parts = session_dir.split('_')
+    degu_id = parts[0] if len(parts) > 1 else None
+    session = parts[1] if len(parts) > 1 else None
+
+    return degu_id, session, os.path.basename(recording_dir)
+
+
+def read_file_metadata(file_path, stat=None):
+    """
+    Reads the catalog row of one data file from its header alone
+
+    :param file_path: str, path to a .ncs, .nev, .nse, .nst or .ntt file
+    :param stat: os.stat_result of the file, if already known
+    :return: dict of catalog columns
+    """
+    file_path = os.path.abspath(file_path)
+    stat = os.stat(file_path) if stat is None else stat
+    extension = file_path.rsplit('.', 1)[-1].lower()
+
+    with open(file_path, 'rb') as fid:
+        raw_header = read_header(fid)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        header = parse_header(raw_header) if raw_header else {}
+        record_count = int(estimate_record_count(file_path, RECORD_DTYPES[extension]))
+
+    opened = header.get('TimeOpened_dt')
+    closed = header.get('TimeClosed_dt')
+    degu_id, session, recording = _path_fields(file_path)
+
+    return {
+        'path': file_path,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'extension': extension,
+        'degu_id': degu_id,
+        'session': session,
+        'recording': recording,
+        'channel': os.path.splitext(os.path.basename(file_path))[0],
+        'acq_ent_name': header.get('AcqEntName'),
+        'sampling_rate': _float(header.get('SamplingFrequency')),
+        'ad_bit_volts': _float(header.get('ADBitVolts')),
+        'time_opened': opened.isoformat() if opened else None,
+        'time_closed': closed.isoformat() if closed else None,
+        'record_count': max(record_count, 0),
+        'header': json.dumps(dict((k, v) for k, v in header.items() if isinstance(v, str))),
+    }
+
+
+class Catalog:
+    """
+    SQLite index of the headers of every data file under a data tree
+
+    Example, all 2 kHz LFP channels from degu 080602 in July 2016:
+
+        catalog = Catalog('degu.sqlite')
+        catalog.scan('/Volumes/Backup Plus/data')
+        catalog.query(degu_id='080602', channel='LFP*', sampling_rate=2000,
+                      opened_after='2016-07-01', opened_before='2016-08-01')
+    """
+
+    def __init__(self, db_path):
+        self.db_path = os.path.abspath(db_path)
+        self.connection = sqlite3.connect(self.db_path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+    def scan(self, path, extensions=tuple(RECORD_DTYPES)):
+        """
+        Indexes every data file under path. Files whose size and mtime match
+        the catalog are skipped, and files that no longer exist under path
+        are dropped.
+
+        :param path: str, root data directory
+        :param extensions: iterable of file extensions to index
+        :return: dict, counts of 'added', 'updated', 'unchanged' and
+                 'removed' files
+        """
+        root = os.path.abspath(path)
+        # Prefix match with substr, since LIKE treats '_' and '%' in the path as wildcards and ignores case
+        prefix = os.path.join(root, '')
+        known = dict((row['path'], (row['size'], row['mtime_ns'])) for row in self.connection.execute(
+            "SELECT path, size, mtime_ns FROM files WHERE path = ? OR substr(path, 1, length(?)) = ?",
+            (root, prefix, prefix)))
+
+        counts = {'added': 0, 'updated': 0, 'unchanged': 0, 'removed': 0}
+        rows = []
+        seen = set()
+        for dir_path, dirs, files in os.walk(root):
+            for file in files:
+                if file.rsplit('.', 1)[-1].lower() not in extensions:
+                    continue
+                file_path = os.path.join(dir_path, file)
+                seen.add(file_path)
+                stat = os.stat(file_path)
+                if known.get(file_path) == (stat.st_size, stat.st_mtime_ns):
+                    counts['unchanged'] += 1
+                    continue
+
+                try:
+                    rows.append(read_file_metadata(file_path, stat))
+                except (OSError, IndexError, KeyError) as error:
+                    warnings.warn('Unable to read header of {}: {}'.format(file_path, error))
+                    continue
+                counts['updated' if file_path in known else 'added'] += 1
+
+        removed = [(p,) for p in known if p not in seen]
+        counts['removed'] = len(removed)
+
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO files ({}) VALUES ({})".format(', '.join(_COLUMNS),
+                                                                       ', '.join('?' * len(_COLUMNS))),
+                [tuple(row[c] for c in _COLUMNS) for row in rows])
+            self.connection.executemany("DELETE FROM files WHERE path = ?", removed)
+
+        return counts
+
+    def query(self, degu_id=None, session=None, recording=None, channel=None, extension=None, sampling_rate=None,
+              opened_after=None, opened_before=None):
+        """
+        Returns the catalog rows matching every given criterion
+
+        :param channel: str, channel name or glob, e.g. 'LFP*'
+        :param opened_after: str, ISO date/time, inclusive
+        :param opened_before: str, ISO date/time, exclusive
+        :return: list of dicts
+        """
+        clauses = []
+        params = []
+        for column, value in (('degu_id', degu_id), ('session', session), ('recording', recording),
+                              ('extension', extension), ('sampling_rate', sampling_rate)):
+            if value is not None:
+                clauses.append("{} = ?".format(column))
+                params.append(value)
+        if channel is not None:
+            clauses.append("channel GLOB ?")
+            params.append(channel)
+        if opened_after is not None:
+            clauses.append("time_opened >= ?")
+            params.append(opened_after)
+        if opened_before is not None:
+            clauses.append("time_opened < ?")
+            params.append(opened_before)
+
+        statement = "SELECT * FROM files"
+        if clauses:
+            statement += " WHERE " + " AND ".join(clauses)
+
+        return self.sql(statement + " ORDER BY path", params)
+
+    def sql(self, statement, params=()):
+        """
+        Runs an arbitrary SQL query against the 'files' table
+
+        :return: list of dicts
+        """
+        return [dict(row) for row in self.connection.execute(statement, params)]
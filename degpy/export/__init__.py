@@ -0,0 +1 @@
+from .export import export_session, export_dataset, EXTENSIONS
\ No newline at end of file
@@ -0,0 +1,297 @@
+"""
+This module contains utilities to export sessions to columnar files
+
+Sessions are streamed out in row-group chunks, so memory stays bounded by
+the chunk size whatever the recording length. Samples are stored as int16
+ADC counts with a per-channel scale (multiply to get data units), and the
+event and nested exposure labels are stored as dictionary-encoded
+categories.
+
+Supported formats (picked from the file extension by default):
+    parquet (.parquet, .pq)  requires pyarrow
+    hdf5    (.h5, .hdf5)     requires h5py
+    npz     (.npz)
+"""
+
+import os
+import json
+import fnmatch
+import zipfile
+import warnings
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from degpy.neuralynx_io import TimeIndex, get_cache
+from degpy.neuralynx_io.neuralynx_io import NCS_SAMPLES_PER_RECORD, MICROVOLT_SCALING
+from degpy.session.session import channel_source, natural_key
+from degpy.terminal.terminal import label_segments, encode_segments
+
+
+_FORMATS = {
+    '.parquet': 'parquet',
+    '.pq': 'parquet',
+    '.h5': 'hdf5',
+    '.hdf5': 'hdf5',
+    '.npz': 'npz',
+}
+
+EXTENSIONS = {'parquet': '.parquet', 'hdf5': '.h5', 'npz': '.npz'}  # Default file extension of each format
+
+
+def _segment_codes(starts, codes, lo, hi):
+    # Per-sample codes of samples lo:hi from (segment start, code) pairs
+    first = np.searchsorted(starts, lo, side='right') - 1
+    last = np.searchsorted(starts, hi, side='left')
+    bounds = np.clip(starts[first:last], lo, hi)
+    return np.repeat(codes[first:last], np.diff(np.append(bounds, hi)))
+
+
+class _SessionStream:
+    """
+    Aligned chunked reader over the channels of a session
+    """
+
+    def __init__(self, session, pattern, signal_scaling, workers):
+        files = sorted(fnmatch.filter(session.data_files, pattern), key=natural_key)
+        if len(files) == 0:
+            raise FileNotFoundError("No data files matching '{}' in '{}'".format(pattern, session.session_path))
+
+        cache = get_cache(session.cache)
+        self.names = [os.path.splitext(f)[0] for f in files]
+        self.sources = [channel_source(os.path.join(session.session_path, f), signal_scaling, cache) for f in files]
+        self.pool = ThreadPoolExecutor(max_workers=workers) if workers else None
+
+        # Align channels on the union of record start times
+        timestamps = [np.array(src['timestamp']) for src in self.sources]
+        self.reference = np.unique(np.concatenate(timestamps))
+        self.positions = [np.searchsorted(self.reference, ts) for ts in timestamps]
+        if any(len(ts) != len(self.reference) for ts in timestamps):
+            warnings.warn('Some channels are missing records; their samples are exported as 0')
+
+        rates = set(src['sampling_rate'] for src in self.sources if src['sampling_rate'] is not None)
+        if len(rates) > 1:
+            raise ValueError("Channels matching '{}' have different sampling rates: {}".format(pattern, sorted(rates)))
+        self.sampling_rate = rates.pop() if rates else 0
+        self.time_index = TimeIndex(self.reference, self.sampling_rate)
+        self.n_rows = len(self.time_index)
+
+        self.scales = [src['scale'] if src['scale'] is not None else 1. for src in self.sources]
+        self.units = self.sources[0]['data_units']
+
+        # Event and nested exposure labels as segments
+        events = session.events[:-1]
+        self.label_starts, codes, self.target_categories = label_segments(self.time_index, session.timestamps[:-1],
+                                                                          events)
+        self.target_codes = codes
+        self.encoded_codes, self.encoded_categories = encode_segments(codes, self.target_categories)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+        for src in self.sources:
+            src['close']()
+
+    def chunks(self, chunk_records):
+        # Yield (first row, stop row) for each chunk of records
+        for r0 in range(0, len(self.reference), chunk_records):
+            r1 = min(r0 + chunk_records, len(self.reference))
+            yield r0 * NCS_SAMPLES_PER_RECORD, r1 * NCS_SAMPLES_PER_RECORD
+
+    def channel(self, i, lo, hi):
+        # int16 samples of channel i for rows lo:hi
+        r0, r1 = lo // NCS_SAMPLES_PER_RECORD, hi // NCS_SAMPLES_PER_RECORD
+        positions = self.positions[i]
+        k0, k1 = np.searchsorted(positions, [r0, r1])
+        block = np.zeros((r1 - r0, NCS_SAMPLES_PER_RECORD), dtype=np.int16)
+        block[positions[k0:k1] - r0] = self.sources[i]['samples'][k0:k1]
+        return block.reshape(-1)
+
+    def channels(self, lo, hi):
+        read = lambda i: self.channel(i, lo, hi)
+        if self.pool is None:
+            return [read(i) for i in range(len(self.sources))]
+        return list(self.pool.map(read, range(len(self.sources))))
+
+    def timestamps(self, lo, hi):
+        return self.time_index.times(lo, hi)
+
+    def target(self, lo, hi):
+        return _segment_codes(self.label_starts, self.target_codes, lo, hi)
+
+    def encoded_target(self, lo, hi):
+        return _segment_codes(self.label_starts, self.encoded_codes, lo, hi)
+
+    def metadata(self, session):
+        return {
+            'session_path': session.session_path,
+            'sampling_rate': float(self.sampling_rate),
+            'data_units': self.units,
+            'channels': self.names,
+            'scale': [float(s) for s in self.scales],
+            'target_categories': [str(c) for c in self.target_categories],
+            'encoded_target_categories': [str(c) for c in self.encoded_categories],
+        }
+
+
+def _write_parquet(stream, session, path, chunk_records, compression):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("Exporting to parquet requires pyarrow")
+
+    metadata = stream.metadata(session)
+    target_dict = pa.array(metadata['target_categories'], type=pa.string())
+    encoded_dict = pa.array(metadata['encoded_target_categories'], type=pa.string())
+    fields = [pa.field('timestamp', pa.float64())]
+    fields += [pa.field(name, pa.int16(), metadata={'scale': repr(scale), 'units': stream.units})
+               for name, scale in zip(stream.names, stream.scales)]
+    fields += [pa.field('target', pa.dictionary(pa.int16(), pa.string())),
+               pa.field('encoded_target', pa.dictionary(pa.int16(), pa.string()))]
+    schema = pa.schema(fields, metadata={'degpy': json.dumps(metadata)})
+
+    with pq.ParquetWriter(path, schema, compression=compression or 'snappy') as writer:
+        for lo, hi in stream.chunks(chunk_records):
+            columns = [pa.array(stream.timestamps(lo, hi))]
+            columns += [pa.array(samples) for samples in stream.channels(lo, hi)]
+            target = stream.target(lo, hi).astype(np.int16)
+            columns += [pa.DictionaryArray.from_arrays(pa.array(target, mask=target < 0), target_dict),
+                        pa.DictionaryArray.from_arrays(pa.array(stream.encoded_target(lo, hi).astype(np.int16)),
+                                                       encoded_dict)]
+            writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+
+
+def _write_hdf5(stream, session, path, chunk_records, compression):
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError("Exporting to HDF5 requires h5py")
+
+    metadata = stream.metadata(session)
+    chunk_rows = max(1, min(stream.n_rows, chunk_records * NCS_SAMPLES_PER_RECORD))
+    options = {'chunks': (chunk_rows,), 'compression': compression} if stream.n_rows else {}
+
+    with h5py.File(path, 'w') as h5:
+        h5.attrs['degpy'] = json.dumps(metadata)
+        timestamp = h5.create_dataset('timestamp', (stream.n_rows,), dtype=np.float64, **options)
+        channels = []
+        for name, scale in zip(stream.names, stream.scales):
+            dataset = h5.create_dataset('channels/' + name, (stream.n_rows,), dtype=np.int16, **options)
+            dataset.attrs['scale'] = scale
+            dataset.attrs['units'] = stream.units
+            channels.append(dataset)
+        target = h5.create_dataset('target', (stream.n_rows,), dtype=np.int16, **options)
+        target.attrs['categories'] = json.dumps(metadata['target_categories'])
+        encoded = h5.create_dataset('encoded_target', (stream.n_rows,), dtype=np.int16, **options)
+        encoded.attrs['categories'] = json.dumps(metadata['encoded_target_categories'])
+
+        for lo, hi in stream.chunks(chunk_records):
+            timestamp[lo:hi] = stream.timestamps(lo, hi)
+            for dataset, samples in zip(channels, stream.channels(lo, hi)):
+                dataset[lo:hi] = samples
+            target[lo:hi] = stream.target(lo, hi)
+            encoded[lo:hi] = stream.encoded_target(lo, hi)
+
+
+def _write_npz(stream, session, path, chunk_records, compression):
+    # Each .npy member is streamed in turn, since zip members cannot be interleaved
+    metadata = stream.metadata(session)
+    mode = zipfile.ZIP_DEFLATED if compression else zipfile.ZIP_STORED
+
+    def write_member(zf, name, dtype, fill):
+        with zf.open(name + '.npy', 'w', force_zip64=True) as fid:
+            np.lib.format.write_array_header_2_0(fid, {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                                                       'fortran_order': False, 'shape': (stream.n_rows,)})
+            for lo, hi in stream.chunks(chunk_records):
+                fid.write(np.ascontiguousarray(fill(lo, hi), dtype=dtype).tobytes())
+
+    with zipfile.ZipFile(path, 'w', compression=mode, allowZip64=True) as zf:
+        write_member(zf, 'timestamp', np.float64, stream.timestamps)
+        for i, name in enumerate(stream.names):
+            write_member(zf, 'channels/' + name, np.int16, partial(stream.channel, i))
+        write_member(zf, 'target', np.int16, stream.target)
+        write_member(zf, 'encoded_target', np.int16, stream.encoded_target)
+        for name, key in (('channel_names', 'channels'), ('scale', 'scale'),
+                          ('target_categories', 'target_categories'),
+                          ('encoded_target_categories', 'encoded_target_categories')):
+            with zf.open(name + '.npy', 'w') as fid:
+                np.lib.format.write_array(fid, np.array(metadata[key]))
+        with zf.open('metadata.npy', 'w') as fid:
+            np.lib.format.write_array(fid, np.array(json.dumps(metadata)))
+
+
+_WRITERS = {
+    'parquet': _write_parquet,
+    'hdf5': _write_hdf5,
+    'npz': _write_npz,
+}
+
+
+def export_session(session, path, format=None, pattern="LFP*.ncs", chunk_records=1024, workers=None,
+                   compression=None, signal_scaling=MICROVOLT_SCALING):
+    """
+    Streams the channels of a session to a columnar file, chunk_records
+    records (512 rows each) at a time. Columns are 'timestamp' (µs), one
+    int16 column per channel with its scale and units, and the dictionary
+    encoded 'target' (last event) and 'encoded_target' (nested exposure)
+    labels.
+
+    :param session: Session, or path to a recording directory
+    :param path: str, output file
+    :param format: str, 'parquet', 'hdf5' or 'npz' (default: from path)
+    :param pattern: str, glob selecting the channels to export
+    :param chunk_records: int, records per row group / chunk
+    :param workers: int, threads reading and encoding channels in parallel
+    :param compression: str, codec name (parquet/hdf5), or any true value
+                        to deflate npz members
+    :param signal_scaling: tuple, (scale factor from volts, units)
+    :return: str, path of the written file
+    """
+    from degpy.session import Session
+
+    if not isinstance(session, Session):
+        session = Session(session)
+    if format is None:
+        format = _FORMATS.get(os.path.splitext(path)[1].lower())
+    if format not in _WRITERS:
+        raise ValueError("Unknown export format '{}', expected one of {}".format(format, sorted(_WRITERS)))
+
+    stream = _SessionStream(session, pattern, signal_scaling, workers)
+    try:
+        _WRITERS[format](stream, session, path, chunk_records, compression)
+    finally:
+        stream.close()
+
+    return path
+
+
+def _export_one(session, root, out_dir, format, **kwargs):
+    # Per-session function for export_dataset; runs in a worker process
+    name = os.path.relpath(session.session_path, root).replace(os.sep, '_')
+    path = os.path.join(out_dir, name + EXTENSIONS[format])
+    return export_session(session, path, format, **kwargs)
+
+
+def export_dataset(root, out_dir, format='parquet', processes=None, progress=None, **kwargs):
+    """
+    Exports every session under root to out_dir, one file per session,
+    fanning sessions out to worker processes with Scraper.get_lfp_data
+
+    :param root: str, root data directory
+    :param out_dir: str, output directory
+    :param format: str, 'parquet', 'hdf5' or 'npz'
+    :param processes: int, number of worker processes
+    :param progress: callable or True, see Scraper.iter_lfp_data
+    :param kwargs: passed to export_session
+    :return: list of SessionResult, whose result is the written path
+    """
+    from degpy.scraper.scraper import Scraper
+
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    func = partial(_export_one, root=os.path.abspath(root), out_dir=os.path.abspath(out_dir), format=format,
+                   **kwargs)
+
+    return Scraper.get_lfp_data(root, func=func, workers=processes, progress=progress)
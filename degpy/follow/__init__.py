@@ -0,0 +1 @@
+from .follow import RecordFollower, NcsFollower, NevFollower, Monitor
\ No newline at end of file
@@ -0,0 +1,372 @@
+"""
+This module contains tail followers of .ncs and .nev files that are still
+being written, and a monitor of band power and exposure state built on them
+
+Cheetah appends whole records to its open files while recording. The
+followers remember the byte offset they have read up to and, on each poll,
+read only the complete records appended since, so monitoring costs the
+same every few seconds however long the recording has run.
+
+    monitor = Monitor(['LFP1.ncs', 'LFP2.ncs'], 'Events.nev', window_sec=10)
+    for update in monitor.updates(interval=2.):
+        print(update['label'], update['bandpower'])
+
+Band power is estimated from a rolling Welch PSD: each new half-overlapping
+window of samples is transformed once, and the PSD is the mean of the
+windows that fit in the last window_sec seconds, which matches Welch over
+those samples. Windows are also accumulated per exposure, labelled with
+the innermost exposure active at their centre.
+"""
+
+import os
+import time
+import warnings
+from collections import deque
+
+import numpy as np
+from scipy.signal import welch
+
+from degpy.neuralynx_io.neuralynx_io import (HEADER_LENGTH, NCS_RECORD, NEV_RECORD, NCS_SAMPLES_PER_RECORD,
+                                             MICROVOLT_SCALING, read_header, parse_header, decode_event_strings,
+                                             RecordValidator)
+from degpy.terminal.terminal import BANDS, as_band_dict, window_samples, integrate_band
+
+
+class RecordFollower:
+    """
+    Reads the complete records appended to a Neuralynx file since the
+    last poll
+    """
+
+    def __init__(self, file_path, record_dtype):
+        """
+        :param file_path: str, file to follow (it need not exist yet)
+        :param record_dtype: numpy dtype of the file's records
+        """
+        self.file_path = os.path.abspath(file_path)
+        self.record_dtype = np.dtype(record_dtype)
+        self.header = None
+        self.offset = HEADER_LENGTH  # Byte offset of the first record not yet read
+        self.records_read = 0
+
+    def __repr__(self):
+        return '{}({!r}, {} records read)'.format(type(self).__name__, self.file_path, self.records_read)
+
+    def poll(self, max_records=None):
+        """
+        :param max_records: int, most records to read at once
+        :return: array of the records appended since the last poll (empty
+                 until the header and a whole record have been written)
+        """
+        try:
+            size = os.path.getsize(self.file_path)
+        except OSError:
+            return np.zeros(0, self.record_dtype)
+        if size < self.offset:
+            warnings.warn("'{}' shrank below the records already read; following it from the start".format(
+                self.file_path))
+            self.header = None
+            self.offset = HEADER_LENGTH
+            self.records_read = 0
+
+        count = (size - self.offset) // self.record_dtype.itemsize if size >= HEADER_LENGTH else 0
+        if max_records is not None:
+            count = min(count, max_records)
+        records = np.zeros(count, self.record_dtype)
+        if count == 0 and self.header is not None:
+            return records
+
+        with open(self.file_path, 'rb') as fid:
+            if self.header is None:
+                self.header = parse_header(read_header(fid))
+            fid.seek(self.offset)
+            count = fid.readinto(memoryview(records.view(np.uint8))) // self.record_dtype.itemsize
+
+        self.offset += count * self.record_dtype.itemsize
+        self.records_read += count
+        return records[:count]
+
+
+class NcsFollower(RecordFollower):
+    """
+    Follows a continuous .ncs file, returning the scaled samples of new
+    records and where they are discontinuous
+    """
+
+    def __init__(self, file_path, signal_scaling=MICROVOLT_SCALING, dtype=np.float64):
+        super().__init__(file_path, NCS_RECORD)
+        self.signal_scaling = signal_scaling
+        self.dtype = np.dtype(dtype)
+        self.sampling_rate = None
+        self.scale = None
+        self.data_units = 'ADC counts'
+        self._validator = RecordValidator()
+
+    def read(self, max_records=None):
+        """
+        Reads the records appended since the last call. Padding after the
+        valid samples of partial records is dropped.
+
+        :return: dict with keys 'data' (new samples), 'timestamp' (start
+                 time of each new record), 'record_start' (index in data of
+                 each record's first sample) and 'gaps' (indices of the new
+                 records that do not follow on from the previous record,
+                 across calls)
+        """
+        records = self.poll(max_records)
+        if self.scale is None and self.header is not None and self.signal_scaling is not None:
+            if 'ADBitVolts' in self.header:
+                self.scale = np.float64(self.header['ADBitVolts']) * self.signal_scaling[0]
+                self.data_units = self.signal_scaling[1]
+        if len(records) and self.sampling_rate is None:
+            self.sampling_rate = float(records['SampleFreq'][0])
+
+        gaps = self._validator.feed(records)
+        valid = np.minimum(records['NumValidSamples'].astype(np.int64), NCS_SAMPLES_PER_RECORD)
+        samples = records['Samples']
+        if np.any(valid != NCS_SAMPLES_PER_RECORD):
+            samples = samples[np.arange(NCS_SAMPLES_PER_RECORD)[None, :] < valid[:, None]]
+        data = samples.reshape(-1).astype(self.dtype)
+        if self.scale is not None:
+            data *= self.dtype.type(self.scale)
+
+        return {
+            'data': data,
+            'timestamp': records['TimeStamp'].copy(),
+            'record_start': np.concatenate(([0], np.cumsum(valid)[:-1])).astype(np.int64) if len(valid) else valid,
+            'gaps': np.asarray(gaps, dtype=np.int64),
+        }
+
+
+class NevFollower(RecordFollower):
+    """
+    Follows an events .nev file, keeping the exposure state up to date:
+    exposures open at their start event ('<name>s', or a stimulus name
+    ending in a digit) and close at their end event ('<name>e' or
+    '<name>o'), as in ExposureTable
+    """
+
+    def __init__(self, file_path):
+        super().__init__(file_path, NEV_RECORD)
+        self.events = []
+        self.timestamps = []
+        self.active = []  # Names of the open exposures, innermost last
+        self._change_times = []  # Time of every change of the innermost exposure
+        self._change_labels = []  # Innermost exposure from that time on (None for none)
+
+    def read(self, max_records=None):
+        """
+        Reads the events appended since the last call
+
+        :return: dict with keys 'events' (new event strings), 'timestamps'
+                 and 'active' (open exposures after them)
+        """
+        records = self.poll(max_records)
+        events = list(decode_event_strings(records['EventString'])) if len(records) else []
+        timestamps = records['TimeStamp'].copy()
+        for event, ts in zip(events, timestamps):
+            if not event:
+                continue
+            if event[-1] == 's' or event[-1] in '1234567890':
+                self.active.append(event[:-1] if event[-1] == 's' else event)
+            elif event[-1] == 'e' or event[-1] == 'o':
+                if event[:-1] in self.active:
+                    self.active.remove(event[:-1])
+            label = self.active[-1] if self.active else None
+            if not self._change_labels or self._change_labels[-1] != label:
+                self._change_times.append(int(ts))
+                self._change_labels.append(label)
+
+        self.events.extend(events)
+        self.timestamps.extend(int(ts) for ts in timestamps)
+        return {'events': events, 'timestamps': timestamps, 'active': list(self.active)}
+
+    def label_at(self, times):
+        """
+        Innermost exposure active at each time (µs), from the events read so
+        far, or None
+
+        :return: list of str or None
+        """
+        positions = np.searchsorted(self._change_times, np.atleast_1d(np.asarray(times, dtype=np.float64)),
+                                    side='right') - 1
+        return [self._change_labels[p] if p >= 0 else None for p in positions]
+
+
+class _RollingSpectrum:
+    """
+    Rolling Welch PSD of one channel, updated with each block of new samples
+    """
+
+    def __init__(self, sampling_rate, nperseg, window_count):
+        self.sampling_rate = sampling_rate
+        self.nperseg = nperseg
+        self.step = nperseg - nperseg // 2  # welch's default overlap
+        self.freqs = None
+        self.psds = deque(maxlen=window_count)
+        self.exposure_sums = {}
+        self.exposure_counts = {}
+        self._carry = np.zeros(0)
+        self._carry_time = None  # Time (µs) of the first carried sample
+
+    def reset(self, start_time):
+        # Restart the windows at a discontinuity
+        self._carry = np.zeros(0)
+        self._carry_time = start_time
+
+    def feed(self, samples, labeller):
+        # Add samples that follow on from those fed since the last reset. labeller maps times to exposure labels.
+        period = 1e6 / self.sampling_rate
+        buffer = np.concatenate((self._carry, samples))
+        count = (len(buffer) - self.nperseg) // self.step + 1 if len(buffer) >= self.nperseg else 0
+        if count:
+            windows = np.lib.stride_tricks.sliding_window_view(buffer, self.nperseg)[::self.step][:count]
+            self.freqs, psds = welch(windows, self.sampling_rate, nperseg=self.nperseg, axis=-1)
+            centres = self._carry_time + (np.arange(count) * self.step + self.nperseg / 2.) * period
+            for psd, label in zip(psds, labeller(centres)):
+                self.psds.append(psd)
+                if label is not None:
+                    self.exposure_sums[label] = self.exposure_sums.get(label, 0) + psd
+                    self.exposure_counts[label] = self.exposure_counts.get(label, 0) + 1
+        consumed = count * self.step
+        self._carry = buffer[consumed:].copy()
+        self._carry_time += consumed * period
+
+    def psd(self):
+        return np.mean(self.psds, axis=0) if self.psds else None
+
+
+class Monitor:
+    """
+    Near-real-time band power and exposure state of files being recorded
+    """
+
+    def __init__(self, ncs_files, nev_file=None, bands=None, window_sec=10., nperseg_sec=None, relative=False,
+                 signal_scaling=MICROVOLT_SCALING):
+        """
+        :param ncs_files: str or list of str, .ncs files to follow
+        :param nev_file: str, events file to follow for exposure labels
+        :param bands: dict of name -> [low, high], or list of [low, high]
+                      (default: degpy.terminal.terminal.BANDS)
+        :param window_sec: float, length of the rolling PSD (s)
+        :param nperseg_sec: float, Welch window length (s). If None,
+                            (1 / lowest band frequency) * 2
+        :param relative: bool, if True divide band power by the total power
+        :param signal_scaling: tuple, (scale factor from volts, units)
+        """
+        ncs_files = [ncs_files] if isinstance(ncs_files, str) else list(ncs_files)
+        self.channels = [os.path.splitext(os.path.basename(path))[0] for path in ncs_files]
+        self.ncs = [NcsFollower(path, signal_scaling) for path in ncs_files]
+        self.nev = NevFollower(nev_file) if nev_file is not None else None
+        self.bands = as_band_dict(BANDS if bands is None else bands)
+        self.window_sec = window_sec
+        self.nperseg_sec = nperseg_sec
+        self.relative = relative
+        self.last_time = [None] * len(self.ncs)  # Time (µs) of the last sample read from each channel
+        self._spectra = [None] * len(self.ncs)
+
+    def _labeller(self, times):
+        return self.nev.label_at(times) if self.nev is not None else [None] * len(times)
+
+    def _spectrum(self, i, sampling_rate):
+        if self._spectra[i] is None:
+            band_edges = np.array(list(self.bands.values()))
+            nperseg = window_samples(band_edges, self.nperseg_sec, sampling_rate)
+            step = nperseg - nperseg // 2
+            window_count = max(1, int((self.window_sec * sampling_rate - nperseg) // step) + 1)
+            self._spectra[i] = _RollingSpectrum(sampling_rate, nperseg, window_count)
+        return self._spectra[i]
+
+    def _bandpower(self, freqs, psd):
+        if psd is None:
+            return np.full(len(self.bands), np.nan)
+        return np.array([integrate_band(freqs, psd, band, self.relative) for band in self.bands.values()])
+
+    def poll(self):
+        """
+        Reads what has been appended to the files since the last poll and
+        updates the estimates
+
+        :return: dict with keys 'samples' (new samples per channel),
+                 'events' and 'event_timestamps' (new events), 'time' (µs of
+                 the last sample read), 'label' (innermost exposure active
+                 then), 'active' (open exposures), 'bandpower' (channels x
+                 bands, rolling), 'exposure_bandpower' (exposure -> channels
+                 x bands, over every window labelled with it), 'channels'
+                 and 'bands'
+        """
+        new_events = self.nev.read() if self.nev is not None else {'events': [], 'timestamps': []}
+
+        new_samples = []
+        for i, follower in enumerate(self.ncs):
+            block = follower.read()
+            new_samples.append(len(block['data']))
+            if not len(block['timestamp']):
+                continue
+            spectrum = self._spectrum(i, follower.sampling_rate)
+            starts = np.append(block['record_start'], len(block['data']))
+            pieces = np.concatenate(([0], block['gaps'], [len(block['timestamp'])]))
+            for first, stop in zip(pieces[:-1], pieces[1:]):
+                if first == stop:
+                    continue
+                if first in block['gaps'] or self.last_time[i] is None:
+                    spectrum.reset(float(block['timestamp'][first]))
+                spectrum.feed(block['data'][starts[first]:starts[stop]], self._labeller)
+            valid = starts[-1] - starts[-2]
+            self.last_time[i] = float(block['timestamp'][-1]) + (valid - 1) * 1e6 / follower.sampling_rate
+
+        times = [t for t in self.last_time if t is not None]
+        now = min(times) if times else None
+        bandpower = np.array([self._bandpower(spectrum.freqs, spectrum.psd()) if spectrum is not None
+                              else self._bandpower(None, None) for spectrum in self._spectra])
+        exposures = sorted(set(name for spectrum in self._spectra if spectrum is not None
+                               for name in spectrum.exposure_sums))
+        exposure_bandpower = {}
+        for name in exposures:
+            exposure_bandpower[name] = np.array([
+                self._bandpower(spectrum.freqs, spectrum.exposure_sums[name] / spectrum.exposure_counts[name])
+                if spectrum is not None and name in spectrum.exposure_sums else self._bandpower(None, None)
+                for spectrum in self._spectra])
+
+        return {
+            'samples': new_samples,
+            'events': new_events['events'],
+            'event_timestamps': new_events['timestamps'],
+            'time': now,
+            'label': self._labeller([now])[0] if now is not None else None,
+            'active': list(self.nev.active) if self.nev is not None else [],
+            'bandpower': bandpower.reshape(len(self.ncs), len(self.bands)),
+            'exposure_bandpower': exposure_bandpower,
+            'channels': self.channels,
+            'bands': list(self.bands),
+        }
+
+    def updates(self, interval=1., timeout=None, idle_timeout=None):
+        """
+        Generator of poll() results, polling every interval seconds and
+        yielding only when new records or events were read
+
+        :param interval: float, seconds between polls
+        :param timeout: float, stop after this many seconds
+        :param idle_timeout: float, stop after this many seconds without
+                             new data (e.g. once recording has stopped)
+        """
+        start = last_data = time.monotonic()
+        while True:
+            update = self.poll()
+            now = time.monotonic()
+            if any(update['samples']) or update['events']:
+                last_data = now
+                yield update
+            if timeout is not None and now - start >= timeout:
+                return
+            if idle_timeout is not None and now - last_data >= idle_timeout:
+                return
+            time.sleep(interval)
+
+    def run(self, callback, interval=1., timeout=None, idle_timeout=None):
+        """
+        Calls callback(update) for every update (see updates)
+        """
+        for update in self.updates(interval, timeout, idle_timeout):
+            callback(update)
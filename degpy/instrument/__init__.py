@@ -0,0 +1,2 @@
+from .instrument import (enable, disable, is_enabled, stage, instrumented, instrumented_method, stats, reset,
+                         merge_stats, to_json, current_recorder, Recorder)
\ No newline at end of file
@@ -0,0 +1,308 @@
+"""
+This module contains an optional instrumentation layer recording the wall
+time, bytes read and peak allocated memory of each processing stage
+
+Instrumentation is off by default, and disabled stages cost one flag check.
+
+    from degpy import instrument
+
+    instrument.enable(memory=True)
+    session = Session(path)
+    session.get_terminal('LFP1.ncs').bandpower_splits([4, 12])
+    session.stats()                     # per stage totals for the session
+    instrument.to_json(session.stats(), 'stats.json')
+
+Stages are recorded into the Recorder active on the current thread, which
+adds them to its parent in turn (a Terminal's Recorder reports to its
+Session's). Stages run with no active Recorder go to a module level one,
+see stats(). Times are inclusive of nested stages. Peak memory is the
+largest tracemalloc allocation above what was allocated when the stage
+started, and is only measured with enable(memory=True), which slows
+allocation-heavy code noticeably.
+"""
+
+import json
+import time
+import threading
+import functools
+import tracemalloc
+
+
+_state = threading.local()  # Per thread: stack of active Recorders and of open stage frames
+_options = {'enabled': False, 'memory': False, 'started_tracing': False}
+
+STAT_FIELDS = ('calls', 'wall_time', 'bytes_read', 'peak_memory')
+
+
+class Recorder(object):
+    """
+    Accumulates per stage totals: number of calls, wall time (s), bytes
+    read and the largest peak memory (bytes) of any call
+    """
+
+    def __init__(self, parent=None):
+        """
+        :param parent: Recorder every stage is also added to
+        """
+        self.parent = parent
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'Recorder({} stages)'.format(len(self._stats))
+
+    def add(self, name, wall_time=0., bytes_read=0, peak_memory=0, calls=1):
+        recorder = self
+        while recorder is not None:
+            with recorder._lock:
+                entry = recorder._stats.get(name)
+                if entry is None:
+                    entry = recorder._stats[name] = dict.fromkeys(STAT_FIELDS, 0)
+                entry['calls'] += calls
+                entry['wall_time'] += wall_time
+                entry['bytes_read'] += bytes_read
+                entry['peak_memory'] = max(entry['peak_memory'], peak_memory)
+            recorder = recorder.parent
+
+    def merge(self, stats):
+        """
+        Adds the totals of a stats() dict, e.g. one returned by a worker
+        process
+        """
+        for name, entry in stats.items():
+            self.add(name, entry['wall_time'], entry['bytes_read'], entry['peak_memory'], entry['calls'])
+
+    def stats(self):
+        """
+        :return: dict of stage name -> dict of 'calls', 'wall_time',
+                 'bytes_read' and 'peak_memory'
+        """
+        with self._lock:
+            return dict((name, dict(entry)) for name, entry in self._stats.items())
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    def activate(self):
+        """
+        Context manager making this the current thread's active Recorder
+        """
+        return _Activation(self)
+
+
+class _Activation(object):
+
+    def __init__(self, recorder):
+        self.recorder = recorder
+
+    def __enter__(self):
+        _recorders().append(self.recorder)
+        return self.recorder
+
+    def __exit__(self, *exc):
+        _recorders().pop()
+
+
+class _Stage(object):
+    # An open stage. Peak memory is tracked by resetting the tracemalloc peak on entry; the peak reached before the
+    # reset is handed back to the enclosing stage on exit, so nested stages do not hide each other's peaks.
+
+    def __init__(self, name, recorder):
+        self.name = name
+        self.recorder = recorder
+        self.bytes_read = 0
+
+    def add_bytes(self, count):
+        self.bytes_read += int(count)
+
+    def __enter__(self):
+        self._target = self.recorder if self.recorder is not None else current_recorder()
+        if self.recorder is not None:
+            _recorders().append(self.recorder)
+        self._memory = _options['memory'] and tracemalloc.is_tracing()
+        if self._memory:
+            current, peak = tracemalloc.get_traced_memory()
+            self._start_memory = current
+            self._outer_peak = peak
+            self._inner_peak = 0
+            if hasattr(tracemalloc, 'reset_peak'):  # Python 3.9+; earlier versions report the peak since tracing began
+                tracemalloc.reset_peak()
+            _frames().append(self)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall_time = time.perf_counter() - self._start
+        peak = 0
+        if self._memory:
+            _frames().pop()
+            absolute_peak = max(tracemalloc.get_traced_memory()[1], self._inner_peak)
+            peak = max(absolute_peak - self._start_memory, 0)
+            frames = _frames()
+            if frames:
+                frames[-1]._inner_peak = max(frames[-1]._inner_peak, absolute_peak, self._outer_peak)
+        if self.recorder is not None:
+            _recorders().pop()
+
+        self._target.add(self.name, wall_time, self.bytes_read, peak)
+
+
+class _NullStage(object):
+    # Stand-in returned while instrumentation is disabled
+
+    bytes_read = 0
+
+    def add_bytes(self, count):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+_global_recorder = Recorder()
+
+
+def _recorders():
+    stack = getattr(_state, 'recorders', None)
+    if stack is None:
+        stack = _state.recorders = []
+    return stack
+
+
+def _frames():
+    frames = getattr(_state, 'frames', None)
+    if frames is None:
+        frames = _state.frames = []
+    return frames
+
+
+def enable(memory=False):
+    """
+    Turns instrumentation on
+
+    :param memory: bool, also measure peak memory with tracemalloc (started
+                   if it is not already tracing)
+    """
+    _options['memory'] = memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _options['started_tracing'] = True
+    _options['enabled'] = True
+
+
+def disable():
+    """
+    Turns instrumentation off, stopping tracemalloc if enable started it
+    """
+    if _options['started_tracing'] and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _options.update(enabled=False, memory=False, started_tracing=False)
+
+
+def is_enabled():
+    return _options['enabled']
+
+
+def current_recorder():
+    """
+    :return: Recorder, the current thread's active Recorder, or the module
+             level one
+    """
+    stack = _recorders()
+    return stack[-1] if stack else _global_recorder
+
+
+def stage(name, recorder=None):
+    """
+    Context manager timing a stage. Bytes read are reported with
+    add_bytes on the returned object.
+
+    :param name: str, stage name
+    :param recorder: Recorder to record into, made active for the duration
+                     of the stage (default: the current Recorder)
+    """
+    if not _options['enabled']:
+        return _NULL_STAGE
+    return _Stage(name, recorder)
+
+
+def instrumented(name, bytes_read=None):
+    """
+    Decorator recording every call of a function as a stage
+
+    :param name: str, stage name
+    :param bytes_read: callable, computes the bytes read from the result
+                       and the arguments of the call
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _options['enabled']:
+                return func(*args, **kwargs)
+            with _Stage(name, None) as record:
+                result = func(*args, **kwargs)
+                if bytes_read is not None:
+                    record.add_bytes(bytes_read(result, *args, **kwargs))
+            return result
+        return wrapper
+    return decorate
+
+
+def instrumented_method(name):
+    """
+    Decorator recording every call of a method as a stage of the
+    instance's Recorder (its _recorder attribute), which is active while
+    the method runs
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if not _options['enabled']:
+                return func(self, *args, **kwargs)
+            with _Stage(name, self._recorder):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def stats():
+    """
+    :return: dict, stats of the stages run with no active Recorder
+    """
+    return _global_recorder.stats()
+
+
+def reset():
+    _global_recorder.reset()
+
+
+def merge_stats(stats_list):
+    """
+    Sums a list of stats() dicts, e.g. one per session
+
+    :return: dict, combined stats
+    """
+    recorder = Recorder()
+    for entry in stats_list:
+        if entry:
+            recorder.merge(entry)
+    return recorder.stats()
+
+
+def to_json(stats, path=None):
+    """
+    Serialises a stats() dict (or any dict of them) as JSON
+
+    :param path: str, file to write to
+    :return: str, the JSON text
+    """
+    text = json.dumps(stats, indent=2, sort_keys=True)
+    if path is not None:
+        with open(path, 'w') as fid:
+            fid.write(text)
+    return text
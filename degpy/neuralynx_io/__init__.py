@@ -1,3 +1,10 @@
 from .neuralynx_io import (load_ncs, load_nev, read_header,
                           parse_header, read_records, estimate_record_count,
-                          parse_neuralynx_time_string, check_ncs_records)
+                          parse_neuralynx_time_string, check_ncs_records,
+                          map_records, NcsFile, NcsSamples, iter_ncs_chunks,
+                          read_ncs, ScaledArray, scale_samples, TimeIndex,
+                          load_spikes, load_nse, load_nst, load_ntt, select_spikes,
+                          decode_event_strings, validate_ncs_records, RecordValidation,
+                          RecordValidator, ncs_time_index, Decimator, decimation_factor,
+                          decimate_ncs_records)
+from .cache import NcsCache, set_cache_dir, get_cache
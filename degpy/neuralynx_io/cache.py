@@ -0,0 +1,239 @@
+# coding=utf-8
+
+from __future__ import division
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import warnings
+import numpy as np
+
+from degpy.instrument.instrument import instrumented
+from .neuralynx_io import (read_header, parse_header, map_records, RecordValidator, RecordValidation,
+                           decimate_ncs_records, NCS_RECORD, NCS_SAMPLES_PER_RECORD)
+
+CACHE_CHUNK_RECORDS = 4096  # Records decoded per step when writing a sidecar
+CACHE_FORMAT = 3  # Bumped when the layout or decoding of entries changes, so that older entries are no longer used
+
+_default_cache = None
+
+
+class NcsCache(object):
+    # Persistent on-disk cache of decoded .ncs files. Each entry is a directory holding the samples as one contiguous
+    # int16 array, the record timestamps and the raw header, keyed by the absolute path, size and mtime of the source
+    # file, so that editing or replacing a file invalidates its entry. Entries are memory-mapped on load. When max_bytes
+    # is set, the least recently used entries are evicted to keep the cache under that size.
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def __repr__(self):
+        return 'NcsCache({!r}, max_bytes={!r})'.format(self.cache_dir, self.max_bytes)
+
+    def key(self, file_path, variant=''):
+        # Identity of the file contents: absolute path, size and modification time
+        file_path = os.path.abspath(file_path)
+        stat = os.stat(file_path)
+        identity = u'{}|{}|{}|{}|{}'.format(file_path, stat.st_size, stat.st_mtime_ns, variant, CACHE_FORMAT)
+        return hashlib.sha1(identity.encode('utf8')).hexdigest()
+
+    def entry_path(self, file_path, variant=''):
+        return os.path.join(self.cache_dir, self.key(file_path, variant))
+
+    @instrumented('NcsCache.get')
+    def get(self, file_path, variant=''):
+        # Return the cached entry for the file, or None if it is not cached
+        path = self.entry_path(file_path, variant)
+        meta_path = os.path.join(path, 'meta.json')
+        if not os.path.exists(meta_path):
+            return None
+
+        with open(meta_path) as fid:
+            meta = json.load(fid)
+        with open(os.path.join(path, 'header.bin'), 'rb') as fid:
+            raw_header = fid.read()
+
+        # Touch the entry so eviction treats it as recently used
+        os.utime(meta_path, None)
+
+        entry = dict(meta)
+        entry['raw_header'] = raw_header
+        entry['header'] = parse_header(raw_header)
+        entry['samples'] = _load_array(os.path.join(path, 'samples.npy'))
+        entry['timestamp'] = _load_array(os.path.join(path, 'timestamp.npy'))
+        for name in meta.get('arrays', []):
+            entry[name] = _load_array(os.path.join(path, name + '.npy'))
+        if 'valid_samples' in entry:
+            entry['validation'] = RecordValidation(entry['valid_samples'], entry['gaps'], meta['channel_numbers'],
+                                                   meta['sampling_rates'],
+                                                   meta.get('samples_per_record', NCS_SAMPLES_PER_RECORD))
+
+        return entry
+
+    @instrumented('NcsCache.put', bytes_read=lambda entry, self, file_path, *args: os.path.getsize(file_path))
+    def put(self, file_path, decimate=1, numtaps=None):
+        # Decode the file into a new entry, streaming the records so the file never has to fit in memory. The records
+        # are validated as they are copied, and the valid sample counts and gap table are stored with the samples.
+        # With decimate > 1 the entry holds the float32 samples decimated by that factor (see Decimator).
+        file_path = os.path.abspath(file_path)
+        with open(file_path, 'rb') as fid:
+            raw_header = read_header(fid)
+        header = parse_header(raw_header)
+        records = map_records(file_path, NCS_RECORD)
+
+        def write(tmp_path):
+            dtype = np.int16 if decimate == 1 else np.float32
+            samples = np.lib.format.open_memmap(os.path.join(tmp_path, 'samples.npy'), mode='w+', dtype=dtype,
+                                                shape=(len(records) * NCS_SAMPLES_PER_RECORD // decimate,))
+            timestamp = np.lib.format.open_memmap(os.path.join(tmp_path, 'timestamp.npy'), mode='w+',
+                                                  dtype=np.uint64, shape=(len(records),))
+            if decimate == 1:
+                validator = RecordValidator(len(records))
+                blocks = samples.reshape(-1, NCS_SAMPLES_PER_RECORD)
+                for start in range(0, len(records), CACHE_CHUNK_RECORDS):
+                    chunk = np.array(records[start:start + CACHE_CHUNK_RECORDS])
+                    blocks[start:start + len(chunk)] = chunk['Samples']
+                    timestamp[start:start + len(chunk)] = chunk['TimeStamp']
+                    validator.feed(chunk)
+                validation = validator.result()
+                del blocks
+            else:
+                validation = decimate_ncs_records(records, decimate, samples, timestamp, numtaps, CACHE_CHUNK_RECORDS)
+            samples.flush()
+            timestamp.flush()
+            del samples, timestamp
+
+            validation.warn()
+            np.save(os.path.join(tmp_path, 'valid_samples.npy'), validation.valid_samples)
+            np.save(os.path.join(tmp_path, 'gaps.npy'), validation.gaps)
+
+            sampling_rate = int(records['SampleFreq'][0]) if len(records) else None
+            if sampling_rate is not None and decimate > 1:
+                sampling_rate = sampling_rate / decimate
+
+            return {
+                'sampling_rate': sampling_rate,
+                'channel_number': int(records['ChannelNumber'][0]) if len(records) else None,
+                'ad_bit_volts': float(header['ADBitVolts']) if 'ADBitVolts' in header else None,
+                'channel_numbers': validation.channel_numbers,
+                'sampling_rates': validation.sampling_rates,
+                'samples_per_record': validation.samples_per_record,
+                'arrays': ['valid_samples', 'gaps'],
+            }
+
+        return self.put_arrays(file_path, raw_header, write, _decimation_variant(decimate, numtaps))
+
+    def put_arrays(self, file_path, raw_header, write, variant=''):
+        # Create an entry by calling write(tmp_path), which writes samples.npy and timestamp.npy (plus any extra
+        # arrays named in the returned metadata's 'arrays' list) into tmp_path and returns the metadata. The entry
+        # only becomes visible once it has been completely written.
+        file_path = os.path.abspath(file_path)
+        path = self.entry_path(file_path, variant)
+        tmp_path = '{}.tmp-{}'.format(path, os.getpid())
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+
+        try:
+            meta = write(tmp_path)
+            meta.update({'file_path': file_path, 'variant': variant, 'created': time.time()})
+            with open(os.path.join(tmp_path, 'header.bin'), 'wb') as fid:
+                fid.write(raw_header)
+            with open(os.path.join(tmp_path, 'meta.json'), 'w') as fid:
+                json.dump(meta, fid)
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                # Another process cached the same file first
+                shutil.rmtree(tmp_path)
+        except Exception:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+        self.evict(keep=path)
+
+        return self.get(file_path, variant)
+
+    def load(self, file_path, decimate=1, numtaps=None):
+        # Return the cached entry for the file, decoding and caching it first if needed
+        entry = self.get(file_path, _decimation_variant(decimate, numtaps))
+        if entry is None:
+            entry = self.put(file_path, decimate, numtaps)
+        return entry
+
+    def entries(self):
+        # List (path, size in bytes, last used time) of every complete entry
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            meta_path = os.path.join(path, 'meta.json')
+            if '.tmp-' in name or not os.path.exists(meta_path):
+                continue
+            size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+            entries.append((path, size, os.path.getmtime(meta_path)))
+
+        return entries
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, keep=None):
+        # Remove least recently used entries until the cache fits in max_bytes. The entry at `keep` is never evicted.
+        if self.max_bytes is None:
+            return
+
+        entries = sorted(self.entries(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+        if total > self.max_bytes:
+            warnings.warn('Cache entry is larger than the cache size limit of {} bytes'.format(self.max_bytes))
+
+    def clear(self):
+        for path, _, _ in self.entries():
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def _decimation_variant(decimate, numtaps):
+    # Cache variant of the samples decimated by `decimate` with a numtaps filter; '' for the full rate samples
+    if decimate == 1:
+        return ''
+    return 'decimate={}:{}'.format(decimate, 20 * decimate + 1 if numtaps is None else numtaps)
+
+
+def _load_array(path):
+    # Memory-map a .npy file; empty arrays cannot be mapped and are read instead
+    try:
+        return np.load(path, mmap_mode='r')
+    except ValueError:
+        return np.load(path)
+
+
+def set_cache_dir(cache_dir, max_bytes=None):
+    # Enable the on-disk cache for every loader that is not given an explicit cache. Pass None to disable it again.
+    global _default_cache
+    _default_cache = NcsCache(cache_dir, max_bytes) if cache_dir is not None else None
+    return _default_cache
+
+
+def get_cache(cache=None):
+    # Resolve a loader's cache argument: an NcsCache is used as is, a path opens a cache in that directory, False
+    # disables caching and None falls back to the cache set with set_cache_dir (if any)
+    if cache is None:
+        return _default_cache
+    if cache is False:
+        return None
+    if isinstance(cache, NcsCache):
+        return cache
+    return NcsCache(cache)
@@ -3,9 +3,13 @@
 from __future__ import division
 
 import os
+import bisect
 import warnings
 import numpy as np
 import datetime
+from scipy.signal import firwin, upfirdn
+
+from degpy.instrument.instrument import instrumented
 
 HEADER_LENGTH = 16 * 1024  # 16 kilobytes of header
 
@@ -49,7 +53,7 @@ NSE_RECORD = np.dtype([('TimeStamp',  np.uint64),       # Cheetah timestamp for
                        ('Params',     np.uint32, 8),    # Array of selected feature data for this spike channel. Cheetah
                                                         # currently allows eight (8) selected features, so this array is fixed
                                                         # at length eight.
-                       ('Data',       np.int, (32, 1))  # Data points for this record. Cheetah currently supports 32 points per
+                       ('Data',       np.int16, (32, 1))  # Data points for this record. Cheetah currently supports 32 points per
                                                         # spike record. The array is organized as [DATAPOINTS, CHANNEL]. At this 
                                                         # time, the Data array is a [32, 1] array.
 ])
@@ -62,7 +66,7 @@ NST_RECORD = np.dtype([('TimeStamp',  np.uint64),       # Cheetah timestamp for
                        ('Params',     np.uint32, 8),    # Array of selected feature data for this spike channel. Cheetah
                                                         # currently allows eight (8) selected features, so this array is fixed
                                                         # at length eight.
-                       ('Data',       np.int, (32, 2))  # Data points for this record. Cheetah currently supports 32 points per
+                       ('Data',       np.int16, (32, 2))  # Data points for this record. Cheetah currently supports 32 points per
                                                         # spike record. The array is organized as [DATAPOINTS, CHANNEL]. At this 
                                                         # time, the Data array is a [32, 2] array.
 ])
@@ -75,16 +79,26 @@ NTT_RECORD = np.dtype([('TimeStamp',  np.uint64),       # Cheetah timestamp for
                        ('Params',     np.uint32, 8),    # Array of selected feature data for this spike channel. Cheetah
                                                         # currently allows eight (8) selected features, so this array is fixed
                                                         # at length eight.
-                       ('Data',       np.int, (32, 4))  # Data points for this record. Cheetah currently supports 32 points per
+                       ('Data',       np.int16, (32, 4))  # Data points for this record. Cheetah currently supports 32 points per
                                                         # spike record. The array is organized as [DATAPOINTS, CHANNEL]. At this 
                                                         # time, the Data array is a [32, 4] array.
 ])
 
+# Record layout by file extension
+RECORD_DTYPES = {
+    'ncs': NCS_RECORD,
+    'nev': NEV_RECORD,
+    'nse': NSE_RECORD,
+    'nst': NST_RECORD,
+    'ntt': NTT_RECORD,
+}
+
 VOLT_SCALING = (1, u'V')
 MILLIVOLT_SCALING = (1000, u'mV')
 MICROVOLT_SCALING = (1000000, u'µV')
 
 
+@instrumented('read_header', bytes_read=lambda raw_hdr, *args: HEADER_LENGTH)
 def read_header(fid):
     # Read the raw header data (16 kb) from the file object fid. Restores the position in the file object after reading.
     pos = fid.tell()
@@ -95,6 +109,7 @@ def read_header(fid):
     return raw_hdr
 
 
+@instrumented('parse_header')
 def parse_header(raw_hdr):
     # Parse the header string into a dictionary of name value pairs
     hdr = dict()
@@ -122,17 +137,19 @@ def parse_header(raw_hdr):
     hdr[u'TimeClosed'] = hdr_lines[3][3:]
     hdr[u'TimeClosed_dt'] = parse_neuralynx_time_string(hdr_lines[3])
 
-    # Read the parameters, assuming "-PARAM_NAME PARAM_VALUE" format
+    # Read the parameters, assuming "-PARAM_NAME PARAM_VALUE" format. Parameters with several values (e.g. ADBitVolts
+    # in tetrode files, one per channel) keep them as a single space separated string.
     for line in hdr_lines[4:]:
         try:
-            name, value = line[1:].split()  # Ignore the dash and split PARAM_NAME and PARAM_VALUE
-            hdr[name] = value
+            name, value = line[1:].split(None, 1)  # Ignore the dash and split PARAM_NAME and PARAM_VALUE
+            hdr[name] = value.strip()
         except:
             warnings.warn('Unable to parse parameter line from Neuralynx header: ' + line)
 
     return hdr
 
 
+@instrumented('read_records', bytes_read=lambda records, *args, **kwargs: records.nbytes)
 def read_records(fid, record_dtype, record_skip=0, count=None):
     # Read count records (default all) from the file object fid skipping the first record_skip records. Restores the
     # position of the file object after reading.
@@ -174,46 +191,814 @@ def parse_neuralynx_time_string(time_string):
                                  tmp_microsecond)
 
 
+NCS_GAP = np.dtype([('record',   np.int64),    # Index of the record that does not follow on from the previous one
+                    ('expected', np.uint64),   # Timestamp (µs) expected from the previous record's valid samples
+                    ('actual',   np.uint64)])  # Timestamp (µs) of the record
+
+VALIDATION_CHUNK_RECORDS = 4096  # Records checked per step by validate_ncs_records
+
+
+class RecordValidation(object):
+    # Result of a single validation pass over .ncs records (see validate_ncs_records). valid_samples holds the
+    # NumValidSamples of every record and gaps is an NCS_GAP table of the records whose timestamp is not where the
+    # previous record's valid samples end. Records with fewer than 512 valid samples are padded; sample_mask and
+    # compact select the valid samples of the flattened data.
+
+    def __init__(self, valid_samples, gaps, channel_numbers, sampling_rates, samples_per_record=NCS_SAMPLES_PER_RECORD):
+        self.valid_samples = valid_samples
+        self.gaps = gaps
+        self.channel_numbers = [int(n) for n in channel_numbers]
+        self.sampling_rates = [int(r) for r in sampling_rates]
+        self.samples_per_record = samples_per_record
+
+    def __repr__(self):
+        return 'RecordValidation({} records, {} gaps, {} invalid samples)'.format(len(self), len(self.gaps),
+                                                                                 self.invalid_count)
+
+    def __len__(self):
+        return len(self.valid_samples)
+
+    @property
+    def partial_records(self):
+        # Indices of the records holding fewer than samples_per_record valid samples
+        return np.flatnonzero(self.valid_samples != self.samples_per_record)
+
+    @property
+    def invalid_count(self):
+        return int(len(self) * self.samples_per_record - np.sum(self.valid_samples, dtype=np.int64))
+
+    @property
+    def valid_count(self):
+        return len(self) * self.samples_per_record - self.invalid_count
+
+    @property
+    def is_valid(self):
+        return (len(self.channel_numbers) <= 1 and len(self.sampling_rates) <= 1 and self.invalid_count == 0
+                and len(self.gaps) == 0)
+
+    def segment_starts(self, compact=False):
+        # Records that start a new continuous stretch of data: those after a gap and, unless the padding of partial
+        # records is dropped, those after a partial record
+        starts = self.gaps['record']
+        if not compact:
+            after_partial = self.partial_records + 1
+            starts = np.union1d(starts, after_partial[after_partial < len(self)])
+        return np.asarray(starts, dtype=np.int64)
+
+    def sample_mask(self):
+        # Boolean mask of the valid samples in the flattened (records * samples_per_record) data
+        offsets = np.arange(self.samples_per_record, dtype=self.valid_samples.dtype)
+        return (offsets < self.valid_samples[:, None]).ravel()
+
+    def compact(self, samples):
+        # The valid samples of the flattened data, without the padding of partial records
+        if self.invalid_count == 0:
+            return samples
+        return np.asarray(samples)[self.sample_mask()]
+
+    def decimated(self, q):
+        # The same validation for data decimated by q, whose records hold samples_per_record // q samples
+        valid_samples = -(-self.valid_samples.astype(np.int64) // q)
+        return RecordValidation(valid_samples.astype(np.uint32), self.gaps, self.channel_numbers, self.sampling_rates,
+                                self.samples_per_record // q)
+
+    def warn(self):
+        # Emit a warning for the first problem found, and return whether the records are valid
+        if len(self.channel_numbers) > 1:
+            warnings.warn('Channel number changed during record sequence')
+        elif len(self.sampling_rates) > 1:
+            warnings.warn('Sampling frequency changed during record sequence')
+        elif self.invalid_count:
+            warnings.warn('Invalid samples in one or more records')
+        elif len(self.gaps):
+            warnings.warn('Time stamp difference tolerance exceeded')
+        else:
+            return True
+        return False
+
+
+class RecordValidator(object):
+    # Incremental form of validate_ncs_records. Records are fed in order, one chunk at a time, and only the timestamp
+    # and valid sample count of the last record are carried between chunks. feed returns the indices (within the
+    # chunk) of the records that start after a gap.
+
+    def __init__(self, record_count=None, tolerance=None):
+        self.tolerance = tolerance
+        self._valid = [] if record_count is None else np.zeros(record_count, np.uint32)
+        self._gaps = []
+        self._channel_numbers = set()
+        self._sampling_rates = set()
+        self._count = 0
+        self._last = None  # (timestamp, valid samples) of the last record fed
+
+    def feed(self, records):
+        count = len(records)
+        if count == 0:
+            return np.zeros(0, np.int64)
+        timestamps = np.asarray(records['TimeStamp'])
+        valid = np.asarray(records['NumValidSamples'])
+        self._channel_numbers.update(np.unique(records['ChannelNumber']).tolist())
+        self._sampling_rates.update(np.unique(records['SampleFreq']).tolist())
+        if isinstance(self._valid, list):
+            self._valid.append(valid.copy())
+        else:
+            self._valid[self._count:self._count + count] = valid
+
+        if self._last is None:
+            self._rate = float(records['SampleFreq'][0])
+            self._period = 1e6 / self._rate if self._rate else 0.
+            if self.tolerance is None:
+                self.tolerance = self._period
+            previous = timestamps[:-1]
+            previous_valid = valid[:-1]
+            first = 1
+        else:
+            previous = np.concatenate(([self._last[0]], timestamps[:-1]))
+            previous_valid = np.concatenate(([self._last[1]], valid[:-1]))
+            first = 0
+
+        expected = previous.astype(np.float64) + previous_valid * self._period
+        actual = timestamps[first:]
+        bad = np.flatnonzero(np.abs(actual - expected) > self.tolerance)
+        if len(bad):
+            gaps = np.zeros(len(bad), NCS_GAP)
+            gaps['record'] = self._count + first + bad
+            gaps['expected'] = np.round(expected[bad])
+            gaps['actual'] = actual[bad]
+            self._gaps.append(gaps)
+
+        self._last = (timestamps[-1], valid[-1])
+        self._count += count
+
+        return first + bad
+
+    def result(self):
+        valid = np.concatenate(self._valid) if isinstance(self._valid, list) and self._valid else self._valid
+        valid = np.asarray(valid, dtype=np.uint32)[:self._count]
+        gaps = np.concatenate(self._gaps) if self._gaps else np.zeros(0, NCS_GAP)
+
+        return RecordValidation(valid, gaps, sorted(self._channel_numbers), sorted(self._sampling_rates))
+
+
+@instrumented('validate_ncs_records')
+def validate_ncs_records(records, tolerance=None, chunk_records=VALIDATION_CHUNK_RECORDS):
+    # Check .ncs records in one pass, chunk by chunk, so memory-mapped files are read once and only a chunk at a time.
+    # A record is a gap when its timestamp differs by more than tolerance µs (default: one sample period) from the end
+    # of the previous record's valid samples. Returns a RecordValidation.
+    validator = RecordValidator(len(records), tolerance)
+    for start in range(0, len(records), chunk_records):
+        validator.feed(records[start:start + chunk_records])
+
+    return validator.result()
+
+
 def check_ncs_records(records):
     # Check that all the records in the array are "similar" (have the same sampling frequency etc.
-    dt = np.diff(records['TimeStamp'])
-    dt = np.abs(dt - dt[0])
-    if not np.all(records['ChannelNumber'] == records[0]['ChannelNumber']):
-        warnings.warn('Channel number changed during record sequence')
-        return False
-    elif not np.all(records['SampleFreq'] == records[0]['SampleFreq']):
-        warnings.warn('Sampling frequency changed during record sequence')
-        return False
-    elif not np.all(records['NumValidSamples'] == 512):
-        warnings.warn('Invalid samples in one or more records')
-        return False
-    elif not np.all(dt <= 1):
-        warnings.warn('Time stamp difference tolerance exceeded')
-        return False
-    else:
-        return True
+    return validate_ncs_records(records).warn()
+
+
+def decimation_factor(sampling_rate, decimate=None, target_rate=None):
+    # Resolve a loader's decimate / target_rate arguments to an integer decimation factor (1 for none). The factor must
+    # divide the 512 samples of a record, so that every record decimates to a whole number of samples.
+    if target_rate is not None:
+        if decimate is not None:
+            raise ValueError('Give either decimate or target_rate, not both')
+        decimate = int(round(float(sampling_rate) / target_rate))
+        if decimate < 1 or abs(float(sampling_rate) / decimate - target_rate) > 1e-6 * target_rate:
+            raise ValueError('target_rate {} Hz is not an integer fraction of {} Hz'.format(target_rate,
+                                                                                            sampling_rate))
+    decimate = 1 if decimate is None else int(decimate)
+    if decimate < 1 or NCS_SAMPLES_PER_RECORD % decimate:
+        raise ValueError('decimate must be a power of two that divides the {} samples of a record, got {}'.format(
+            NCS_SAMPLES_PER_RECORD, decimate))
+
+    return decimate
+
+
+class Decimator(object):
+    # Streaming polyphase FIR decimation by an integer factor q. Uses the same Hamming-window low-pass filter as
+    # scipy.signal.decimate(ftype='fir') (numtaps = 20 * q + 1 by default), applied with upfirdn so only the kept output
+    # samples are computed. The last numtaps - 1 input samples are carried between calls to feed, so the output does
+    # not depend on how the input is chunked. The filter delay is compensated: output j is centred on input sample
+    # j * q, which requires numtaps - 1 to be a multiple of 2 * q. Output therefore lags input by (numtaps - 1) / 2
+    # samples until flush, which zero pads past the end of the signal and resets the filter.
+
+    def __init__(self, q, numtaps=None):
+        self.q = int(q)
+        numtaps = 20 * self.q + 1 if numtaps is None else int(numtaps)
+        if (numtaps - 1) % (2 * self.q):
+            raise ValueError('numtaps - 1 must be a multiple of 2 * q')
+        self.taps = firwin(numtaps, 1. / self.q, window='hamming')
+        self.delay = (numtaps - 1) // 2
+        self.reset()
+
+    def reset(self):
+        self._history = np.zeros(2 * self.delay)
+        self._fed = 0
+        self._emitted = 0
+
+    def feed(self, samples):
+        # Decimate the next len(samples) input samples (a multiple of q); returns the output samples now complete
+        if len(samples) % self.q:
+            raise ValueError('Decimator input must be fed in multiples of q samples')
+        segment = np.concatenate((self._history, samples))
+        filtered = upfirdn(self.taps, segment, 1, self.q)
+        # filtered[i] is centred on input sample self._fed + (i - 3 * delay / q) * q
+        first = 3 * self.delay // self.q - self._fed // self.q + self._emitted
+        stop = (len(segment) - 1) // self.q + 1
+        out = filtered[first:max(first, stop)]
+
+        self._history = segment[len(segment) - 2 * self.delay:]
+        self._fed += len(samples)
+        self._emitted += len(out)
+        return out
+
+    def flush(self):
+        # The remaining output samples, with the input zero padded past its end; resets the filter
+        remaining = self._fed // self.q - self._emitted
+        out = self.feed(np.zeros(self.delay))[:remaining] if remaining else np.zeros(0)
+        self.reset()
+        return out
+
+
+class _RecordDecimator(object):
+    # Decimator over a stream of .ncs records that restarts the filter at every segment start: after a gap and after
+    # a partial record. No output sample mixes samples from either side of a discontinuity. Only the valid samples of
+    # a partial record are filtered (rounded up to a multiple of q). Its padding decimates to zeros, or is left out
+    # with compact=True, matching RecordValidation.decimated(q).
+
+    def __init__(self, q, numtaps=None, compact=False):
+        self.decimator = Decimator(q, numtaps)
+        self.q = self.decimator.q
+        self.compact = compact
+
+    def feed(self, records, gaps):
+        # Decimated samples completed by the next records, given the indices of those that start after a gap (as
+        # returned by RecordValidator.feed)
+        valid = np.minimum(records['NumValidSamples'], NCS_SAMPLES_PER_RECORD).astype(np.int64)
+        bounds = np.union1d(np.asarray(gaps, dtype=np.int64), np.flatnonzero(valid < NCS_SAMPLES_PER_RECORD) + 1)
+        restarts = set(int(g) for g in gaps)
+        out = []
+        for start, stop in zip(np.concatenate(([0], bounds)), np.concatenate((bounds, [len(records)]))):
+            if start in restarts:
+                out.append(self.decimator.flush())
+            if stop <= start:
+                continue
+            samples = records['Samples'][start:stop].reshape(-1)
+            count = (stop - start - 1) * NCS_SAMPLES_PER_RECORD + valid[stop - 1]
+            if count == len(samples):
+                out.append(self.decimator.feed(samples))
+                continue
+
+            # A partial record ends its segment
+            count = -(-count // self.q) * self.q
+            if count:
+                out.append(self.decimator.feed(samples[:count]))
+            out.append(self.decimator.flush())
+            if not self.compact:
+                out.append(np.zeros((len(samples) - count) // self.q))
+
+        return np.concatenate(out) if out else np.zeros(0)
+
+    def flush(self):
+        # The output still held back by the filter delay
+        return self.decimator.flush()
+
+
+@instrumented('decimate_ncs_records', bytes_read=lambda validation, records, *args, **kwargs: records.nbytes)
+def decimate_ncs_records(records, q, samples, timestamp, numtaps=None, chunk_records=VALIDATION_CHUNK_RECORDS):
+    # Validate and decimate .ncs records in a single streaming pass, writing the decimated samples (ADC counts) into
+    # samples (len(records) * 512 // q) and the record start times into timestamp. The filter is restarted at every
+    # gap and after every partial record, so that no output mixes samples from either side of a discontinuity, and the
+    # padding of partial records is never filtered (see _RecordDecimator). Returns the RecordValidation of the
+    # decimated data.
+    validator = RecordValidator(len(records))
+    decimator = _RecordDecimator(q, numtaps)
+    position = 0
+    for start in range(0, len(records), chunk_records):
+        chunk = np.array(records[start:start + chunk_records])
+        timestamp[start:start + len(chunk)] = chunk['TimeStamp']
+        out = decimator.feed(chunk, validator.feed(chunk))
+        samples[position:position + len(out)] = out
+        position += len(out)
+
+    out = decimator.flush()
+    samples[position:position + len(out)] = out
+
+    return validator.result().decimated(q)
+
+
+class TimeIndex(object):
+    # Compact time base for continuous data. Stores only the start timestamp (µs) of each record and the sampling rate,
+    # and computes sample times on demand, so the time of every sample never has to be materialised. Records that do not
+    # start where the previous one ended (e.g. when Cheetah pauses acquisition) are detected as gaps, and sample times
+    # are always measured from the start of their own record, so they stay correct across gaps. gaps may be given
+    # (e.g. from a RecordValidation) to skip detecting them, and valid_samples describes data whose partial records
+    # have been compacted, so that records hold different numbers of samples.
+
+    def __init__(self, record_timestamps, sampling_rate, samples_per_record=NCS_SAMPLES_PER_RECORD, tolerance=None,
+                 gaps=None, valid_samples=None):
+        self.record_timestamps = np.array(record_timestamps, dtype=np.uint64)
+        self.sampling_rate = float(sampling_rate)
+        self.samples_per_record = int(samples_per_record)
+        self.sample_period = 1e6 / self.sampling_rate if self.sampling_rate else 0.
+        self.record_duration = self.samples_per_record * self.sample_period
+        # Deviation from the expected record spacing (µs) above which records are considered discontinuous
+        self.tolerance = self.sample_period if tolerance is None else tolerance
+        self._gaps = None if gaps is None else np.asarray(gaps, dtype=np.int64)
+
+        # First sample of every record (and the total length) when records are not all samples_per_record long
+        self.valid_samples = None
+        self._offsets = None
+        if valid_samples is not None and np.any(np.asarray(valid_samples) != self.samples_per_record):
+            self.valid_samples = np.asarray(valid_samples, dtype=np.int64)
+            self._offsets = np.concatenate(([0], np.cumsum(self.valid_samples)))
+
+    def __repr__(self):
+        return 'TimeIndex({} records, {} Hz, {} gaps)'.format(len(self.record_timestamps), self.sampling_rate,
+                                                              len(self.gaps))
+
+    def __len__(self):
+        if self._offsets is not None:
+            return int(self._offsets[-1])
+        return len(self.record_timestamps) * self.samples_per_record
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            return self.sample_to_time(np.arange(start, stop, step))
+        return self.sample_to_time(key)
+
+    @property
+    def gaps(self):
+        # Indices of the records that start a new continuous segment
+        if self._gaps is None:
+            delta = np.diff(self.record_timestamps.astype(np.float64))
+            duration = self.record_duration
+            if self.valid_samples is not None:
+                duration = self.valid_samples[:-1] * self.sample_period
+            self._gaps = np.flatnonzero(np.abs(delta - duration) > self.tolerance) + 1
+        return self._gaps
+
+    def record_start(self, record):
+        # Index of the first sample of the given record(s)
+        if self._offsets is not None:
+            return self._offsets[record]
+        return np.asarray(record, dtype=np.int64) * self.samples_per_record
+
+    def segments(self):
+        # (start, stop) sample ranges of the continuous stretches of data between gaps
+        bounds = self.record_start(np.concatenate(([0], self.gaps, [len(self.record_timestamps)])).astype(np.int64))
+        return np.column_stack((bounds[:-1], bounds[1:]))
+
+    def sample_to_time(self, index):
+        # Time (µs) of the given sample index or array of indices
+        index = np.asarray(index, dtype=np.int64)
+        index = np.where(index < 0, index + len(self), index)
+        if self._offsets is not None:
+            record = np.searchsorted(self._offsets, index, side='right') - 1
+            offset = index - self._offsets[record]
+        else:
+            record, offset = np.divmod(index, self.samples_per_record)
+        times = self.record_timestamps[record].astype(np.float64) + offset * self.sample_period
+        return times[()] if times.ndim == 0 else times
+
+    def time_to_sample(self, time, side='left'):
+        # Index of the first sample recorded at or after the given time(s) (side='left'), or strictly after them
+        # (side='right'). Times that fall in a gap map to the first sample after the gap. O(log n) per time.
+        time = np.asarray(time, dtype=np.float64)
+        record = np.searchsorted(self.record_timestamps, time, side='right') - 1
+        start = self.record_timestamps[np.maximum(record, 0)].astype(np.float64)
+        elapsed = (time - start) / self.sample_period if self.sample_period else np.zeros_like(time)
+        if side == 'left':
+            offset = np.ceil(elapsed - 1e-9)
+        elif side == 'right':
+            offset = np.floor(elapsed + 1e-9) + 1
+        else:
+            raise ValueError("side must be 'left' or 'right'")
+
+        length = self.samples_per_record if self.valid_samples is None else self.valid_samples[np.maximum(record, 0)]
+        offset = np.clip(offset, 0, length).astype(np.int64)
+        index = np.where(record < 0, 0, self.record_start(np.maximum(record, 0)) + offset)
+        return index[()] if index.ndim == 0 else index
+
+    def slice(self, t0, t1):
+        # Slice of the samples recorded in the half-open interval [t0, t1) (µs)
+        return slice(int(self.time_to_sample(t0)), int(self.time_to_sample(t1)))
+
+    def times(self, start=0, stop=None, dtype=np.float64):
+        # Materialise the times (µs) of samples start:stop
+        stop = len(self) if stop is None else stop
+        return self.sample_to_time(np.arange(start, stop)).astype(dtype)
+
+
+SCALED_CHUNK_SAMPLES = 1 << 20  # Samples scaled at a time by the chunked ScaledArray reductions
+
+
+class ScaledArray(object):
+    # Compact array-like holding raw int16 ADC counts together with the factor that converts them to `units`. Scaling
+    # is only applied to what is read, so these stay compact:
+    #   indexing and slicing, which scale only the selected samples;
+    #   sum, mean, std, var, min and max, as methods or through np.sum, np.mean, etc., which reduce the raw counts
+    #   (chunk by chunk for std and var over the whole array) and scale the result;
+    #   reshape, which returns another ScaledArray;
+    #   degpy.terminal.terminal.chunked_welch, and so the Terminal PSDs and band powers, which scale a chunk at a time.
+    # Anything else, such as np.asarray, astype or any other numpy function, scales a full copy of the samples.
+
+    def __init__(self, raw, scale, units, dtype=np.float64):
+        self.raw = raw
+        self.scale = np.float64(scale)
+        self.units = units
+        self.dtype = np.dtype(dtype)
+
+    def __repr__(self):
+        return 'ScaledArray(shape={}, scale={!r}, units={!r}, dtype={})'.format(self.shape, self.scale, self.units,
+                                                                                self.dtype)
+
+    def __len__(self):
+        return len(self.raw)
+
+    @property
+    def shape(self):
+        return self.raw.shape
+
+    @property
+    def ndim(self):
+        return self.raw.ndim
+
+    @property
+    def size(self):
+        return self.raw.size
+
+    @property
+    def nbytes(self):
+        return self.raw.nbytes
+
+    def _scaled(self, raw, dtype=None):
+        dtype = self.dtype if dtype is None else np.dtype(dtype)
+        return np.asarray(raw).astype(dtype) * dtype.type(self.scale)
+
+    def __getitem__(self, key):
+        value = self._scaled(self.raw[key])
+        return value[()] if value.ndim == 0 else value
+
+    def __array__(self, dtype=None, copy=None):
+        # Scaling always allocates a new array, so a copy cannot be avoided
+        if copy is False:
+            raise ValueError('ScaledArray cannot be converted to an array without scaling a copy of the samples')
+        return self._scaled(self.raw, dtype)
+
+    def astype(self, dtype):
+        return self._scaled(self.raw, dtype)
+
+    def reshape(self, *shape):
+        return ScaledArray(self.raw.reshape(*shape), self.scale, self.units, self.dtype)
+
+    def __array_function__(self, func, types, args, kwargs):
+        # Reductions of a ScaledArray go to the compact methods; any other numpy function gets the scaled samples
+        method = _SCALED_REDUCTIONS.get(func)
+        if method is not None and args and args[0] is self:
+            return getattr(self, method)(*args[1:], **kwargs)
+        return func(*_unscaled(args), **_unscaled(kwargs))
+
+    def sum(self, axis=None, dtype=None, out=None, **kwargs):
+        return self._reduced(self.raw.sum(axis=axis, dtype=np.float64, **kwargs) * self.scale, dtype, out)
+
+    def mean(self, axis=None, dtype=None, out=None, **kwargs):
+        return self._reduced(self.raw.mean(axis=axis, dtype=np.float64, **kwargs) * self.scale, dtype, out)
+
+    def std(self, axis=None, dtype=None, out=None, ddof=0, **kwargs):
+        std = np.sqrt(self._raw_var(axis, ddof, **kwargs)) * abs(self.scale)
+        return self._reduced(std, dtype, out)
+
+    def var(self, axis=None, dtype=None, out=None, ddof=0, **kwargs):
+        var = self._raw_var(axis, ddof, **kwargs) * self.scale ** 2
+        return self._reduced(var, dtype, out)
+
+    def _raw_var(self, axis, ddof, **kwargs):
+        # Variance of the raw counts. ndarray.var upcasts every sample to take the deviations from the mean, so over
+        # the whole array they are summed SCALED_CHUNK_SAMPLES at a time instead.
+        if axis is not None or kwargs:
+            return self.raw.var(axis=axis, dtype=np.float64, ddof=ddof, **kwargs)
+        raw = self.raw.reshape(-1)
+        mean = raw.mean(dtype=np.float64)
+        total = 0.
+        for start in range(0, len(raw), SCALED_CHUNK_SAMPLES):
+            deviation = raw[start:start + SCALED_CHUNK_SAMPLES] - mean
+            total += np.dot(deviation, deviation)
+        count = len(raw) - ddof
+        return np.float64(total / count) if count > 0 else np.float64(np.nan)
 
+    def min(self, axis=None, out=None, **kwargs):
+        raw = self.raw.min(axis=axis, **kwargs) if self.scale >= 0 else self.raw.max(axis=axis, **kwargs)
+        return self._reduced(self._scaled(raw), None, out)
+
+    def max(self, axis=None, out=None, **kwargs):
+        raw = self.raw.max(axis=axis, **kwargs) if self.scale >= 0 else self.raw.min(axis=axis, **kwargs)
+        return self._reduced(self._scaled(raw), None, out)
+
+    def _reduced(self, value, dtype, out):
+        value = np.asarray(value, dtype=self.dtype if dtype is None else dtype)
+        if out is not None:
+            out[...] = value
+            return out
+        return value[()] if value.ndim == 0 else value
+
+
+_SCALED_REDUCTIONS = {np.sum: 'sum', np.mean: 'mean', np.std: 'std', np.var: 'var', np.amin: 'min', np.amax: 'max',
+                      np.min: 'min', np.max: 'max'}
+
+
+def _unscaled(value):
+    # Arguments of a numpy function with every ScaledArray replaced by its scaled samples
+    if isinstance(value, ScaledArray):
+        return np.asarray(value)
+    if isinstance(value, (list, tuple)):
+        return type(value)(_unscaled(v) for v in value)
+    if isinstance(value, dict):
+        return dict((k, _unscaled(v)) for k, v in value.items())
+    return value
+
+
+@instrumented('scale_samples')
+def scale_samples(samples, header, rescale_data=True, signal_scaling=MICROVOLT_SCALING, dtype=np.float64, raw=False):
+    # Convert int16 samples to signal units using the ADBitVolts value in the header. dtype selects the floating point
+    # type of the result; with raw=True the samples are left as int16 and wrapped in a ScaledArray instead. Returns
+    # (data, data units).
+    if not rescale_data:
+        return samples, 'ADC counts'
+
+    try:
+        # ADBitVolts specifies the conversion factor between the ADC counts and volts
+        scale = np.float64(header['ADBitVolts']) * signal_scaling[0]
+    except KeyError:
+        warnings.warn('Unable to rescale data, no ADBitVolts value specified in header')
+        return samples, 'ADC counts'
+
+    if raw:
+        return ScaledArray(samples, scale, signal_scaling[1], dtype), signal_scaling[1]
+
+    dtype = np.dtype(dtype)
+    return samples.astype(dtype) * dtype.type(scale), signal_scaling[1]
+
+
+def map_records(file_path, record_dtype):
+    # Memory-map the records of the given file without reading them. Trailing bytes that do not make up a whole record
+    # are ignored.
+    record_count = int(estimate_record_count(file_path, record_dtype))
+    if record_count == 0:
+        return np.zeros(0, record_dtype)
+
+    return np.memmap(file_path, dtype=record_dtype, mode='r', offset=HEADER_LENGTH, shape=(record_count,))
+
+
+class NcsSamples(object):
+    # Lazy, sliceable view of the samples in a memory-mapped .ncs file. Indexing reads only the records spanned by the
+    # requested samples, so only the pages that are touched are ever loaded from disk.
+
+    def __init__(self, records, scale=None, dtype=np.float64):
+        self._records = records
+        self.scale = scale
+        self.dtype = np.dtype(dtype) if scale is not None else np.dtype(np.int16)
+        self.sampling_rate = records['SampleFreq'][0] if len(records) > 0 else 0
+
+    def __len__(self):
+        return len(self._records) * NCS_SAMPLES_PER_RECORD
+
+    @property
+    def shape(self):
+        return (len(self),)
+
+    @property
+    def ndim(self):
+        return 1
+
+    def __array__(self, dtype=None, copy=None):
+        # Samples are always read into a new array, which satisfies copy=True; they cannot be exposed without a copy
+        if copy is False:
+            raise ValueError('NcsSamples cannot be converted to an array without copying the samples')
+        return self[:].astype(self.dtype if dtype is None else dtype, copy=False)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            index = int(key)
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError('sample index {} out of range'.format(key))
+            return self[index:index + 1][0]
+        if not isinstance(key, slice):
+            raise TypeError('NcsSamples can only be indexed with integers or slices')
+
+        start, stop, step = key.indices(len(self))
+        if step == 1:
+            return self._read(start, stop)
+
+        indices = np.arange(start, stop, step)
+        if len(indices) == 0:
+            return self._read(0, 0)
+        low = indices.min()
+        return self._read(low, indices.max() + 1)[indices - low]
+
+    def _read(self, start, stop):
+        # Read samples start:stop from the records spanning them
+        stop = max(start, stop)
+        first = start // NCS_SAMPLES_PER_RECORD
+        last = -(-stop // NCS_SAMPLES_PER_RECORD)
+        data = self._records['Samples'][first:last].reshape(-1)
+        data = data[start - first * NCS_SAMPLES_PER_RECORD:stop - first * NCS_SAMPLES_PER_RECORD]
+        if self.scale is None:
+            return np.array(data)
+        return data.astype(self.dtype) * self.dtype.type(self.scale)
+
+    def time_to_sample(self, time):
+        # Index of the first sample recorded at or after the given time (µs). Only the handful of records visited by
+        # the binary search over record timestamps are read.
+        timestamps = self._records['TimeStamp']
+        record = bisect.bisect_right(timestamps, time) - 1
+        if record < 0:
+            return 0
+        offset = int(np.ceil((time - float(timestamps[record])) * self.sampling_rate / 1e6))
+
+        return record * NCS_SAMPLES_PER_RECORD + min(max(offset, 0), NCS_SAMPLES_PER_RECORD)
+
+    def time_slice(self, t0, t1):
+        # Samples recorded in the half-open microsecond interval [t0, t1)
+        return self._read(self.time_to_sample(t0), self.time_to_sample(t1))
+
+
+class NcsFile(object):
+    # Memory-mapped Neuralynx .ncs file. Only the 16 kB header is read up front; records and samples are read from
+    # disk as they are accessed.
+
+    def __init__(self, file_path, rescale_data=True, signal_scaling=MICROVOLT_SCALING, dtype=np.float64):
+        self.file_path = os.path.abspath(file_path)
+        with open(self.file_path, 'rb') as fid:
+            self.raw_header = read_header(fid)
+
+        self.header = parse_header(self.raw_header)
+        self.records = map_records(self.file_path, NCS_RECORD)
+
+        scale = None
+        if rescale_data:
+            try:
+                # ADBitVolts specifies the conversion factor between the ADC counts and volts
+                scale = np.float64(self.header['ADBitVolts']) * signal_scaling[0]
+            except KeyError:
+                warnings.warn('Unable to rescale data, no ADBitVolts value specified in header')
+
+        self.samples = NcsSamples(self.records, scale, dtype)
+        self.data_units = signal_scaling[1] if scale is not None else 'ADC counts'
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def sampling_rate(self):
+        return self.records['SampleFreq'][0]
+
+    @property
+    def channel_number(self):
+        return self.records['ChannelNumber'][0]
+
+    @property
+    def timestamp(self):
+        # Record start times (µs) as a strided view into the mapped file
+        return self.records['TimeStamp']
+
+    def close(self):
+        mmap = getattr(self.records, '_mmap', None)
+        self.records = np.zeros(0, NCS_RECORD)
+        self.samples = NcsSamples(self.records, self.samples.scale, self.samples.dtype)
+        if mmap is not None:
+            mmap.close()
+
+
+@instrumented('read_ncs')
+def read_ncs(file_path, cache=None, decimate=None, target_rate=None, numtaps=None):
+    # Read the header, flattened int16 samples and record timestamps of an .ncs file. If a cache is given (or set with
+    # set_cache_dir) the samples and timestamps are memory-mapped from the file's cache entry, which is created first
+    # if needed. The records are validated in the same pass, and the RecordValidation (kept in the cache entry) is
+    # returned so later steps need not scan the records again. decimate (or target_rate, in Hz) low-pass filters and
+    # downsamples the samples as the records are streamed (see Decimator); the decimated samples are float32 ADC counts
+    # and are cached separately from the full rate ones.
+    # Returns (raw_header, header, samples, timestamps, sampling_rate, channel_number, validation).
+    from .cache import get_cache
 
-def load_ncs(file_path, load_time=True, rescale_data=True, signal_scaling=MICROVOLT_SCALING):
-    # Load the given file as a Neuralynx .ncs continuous acquisition file and extract the contents
     file_path = os.path.abspath(file_path)
+    q = 1
+    if decimate is not None or target_rate is not None:
+        q = decimation_factor(_ncs_sampling_rate(file_path), decimate, target_rate)
+
+    cache = get_cache(cache)
+    if cache is not None:
+        entry = cache.load(file_path, q, numtaps)
+        return (entry['raw_header'], entry['header'], entry['samples'], entry['timestamp'],
+                entry['sampling_rate'], entry['channel_number'], entry.get('validation'))
+
+    if q > 1:
+        with open(file_path, 'rb') as fid:
+            raw_header = read_header(fid)
+        records = map_records(file_path, NCS_RECORD)
+        samples = np.zeros(len(records) * NCS_SAMPLES_PER_RECORD // q, np.float32)
+        timestamps = np.zeros(len(records), np.uint64)
+        validation = decimate_ncs_records(records, q, samples, timestamps, numtaps)
+        validation.warn()
+        sampling_rate = records['SampleFreq'][0] / q if len(records) else 0
+        channel_number = records['ChannelNumber'][0] if len(records) else None
+
+        return raw_header, parse_header(raw_header), samples, timestamps, sampling_rate, channel_number, validation
+
     with open(file_path, 'rb') as fid:
         raw_header = read_header(fid)
         records = read_records(fid, NCS_RECORD)
 
     header = parse_header(raw_header)
-    check_ncs_records(records)
+    validation = validate_ncs_records(records)
+    validation.warn()
 
-    # Reshape (and rescale, if requested) the data into a 1D array
-    data = records['Samples'].ravel()
-    #data = records['Samples'].reshape((NCS_SAMPLES_PER_RECORD * len(records), 1))
-    if rescale_data:
-        try:
-            # ADBitVolts specifies the conversion factor between the ADC counts and volts
-            data = data.astype(np.float64) * (np.float64(header['ADBitVolts']) * signal_scaling[0])
-        except KeyError:
-            warnings.warn('Unable to rescale data, no ADBitVolts value specified in header')
-            rescale_data = False
+    # Reshape the data into a 1D array
+    samples = records['Samples'].ravel()
+    timestamps = records['TimeStamp'].copy()
+
+    return (raw_header, header, samples, timestamps, records['SampleFreq'][0], records['ChannelNumber'][0],
+            validation)
+
+
+def _ncs_sampling_rate(file_path):
+    # Sampling rate of an .ncs file from its first record, or its header if it has no records
+    records = map_records(file_path, NCS_RECORD)
+    if len(records):
+        return float(records['SampleFreq'][0])
+    with open(file_path, 'rb') as fid:
+        return float(parse_header(read_header(fid)).get('SamplingFrequency', 0))
+
+
+def _check_invalid_samples(invalid_samples):
+    if invalid_samples not in ('keep', 'mask', 'drop'):
+        raise ValueError("invalid_samples must be 'keep', 'mask' or 'drop'")
+
+
+def ncs_time_index(timestamp, sampling_rate, validation=None, invalid_samples='keep'):
+    # TimeIndex of .ncs samples, reusing the gaps and valid sample counts found by validation. With
+    # invalid_samples='drop' it indexes the compacted samples (see RecordValidation.compact).
+    _check_invalid_samples(invalid_samples)
+    if validation is None:
+        return TimeIndex(timestamp, sampling_rate)
+
+    compact = invalid_samples == 'drop'
+    return TimeIndex(timestamp, sampling_rate, samples_per_record=validation.samples_per_record,
+                     gaps=validation.segment_starts(compact),
+                     valid_samples=validation.valid_samples if compact else None)
+
+
+@instrumented('load_ncs')
+def load_ncs(file_path, load_time=True, rescale_data=True, signal_scaling=MICROVOLT_SCALING, mmap=False, cache=None,
+             dtype=np.float64, raw=False, invalid_samples='keep', decimate=None, target_rate=None):
+    # Load the given file as a Neuralynx .ncs continuous acquisition file and extract the contents. With mmap=True the
+    # records are memory-mapped rather than read, and 'data' is a lazy NcsSamples view that is sliced on demand.
+    # cache selects an on-disk NcsCache (see degpy.neuralynx_io.cache); None uses the one set with set_cache_dir.
+    # dtype is the floating point type of the rescaled data; raw=True keeps the int16 samples in a ScaledArray.
+    # 'time_index' is a TimeIndex that maps between samples and times without materialising them; set load_time=False
+    # to skip building the per-sample 'time' array. 'validation' is the RecordValidation of the records. Padding in
+    # records with fewer than 512 valid samples is kept by default; invalid_samples='mask' adds a boolean
+    # 'valid_mask' of the samples and 'drop' removes the padding from 'data' and the time base. decimate (an integer
+    # factor dividing 512) or target_rate (Hz) downsample the data with an anti-alias filter as it is read, and
+    # sampling_rate, time_index and time describe the decimated samples.
+    file_path = os.path.abspath(file_path)
+    if mmap:
+        if decimate is not None or target_rate is not None:
+            raise ValueError('Decimation is not supported with mmap=True')
+        ncs_file = NcsFile(file_path, rescale_data=rescale_data, signal_scaling=signal_scaling, dtype=dtype)
+
+        ncs = dict()
+        ncs['file_path'] = file_path
+        ncs['raw_header'] = ncs_file.raw_header
+        ncs['header'] = ncs_file.header
+        ncs['data'] = ncs_file.samples
+        ncs['data_units'] = ncs_file.data_units
+        ncs['sampling_rate'] = ncs_file.sampling_rate
+        ncs['channel_number'] = ncs_file.channel_number
+        ncs['timestamp'] = ncs_file.timestamp
+        ncs['ncs_file'] = ncs_file
+
+        return ncs
+
+    _check_invalid_samples(invalid_samples)
+    raw_header, header, samples, timestamp, sampling_rate, channel_number, validation = read_ncs(
+        file_path, cache, decimate, target_rate)
+    time_index = ncs_time_index(timestamp, sampling_rate, validation, invalid_samples)
+    if invalid_samples == 'drop':
+        samples = validation.compact(samples)
+
+    # Rescale the data, if requested
+    data, data_units = scale_samples(samples, header, rescale_data, signal_scaling, dtype, raw)
 
     # Pack the extracted data in a dictionary that is passed out of the function
     ncs = dict()
@@ -221,21 +1006,114 @@ def load_ncs(file_path, load_time=True, rescale_data=True, signal_scaling=MICROV
     ncs['raw_header'] = raw_header
     ncs['header'] = header
     ncs['data'] = data
-    ncs['data_units'] = signal_scaling[1] if rescale_data else 'ADC counts'
-    ncs['sampling_rate'] = records['SampleFreq'][0]
-    ncs['channel_number'] = records['ChannelNumber'][0]
-    ncs['timestamp'] = records['TimeStamp']
+    ncs['data_units'] = data_units
+    ncs['sampling_rate'] = sampling_rate
+    ncs['channel_number'] = channel_number
+    ncs['timestamp'] = timestamp
+    ncs['validation'] = validation
+    if invalid_samples == 'mask':
+        ncs['valid_mask'] = validation.sample_mask()
+
+    ncs['time_index'] = time_index
 
     # Calculate the sample time points (if needed)
     if load_time:
-        num_samples = data.shape[0]
-        times = np.interp(np.arange(num_samples), np.arange(0, num_samples, 512), records['TimeStamp']).astype(np.uint64)
-        ncs['time'] = times
+        ncs['time'] = ncs['time_index'].times(dtype=np.uint64)
         ncs['time_units'] = u'µs'
 
     return ncs
 
 
+def iter_ncs_chunks(file_path, chunk_records=1024, overlap=0, rescale_data=True, signal_scaling=MICROVOLT_SCALING,
+                    dtype=np.float64, invalid_samples='keep', decimate=None, target_rate=None, numtaps=None):
+    # Stream the given .ncs file in blocks of chunk_records records, yielding (data, timestamps) pairs. data holds the
+    # rescaled samples of the block, preceded by the last `overlap` samples of the previous block (fewer for the first
+    # block), and timestamps holds the start times of the records read for this block. invalid_samples='drop' leaves
+    # out the padding of partial records, and decimate (or target_rate) decimates the samples as load_ncs does, with the
+    # filter carried from block to block. Decimated samples lag the records read by the filter delay, so a last block
+    # without records holds the rest. Both arrays are views into fixed-size buffers that are reused between blocks, so
+    # copy them if they need to outlive the iteration.
+    if overlap < 0:
+        raise ValueError('overlap must be non-negative')
+    _check_invalid_samples(invalid_samples)
+
+    file_path = os.path.abspath(file_path)
+    q = 1
+    if decimate is not None or target_rate is not None:
+        q = decimation_factor(_ncs_sampling_rate(file_path), decimate, target_rate)
+    chunk_samples = chunk_records * NCS_SAMPLES_PER_RECORD // q
+    if overlap > chunk_samples:
+        raise ValueError('overlap cannot exceed the number of samples in a chunk')
+
+    compact = invalid_samples == 'drop'
+    decimator = _RecordDecimator(q, numtaps, compact) if q > 1 else None
+    validator = RecordValidator() if decimator is not None else None
+    if decimator is not None:
+        chunk_samples += decimator.decimator.delay // q
+
+    with open(file_path, 'rb') as fid:
+        header = parse_header(read_header(fid))
+        scale = 1
+        if rescale_data:
+            try:
+                # ADBitVolts specifies the conversion factor between the ADC counts and volts
+                scale = np.float64(header['ADBitVolts']) * signal_scaling[0]
+            except KeyError:
+                warnings.warn('Unable to rescale data, no ADBitVolts value specified in header')
+
+        records = np.zeros(chunk_records, NCS_RECORD)
+        timestamps = np.zeros(chunk_records, np.uint64)
+        data = np.zeros(overlap + chunk_samples, dtype)
+        record_bytes = memoryview(records.view(np.uint8))
+        offsets = np.arange(NCS_SAMPLES_PER_RECORD)
+
+        def blocks():
+            # (samples, record count) of each block, in ADC counts
+            fid.seek(HEADER_LENGTH)
+            while True:
+                count = fid.readinto(record_bytes) // NCS_RECORD.itemsize
+                if count == 0:
+                    break
+                chunk = records[:count]
+                timestamps[:count] = chunk['TimeStamp']
+                if decimator is not None:
+                    yield decimator.feed(chunk, validator.feed(chunk)), count
+                elif compact:
+                    yield chunk['Samples'][offsets < chunk['NumValidSamples'][:, None]], count
+                else:
+                    yield chunk['Samples'].reshape(-1), count
+                if count < chunk_records:
+                    break
+            if decimator is not None:
+                rest = decimator.flush()
+                if len(rest):
+                    yield rest, 0
+
+        carried = 0
+        end = 0
+        for samples, count in blocks():
+            # Move the tail of the previous block to the front of the buffer to provide the overlap
+            if carried:
+                data[:carried] = data[end - carried:end]
+            end = carried + len(samples)
+            np.multiply(samples, scale, out=data[carried:end], casting='unsafe')
+
+            yield data[:end], timestamps[:count]
+
+            carried = min(overlap, end)
+
+
+def decode_event_strings(event_strings):
+    # Decode an array of null padded event strings in one vectorized cast. Strings that are not plain ASCII fall back to
+    # element-wise UTF-8 decoding.
+    event_strings = np.asarray(event_strings)
+    try:
+        return event_strings.astype(str)
+    except UnicodeDecodeError:
+        return np.char.decode(event_strings, 'utf8', 'replace')
+
+
+@instrumented('load_nev')
 def load_nev(file_path):
     # Load the given file as a Neuralynx .nev event file and extract the contents
     file_path = os.path.abspath(file_path)
@@ -256,39 +1134,78 @@ def load_nev(file_path):
     nev['header'] = header
     nev['records'] = records
     nev['events'] = records[['pkt_id', 'TimeStamp', 'event_id', 'ttl', 'Extra', 'EventString']]
+    nev['event_strings'] = decode_event_strings(records['EventString'])
 
     return nev
 
-def load_nse(file_path, load_time=True, rescale_data=True, signal_scaling=MICROVOLT_SCALING):
-    # Load the given file as a Neuralynx .ncs continuous acquisition file and extract the contents
+@instrumented('load_spikes')
+def load_spikes(file_path, record_dtype, mmap=True):
+    # Load the given file as a Neuralynx spike file (.nse, .nst or .ntt, depending on record_dtype) and extract the
+    # contents. The records are memory-mapped (or read, with mmap=False) and every field is returned as a zero-copy
+    # view, so waveforms stay int16 on disk layout: 'waveforms' has shape (spikes, 32, channels). 'ad_bit_volts' holds
+    # the per-channel conversion from ADC counts to volts, if the header specifies it.
     file_path = os.path.abspath(file_path)
     with open(file_path, 'rb') as fid:
         raw_header = read_header(fid)
-        records = read_records(fid, NSE_RECORD)
+        records = None if mmap else read_records(fid, record_dtype)
 
     header = parse_header(raw_header)
-    # check_ncs_records(records)
+    if mmap:
+        records = map_records(file_path, record_dtype)
 
-    # Reshape (and rescale, if requested) the data into a 1D array
-    data = records['Samples'].ravel()
-    #data = records['Samples'].reshape((NCS_SAMPLES_PER_RECORD * len(records), 1))
-    if rescale_data:
-        try:
-            # ADBitVolts specifies the conversion factor between the ADC counts and volts
-            data = data.astype(np.float64) * (np.float64(header['ADBitVolts']) * signal_scaling[0])
-        except KeyError:
-            warnings.warn('Unable to rescale data, no ADBitVolts value specified in header')
-            rescale_data = False
+    try:
+        ad_bit_volts = np.array(header['ADBitVolts'].split(), dtype=np.float64)
+    except (KeyError, ValueError):
+        ad_bit_volts = None
 
     # Pack the extracted data in a dictionary that is passed out of the function
-    nse = dict()
-    nse['file_path'] = file_path
-    nse['raw_header'] = raw_header
-    nse['header'] = header
-    nse['data'] = data
-    nse['data_units'] = signal_scaling[1] if rescale_data else 'ADC counts'
-    nse['sampling_rate'] = records['SampleFreq'][0]
-    nse['channel_number'] = records['ChannelNumber'][0]
-    nse['timestamp'] = records['TimeStamp']
-
-    return nse
\ No newline at end of file
+    spikes = dict()
+    spikes['file_path'] = file_path
+    spikes['raw_header'] = raw_header
+    spikes['header'] = header
+    spikes['records'] = records
+    spikes['timestamp'] = records['TimeStamp']
+    spikes['sc_number'] = records['ScNumber']
+    spikes['cell_number'] = records['CellNumber']
+    spikes['params'] = records['Params']
+    spikes['waveforms'] = records['Data']
+    spikes['ad_bit_volts'] = ad_bit_volts
+    spikes['data_units'] = 'ADC counts'
+
+    return spikes
+
+
+def load_nse(file_path, mmap=True):
+    # Load the given file as a Neuralynx .nse single electrode spike file, see load_spikes
+    return load_spikes(file_path, NSE_RECORD, mmap)
+
+
+def load_nst(file_path, mmap=True):
+    # Load the given file as a Neuralynx .nst stereotrode spike file, see load_spikes
+    return load_spikes(file_path, NST_RECORD, mmap)
+
+
+def load_ntt(file_path, mmap=True):
+    # Load the given file as a Neuralynx .ntt tetrode spike file, see load_spikes
+    return load_spikes(file_path, NTT_RECORD, mmap)
+
+
+def select_spikes(spikes, cell_numbers=None, t0=None, t1=None):
+    # Select the spikes of the given classified cells within the half-open microsecond interval [t0, t1) from the
+    # output of load_spikes. The time range is found by binary search (spike files are written in time order) and is a
+    # zero-copy slice; filtering by cell number gathers only the selected spikes. 'index' holds the selected positions.
+    timestamps = spikes['timestamp']
+    start = 0 if t0 is None else int(np.searchsorted(timestamps, t0, side='left'))
+    stop = len(timestamps) if t1 is None else int(np.searchsorted(timestamps, t1, side='left'))
+    index = slice(start, max(start, stop))
+
+    if cell_numbers is not None:
+        mask = np.isin(spikes['cell_number'][index], np.atleast_1d(cell_numbers))
+        index = np.flatnonzero(mask) + start
+
+    selected = dict(spikes)
+    for key in ('records', 'timestamp', 'sc_number', 'cell_number', 'params', 'waveforms'):
+        selected[key] = spikes[key][index]
+    selected['index'] = np.arange(index.start, index.stop) if isinstance(index, slice) else index
+
+    return selected
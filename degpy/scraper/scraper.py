@@ -14,9 +14,156 @@ TODO:
 """
 
 import os
+import sys
+import glob
+import time
 import shutil
+import hashlib
+import warnings
+import traceback
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
+from degpy import instrument
 from degpy.session import Session
+from degpy.catalog import Catalog
+
+
+# Outcome of running a function over one session. error holds the formatted
+# traceback if the session failed, and result is None. stats holds the
+# session's instrumentation totals when they were requested.
+SessionResult = namedtuple('SessionResult', ['session_path', 'result', 'error', 'stats'])
+SessionResult.__new__.__defaults__ = (None,)
+
+
+def load_lfp(session):
+    """
+    Default per-session function for Scraper.get_lfp_data: loads every LFP
+    channel of the session into a (channels x samples) array
+    """
+    return session.load_channels("LFP*.ncs")
+
+
+def _run_session(func, session_path, stats=False):
+    # Runs in a worker process; failures are returned rather than raised so
+    # that one bad session does not stop the batch
+    if stats:
+        instrument.enable(memory=stats == 'memory')
+    session = None
+    try:
+        session = Session(session_path)
+        return SessionResult(session_path, func(session), None, session.stats() if stats else None)
+    except Exception:
+        return SessionResult(session_path, None, traceback.format_exc(),
+                             session.stats() if stats and session is not None else None)
+    finally:
+        if stats:
+            instrument.disable()
+
+
+# Outcome of copying one file in Scraper.move_files. status is 'copied',
+# 'skipped' (destination already up to date) or 'failed', with the
+# formatted exception in error.
+FileTransfer = namedtuple('FileTransfer', ['src', 'dst', 'status', 'bytes', 'error'])
+
+# Totals of a Scraper.move_files run. throughput is bytes copied per second.
+TransferReport = namedtuple('TransferReport', ['copied', 'skipped', 'failed', 'bytes_copied', 'seconds',
+                                               'throughput', 'failures'])
+
+MTIME_TOLERANCE = 2.  # Seconds; FAT/exFAT drives store modification times to 2 s
+CHECKSUM_CHUNK = 16 * 1024 * 1024
+
+
+def _file_checksum(path, size=None):
+    # SHA-1 of the file, or of its first size bytes
+    digest = hashlib.sha1()
+    remaining = float('inf') if size is None else size
+    with open(path, 'rb') as fid:
+        while remaining > 0:
+            chunk = fid.read(int(min(CHECKSUM_CHUNK, remaining)))
+            if not chunk:
+                break
+            digest.update(chunk)
+            remaining -= len(chunk)
+    return digest.hexdigest()
+
+
+def _up_to_date(src, dst, checksum=False):
+    # Whether dst already holds a copy of src: same size and modification time, or same content with checksum=True
+    try:
+        dst_stat = os.stat(dst)
+    except OSError:
+        return False
+    src_stat = os.stat(src)
+    if src_stat.st_size != dst_stat.st_size:
+        return False
+    if checksum:
+        return _file_checksum(src) == _file_checksum(dst)
+    return abs(src_stat.st_mtime - dst_stat.st_mtime) <= MTIME_TOLERANCE
+
+
+def _resume_offset(src, part, checksum=False):
+    # Bytes of src already in the '.part' file of an interrupted copy, or 0 to start over. The part is only resumed if
+    # it is no longer than src and was written after src was last modified, and with checksum=True if its content
+    # matches the start of src.
+    try:
+        part_stat = os.stat(part)
+    except OSError:
+        return 0
+    src_stat = os.stat(src)
+    if part_stat.st_size > src_stat.st_size or part_stat.st_mtime < src_stat.st_mtime:
+        return 0
+    if checksum and _file_checksum(part) != _file_checksum(src, part_stat.st_size):
+        return 0
+    return part_stat.st_size
+
+
+@instrument.instrumented('Scraper._transfer_file', bytes_read=lambda outcome, *args: outcome.bytes)
+def _transfer_file(src, dst, checksum=False):
+    # Copy src to dst unless dst is up to date. The copy is written to '<dst>.part' and renamed into place once
+    # complete, so an interrupted run never leaves a truncated dst. The next run resumes the '.part' file from where the
+    # copy stopped (see _resume_offset) or overwrites it, so partial copies never pile up. The '.part' file of a copy
+    # that fails is removed, as are uniquely named '<dst>.*.part' files left by older versions of move_files.
+    part = dst + '.part'
+    try:
+        for stale in glob.glob(glob.escape(dst) + '.*.part'):
+            os.remove(stale)
+        if _up_to_date(src, dst, checksum):
+            if os.path.exists(part):
+                os.remove(part)
+            return FileTransfer(src, dst, 'skipped', 0, None)
+
+        offset = _resume_offset(src, part, checksum)
+        with open(src, 'rb') as fsrc, open(part, 'r+b' if offset else 'wb') as fdst:
+            fsrc.seek(offset)
+            fdst.seek(offset)
+            fdst.truncate()
+            shutil.copyfileobj(fsrc, fdst, CHECKSUM_CHUNK)
+        shutil.copystat(src, part)
+        os.replace(part, dst)
+        return FileTransfer(src, dst, 'copied', os.path.getsize(dst) - offset, None)
+    except Exception:
+        if os.path.exists(part):
+            os.remove(part)
+        return FileTransfer(src, dst, 'failed', 0, traceback.format_exc())
+
+
+def _flat_name(src, root_path):
+    # Destination name: the directories of the file below '.../data/' joined by underscores, e.g.
+    # 080602_080602_ps01_160614_2016-06-14_09-39-10_LFP1.ncs. Paths without a 'data' directory are named from root_path.
+    flat = src.replace(os.sep, '_')
+    if 'data' in flat:
+        return flat.split('data', 1)[1][1:]
+    return os.path.relpath(src, root_path).replace(os.sep, '_')
+
+
+def _print_transfer(done, total, outcome):
+    print('[{}/{}] {} {}'.format(done, total, outcome.src, outcome.status), file=sys.stderr)
+
+
+def _print_progress(done, total, outcome):
+    status = 'ok' if outcome.error is None else 'FAILED'
+    print('[{}/{}] {} {}'.format(done, total, outcome.session_path, status), file=sys.stderr)
 
 
 class Scraper:
@@ -42,38 +189,168 @@ class Scraper:
         return data_files, (data_size / 1e9)
 
     @staticmethod
-    def get_lfp_data(path):
+    def build_catalog(path, db_path):
         """
-        Utility to crawl LFP datafiles
+        Utility to index the headers of every data file under path into a
+        SQLite catalog. Rescans only re-read files that changed.
 
-        :param path:
-        :return: tuple, (list of filepaths, total size of files in bytes)
+        :param path: str, root data directory
+        :param db_path: str, path to the SQLite database
+        :return: Catalog
+        """
+        catalog = Catalog(db_path)
+        catalog.scan(path)
+        return catalog
+
+    @staticmethod
+    def find_sessions(path):
+        """
+        Utility to find recording directories (e.g. 2016-06-14_09-39-10)
+
+        :param path: str, root data directory
+        :return: list of session directory paths
+        """
+        return sorted(root for root, dirs, files in os.walk(path) if '-' in os.path.basename(root))
+
+    @staticmethod
+    def iter_lfp_data(path, func=load_lfp, workers=None, progress=None, stats=False):
+        """
+        Utility to run a function over every recording session under path.
+        Sessions are fanned out to a process pool and results are yielded as
+        they complete, so nothing runs until the generator is iterated.
+        Sessions that raise are reported with a warning and skipped over.
+
+        :param path: str, root data directory
+        :param func: callable, takes a Session and returns a picklable result.
+                     Must be importable by worker processes (module level).
+                     Defaults to loading all LFP channels.
+        :param workers: int, number of worker processes (default: CPU count)
+        :param progress: callable(done, total, SessionResult) called after
+                         each session, or True to print a line to stderr
+        :param stats: bool, instrument each session (see degpy.instrument)
+                      and return its stats, or 'memory' to also measure
+                      peak memory. Combine them with Scraper.merge_stats.
+        :return: generator of SessionResult(session_path, result, error,
+                 stats), in order of completion
         """
+        if progress is True:
+            progress = _print_progress
 
         # Grabbing directories containing data files
-        data_dirs = [x[0] for x in os.walk(path) if '-' in x[0].split('/')[-1]]
+        data_dirs = Scraper.find_sessions(path)
 
-        for dir in data_dirs:
-            sess = Session(dir)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_run_session, func, dir, stats) for dir in data_dirs]
+            try:
+                for done, future in enumerate(as_completed(futures), 1):
+                    outcome = future.result()
+                    if outcome.error is not None:
+                        warnings.warn('Session {} failed: {}'.format(outcome.session_path,
+                                                                    outcome.error.strip().splitlines()[-1]))
+                    if progress:
+                        progress(done, len(futures), outcome)
+                    yield outcome
+            finally:
+                # If iteration stops early, drop the sessions not started yet instead of waiting for them
+                for future in futures:
+                    future.cancel()
 
+    @staticmethod
+    def get_lfp_data(path, func=load_lfp, workers=None, progress=None, stats=False):
+        """
+        Utility to run a function over every recording session under path,
+        in parallel worker processes; see iter_lfp_data to handle results
+        as they complete
+
+        :return: list of SessionResult(session_path, result, error, stats),
+                 in session path order
+        """
+        results = Scraper.iter_lfp_data(path, func, workers, progress, stats)
+        return sorted(results, key=lambda outcome: outcome.session_path)
+
+    @staticmethod
+    def merge_stats(results, path=None):
+        """
+        Aggregates the per-session stats of get_lfp_data results
+
+        :param results: iterable of SessionResult
+        :param path: str, optional JSON file the per-session and total
+                     stats are written to
+        :return: dict, stats summed over every session
+        """
+        results = list(results)
+        total = instrument.merge_stats([outcome.stats for outcome in results])
+        if path is not None:
+            instrument.to_json({'sessions': dict((outcome.session_path, outcome.stats) for outcome in results),
+                                'total': total}, path)
+        return total
 
 
     @staticmethod
-    def move_files(root_path, dest_path):
+    def move_files(root_path, dest_path, workers=8, checksum=False, progress=True):
         """
+        Utility to copy every .ncs and .nev file under root_path into
+        dest_path, named after the directories they were in. Files are copied
+        concurrently by a pool of threads. A file is skipped when its
+        destination already has the same size and modification time (or the
+        same content, with checksum=True). Each copy goes to a '<name>.part'
+        file that is renamed into place once complete, so an interrupted
+        run can be rerun: it resumes partly copied files and only copies
+        what is missing. Raises ValueError if two files would get the same
+        destination name.
 
         :param root_path: str, relative path to root data directory
         :param dest_path: str, relative path to destination directory
-        :return: None
+        :param workers: int, number of concurrent copies
+        :param checksum: bool, compare file contents (SHA-1) instead of
+                         modification times to decide what to skip
+        :param progress: bool or callable(done, total, FileTransfer),
+                         progress reporting after each file
+        :return: TransferReport(copied, skipped, failed, bytes_copied,
+                 seconds, throughput, failures)
         """
+        if progress is True:
+            progress = _print_transfer
+        if not os.path.isdir(dest_path):
+            os.makedirs(dest_path)
 
+        transfers = []
         for root, dirs, files in os.walk(root_path):
             for file in files:
                 if 'ncs' in file or 'nev' in file:
                     src = os.path.join(root, file)
+                    transfers.append((src, os.path.join(dest_path, _flat_name(src, root_path))))
+
+        # Sources that flatten to the same name would overwrite each other
+        sources = {}
+        for src, dst in transfers:
+            sources.setdefault(dst, []).append(src)
+        clashes = dict((dst, srcs) for dst, srcs in sources.items() if len(srcs) > 1)
+        if clashes:
+            raise ValueError('Files map to the same destination: {}'.format(
+                '; '.join('{} <- {}'.format(dst, ', '.join(srcs)) for dst, srcs in sorted(clashes.items()))))
+
+        counts = {'copied': 0, 'skipped': 0, 'failed': 0}
+        bytes_copied = 0
+        failures = []
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_transfer_file, src, dst, checksum) for src, dst in transfers]
+            for done, future in enumerate(as_completed(futures), 1):
+                outcome = future.result()
+                counts[outcome.status] += 1
+                bytes_copied += outcome.bytes
+                if outcome.error is not None:
+                    failures.append(outcome)
+                if progress:
+                    progress(done, len(futures), outcome)
+        seconds = time.perf_counter() - start
+
+        report = TransferReport(counts['copied'], counts['skipped'], counts['failed'], bytes_copied, seconds,
+                                bytes_copied / seconds if seconds > 0 else 0., failures)
+        if progress:
+            print('Copied {} files ({:.2f} GB) in {:.1f} s, {:.1f} MB/s; skipped {}, failed {}'.format(
+                report.copied, bytes_copied / 1e9, seconds, report.throughput / 1e6, report.skipped,
+                report.failed), file=sys.stderr)
 
-                    # Formatting filename to be concatenation
-                    # of directories
-                    name = src.replace('/', '_').split('data')[1][1:]
-                    dst = os.path.join(dest_path, name)
-                    shutil.copy(src, dst)
+        return report
@@ -0,0 +1 @@
+from .server import SliceServer, SliceClient, ChunkCache
\ No newline at end of file
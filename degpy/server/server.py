@@ -0,0 +1,421 @@
+"""
+This module contains a read-only localhost server for time-range slices of
+continuous data, and its client
+
+Many processes reading the same sessions share one server, which answers
+from memory-mapped .ncs files through an LRU cache of decoded chunks, so
+each chunk is decoded (and decimated) once however many clients ask for it.
+Requests are served by an asyncio loop and decoding runs in a thread pool,
+so slow requests do not hold up the others.
+
+    python -m degpy.server.server /Volumes/data --port 8765
+
+    with SliceClient(port=8765) as client:
+        lfp = client.slice('080602/080602_ps17_160704/2016-07-04_13-22-47', 'LFP1', t0, t1, decimate=16)
+
+The protocol is JSON lines over TCP: every request is one JSON object
+({'id', 'op', ...}) and every response a JSON object line, followed, for
+slices, by 'nbytes' bytes of little-endian float32 samples. Times are
+Cheetah timestamps (µs).
+"""
+
+import os
+import sys
+import json
+import socket
+import asyncio
+import argparse
+import threading
+from collections import OrderedDict
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from degpy.neuralynx_io import NcsFile, TimeIndex, decimate_ncs_records, decimation_factor
+from degpy.neuralynx_io.neuralynx_io import NCS_SAMPLES_PER_RECORD, MICROVOLT_SCALING
+from degpy.session.session import Session
+
+
+LOOPBACK_HOSTS = ('127.0.0.1', 'localhost', '::1')
+DEFAULT_PORT = 8765
+CHUNK_RECORDS = 256  # Records decoded per cached chunk
+CACHE_BYTES = 256 * 1024 * 1024
+PAYLOAD_DTYPE = np.dtype('<f4')
+
+
+class ChunkCache:
+    """
+    Least recently used cache of decoded chunks, bounded in bytes. Only
+    used from the server's event loop thread.
+    """
+
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._chunks = OrderedDict()
+
+    def __len__(self):
+        return len(self._chunks)
+
+    def get(self, key):
+        chunk = self._chunks.get(key)
+        if chunk is None:
+            self.misses += 1
+            return None
+        self._chunks.move_to_end(key)
+        self.hits += 1
+        return chunk
+
+    def put(self, key, chunk):
+        if key in self._chunks:
+            self.nbytes -= self._chunks.pop(key).nbytes
+        self._chunks[key] = chunk
+        self.nbytes += chunk.nbytes
+        while self.nbytes > self.max_bytes and len(self._chunks) > 1:
+            _, dropped = self._chunks.popitem(last=False)
+            self.nbytes -= dropped.nbytes
+
+    def stats(self):
+        return {'chunks': len(self._chunks), 'cached_bytes': self.nbytes, 'max_bytes': self.max_bytes,
+                'hits': self.hits, 'misses': self.misses}
+
+
+class _Channel:
+    """
+    Memory-mapped .ncs file served by the server, with the time base of
+    each decimation factor requested so far
+    """
+
+    def __init__(self, file_path, signal_scaling):
+        self.file_path = file_path
+        self.ncs_file = NcsFile(file_path, signal_scaling=signal_scaling)
+        self.records = self.ncs_file.records
+        self.scale = self.ncs_file.samples.scale
+        self.data_units = self.ncs_file.data_units
+        self.sampling_rate = float(self.ncs_file.sampling_rate) if len(self.ncs_file) else 0.
+        self._indexes = {}
+
+    def time_index(self, q):
+        if q not in self._indexes:
+            self._indexes[q] = TimeIndex(self.records['TimeStamp'], self.sampling_rate / q,
+                                         samples_per_record=NCS_SAMPLES_PER_RECORD // q)
+        return self._indexes[q]
+
+    def decode(self, chunk, q, chunk_records, numtaps=None):
+        # Samples (float32, data units) of records chunk * chunk_records onwards, decimated by q. Decimation is run over
+        # enough neighbouring records to cover the filter, so chunks match decimating the whole file.
+        first = chunk * chunk_records
+        last = min(first + chunk_records, len(self.records))
+        scale = 1. if self.scale is None else self.scale
+        if q == 1:
+            counts = self.records['Samples'][first:last].reshape(-1)
+            return (counts * np.float32(scale)).astype(np.float32)
+
+        margin = -(-(20 * q if numtaps is None else numtaps) // NCS_SAMPLES_PER_RECORD) + 1
+        lo, hi = max(first - margin, 0), min(last + margin, len(self.records))
+        per_record = NCS_SAMPLES_PER_RECORD // q
+        samples = np.zeros((hi - lo) * per_record, np.float32)
+        decimate_ncs_records(self.records[lo:hi], q, samples, np.zeros(hi - lo, np.uint64), numtaps)
+        samples = samples[(first - lo) * per_record:(last - lo) * per_record]
+        samples *= np.float32(scale)
+        return samples
+
+    def close(self):
+        self.ncs_file.close()
+
+
+class SliceServer:
+    """
+    Read-only asyncio server of time-range slices of the sessions below a
+    root directory. Operations:
+
+        slice   session, channel, t0, t1 (µs, None for either end of the
+                recording), decimate (or target_rate); responds with
+                'shape', 'start_time' (µs of the first sample),
+                'sampling_rate', 'data_units', 'segments' ([sample offset,
+                start time] of each continuous run) and 'nbytes' of samples
+        info    session, channel (optional); the session's data files, or a
+                channel's sampling rate, record count and time range
+        events  session; event strings and timestamps
+        stats   cache statistics
+    """
+
+    def __init__(self, root, host='127.0.0.1', port=DEFAULT_PORT, cache_bytes=CACHE_BYTES,
+                 chunk_records=CHUNK_RECORDS, workers=None, signal_scaling=MICROVOLT_SCALING, numtaps=None):
+        """
+        :param root: str, directory holding the sessions; requests name
+                     sessions by their path relative to it
+        :param host: str, loopback address to listen on
+        :param port: int, port to listen on (0 picks a free one)
+        :param cache_bytes: int, size of the decoded chunk cache
+        :param chunk_records: int, records decoded per cached chunk
+        :param workers: int, decoding threads
+        :param signal_scaling: tuple, (scale factor from volts, units)
+        :param numtaps: int, decimation filter length (see Decimator)
+        """
+        if host not in LOOPBACK_HOSTS:
+            raise ValueError('SliceServer only listens on localhost, got {!r}'.format(host))
+        self.root = os.path.realpath(root)
+        self.host = host
+        self.port = port
+        self.chunk_records = chunk_records
+        self.signal_scaling = signal_scaling
+        self.numtaps = numtaps
+        self.cache = ChunkCache(cache_bytes)
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._sessions = {}
+        self._channels = {}
+        self._indexes = {}
+        self._pending = {}
+        self._server = None
+
+    async def _open(self, opened, key, factory, *args):
+        # Object opened by factory(*args) in the thread pool and kept in opened under key, so that parsing headers and
+        # event files or reading record timestamps never blocks the event loop. Concurrent requests for a key that is
+        # being opened wait for that open instead of starting another.
+        if key in opened:
+            return opened[key]
+        if key not in self._pending:
+            loop = asyncio.get_running_loop()
+            self._pending[key] = loop.run_in_executor(self._pool, factory, *args)
+        try:
+            value = await asyncio.shield(self._pending[key])
+        finally:
+            self._pending.pop(key, None)
+        opened[key] = value
+        return value
+
+    async def _session(self, name):
+        path = os.path.realpath(os.path.join(self.root, name))
+        if os.path.commonpath([self.root, path]) != self.root:
+            raise ValueError("Session '{}' is outside the server root".format(name))
+        return await self._open(self._sessions, path, partial(Session, path, cache_size=0))
+
+    async def _channel(self, session_name, channel):
+        session = await self._session(session_name)
+        file = channel if channel.endswith('.ncs') else channel + '.ncs'
+        if file not in session.data_files:
+            raise FileNotFoundError("'{}' does not exist in session '{}'".format(file, session_name))
+        path = os.path.join(session.session_path, file)
+        return await self._open(self._channels, path, _Channel, path, self.signal_scaling)
+
+    async def _time_index(self, channel, q):
+        # Time base of the channel decimated by q; building it reads every record timestamp
+        return await self._open(self._indexes, (channel.file_path, q), channel.time_index, q)
+
+    async def _chunk(self, channel, chunk, q):
+        # Decoded chunk from the cache, decoding it in the thread pool on a miss. Concurrent requests for a chunk that
+        # is being decoded wait for that decode instead of starting another.
+        key = (channel.file_path, q, chunk)
+        samples = self.cache.get(key)
+        if samples is not None:
+            return samples
+        if key not in self._pending:
+            loop = asyncio.get_running_loop()
+            self._pending[key] = loop.run_in_executor(self._pool, channel.decode, chunk, q, self.chunk_records,
+                                                      self.numtaps)
+        try:
+            samples = await asyncio.shield(self._pending[key])
+        finally:
+            self._pending.pop(key, None)
+        self.cache.put(key, samples)
+        return samples
+
+    async def _slice(self, request):
+        channel = await self._channel(request['session'], request['channel'])
+        q = decimation_factor(channel.sampling_rate, request.get('decimate'), request.get('target_rate'))
+        index = await self._time_index(channel, q)
+        t0, t1 = request.get('t0'), request.get('t1')
+        start = 0 if t0 is None else int(index.time_to_sample(t0))
+        stop = len(index) if t1 is None else int(index.time_to_sample(t1))
+        stop = max(start, stop)
+
+        chunk_samples = self.chunk_records * NCS_SAMPLES_PER_RECORD // q
+        chunks = range(start // chunk_samples, -(-stop // chunk_samples))
+        decoded = await asyncio.gather(*[self._chunk(channel, chunk, q) for chunk in chunks])
+        offset = chunks.start * chunk_samples
+        data = np.concatenate(decoded)[start - offset:stop - offset] if decoded else np.zeros(0, np.float32)
+
+        segments = index.segments()
+        segments = segments[(segments[:, 1] > start) & (segments[:, 0] < stop), 0]
+        offsets = np.maximum(segments, start)
+        header = {
+            'shape': [len(data)],
+            'start_time': float(index.sample_to_time(start)) if start < len(index) else None,
+            'sampling_rate': index.sampling_rate,
+            'data_units': channel.data_units,
+            'segments': [[int(o - start), float(index.sample_to_time(o))] for o in offsets],
+            'nbytes': int(data.size * PAYLOAD_DTYPE.itemsize),
+        }
+        return header, data.astype(PAYLOAD_DTYPE, copy=False).tobytes()
+
+    async def _info(self, request):
+        session = await self._session(request['session'])
+        if request.get('channel') is None:
+            return {'data_files': sorted(session.data_files)}
+        channel = await self._channel(request['session'], request['channel'])
+        index = await self._time_index(channel, 1)
+        timestamps = channel.records['TimeStamp']
+        return {
+            'sampling_rate': channel.sampling_rate,
+            'records': len(channel.records),
+            'samples': len(channel.records) * NCS_SAMPLES_PER_RECORD,
+            'data_units': channel.data_units,
+            'start_time': int(timestamps[0]) if len(timestamps) else None,
+            'stop_time': float(index.sample_to_time(-1)) if len(timestamps) else None,
+        }
+
+    async def _events(self, request):
+        session = await self._session(request['session'])
+        return {'events': list(session.events), 'timestamps': [int(ts) for ts in session.timestamps]}
+
+    async def _respond(self, request):
+        op = request.get('op')
+        if op == 'slice':
+            return await self._slice(request)
+        if op == 'info':
+            return await self._info(request), b''
+        if op == 'events':
+            return await self._events(request), b''
+        if op == 'stats':
+            return self.cache.stats(), b''
+        raise ValueError('Unknown op {!r}'.format(op))
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request = {}
+                try:
+                    request = json.loads(line)
+                    header, payload = await self._respond(request)
+                except Exception as exc:
+                    header, payload = {'error': '{}: {}'.format(type(exc).__name__, exc)}, b''
+                header['id'] = request.get('id') if isinstance(request, dict) else None
+                writer.write(json.dumps(header).encode() + b'\n')
+                writer.write(payload)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        """
+        Starts listening; self.port is the port bound
+        """
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        self._pool.shutdown(wait=True)
+        for channel in self._channels.values():
+            channel.close()
+        self._channels.clear()
+        self._indexes.clear()
+
+    def run(self):
+        """
+        Serves until interrupted
+        """
+        try:
+            asyncio.run(self.serve_forever())
+        except KeyboardInterrupt:
+            pass
+
+
+class SliceClient:
+    """
+    Blocking client of a SliceServer. One connection, shared by threads
+    one request at a time.
+    """
+
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT, timeout=None):
+        self._socket = socket.create_connection((host, port), timeout=timeout)
+        self._file = self._socket.makefile('rb')
+        self._lock = threading.Lock()
+        self._next_id = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+    def _request(self, **request):
+        with self._lock:
+            self._next_id += 1
+            request['id'] = self._next_id
+            self._socket.sendall(json.dumps(request).encode() + b'\n')
+            line = self._file.readline()
+            if not line:
+                raise ConnectionError('SliceServer closed the connection')
+            header = json.loads(line)
+            payload = self._file.read(header.get('nbytes', 0)) if header.get('nbytes') else b''
+        if 'error' in header:
+            raise RuntimeError(header['error'])
+        return header, payload
+
+    def slice(self, session, channel, t0=None, t1=None, decimate=None, target_rate=None):
+        """
+        Samples of a channel recorded in [t0, t1) (µs)
+
+        :param session: str, session path relative to the server root
+        :param channel: str, channel name (e.g. 'LFP1') or .ncs file
+        :param decimate: int, decimation factor dividing 512
+        :param target_rate: float, sampling rate to decimate to (Hz)
+        :return: dict with keys 'data' (float32 samples), 'start_time',
+                 'sampling_rate', 'data_units' and 'segments'
+        """
+        header, payload = self._request(op='slice', session=session, channel=channel, t0=t0, t1=t1,
+                                        decimate=decimate, target_rate=target_rate)
+        header['data'] = np.frombuffer(payload, dtype=PAYLOAD_DTYPE).reshape(header.pop('shape'))
+        del header['nbytes'], header['id']
+        return header
+
+    def info(self, session, channel=None):
+        return self._request(op='info', session=session, channel=channel)[0]
+
+    def events(self, session):
+        return self._request(op='events', session=session)[0]
+
+    def stats(self):
+        return self._request(op='stats')[0]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve time-range slices of the sessions below a directory')
+    parser.add_argument('root', help='directory holding the sessions')
+    parser.add_argument('--host', default='127.0.0.1', choices=LOOPBACK_HOSTS)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--cache-mb', type=int, default=CACHE_BYTES // 2 ** 20, help='decoded chunk cache size')
+    parser.add_argument('--workers', type=int, help='decoding threads')
+    args = parser.parse_args(argv)
+
+    server = SliceServer(args.root, args.host, args.port, args.cache_mb * 2 ** 20, workers=args.workers)
+    print('Serving {} on {}:{}'.format(server.root, args.host, args.port), file=sys.stderr)
+    server.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,169 @@
 import os
+import re
+import fnmatch
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
+from scipy.signal import welch
 
-from degpy.neuralynx_io import load_ncs, load_nev
+from degpy.neuralynx_io import load_ncs, load_nev, NcsFile, get_cache, TimeIndex
+from degpy.neuralynx_io.neuralynx_io import NCS_SAMPLES_PER_RECORD, MICROVOLT_SCALING
 from degpy.terminal import Terminal
+from degpy.instrument.instrument import Recorder, instrumented_method
+from degpy.terminal.terminal import (BANDS, as_band_dict, exposure_names, exposure_bounds, window_samples,
+                                     integrate_band, ExposureTable)
+
+
+def natural_key(name):
+    """
+    Sort key placing LFP2 before LFP10
+    """
+    return [int(tok) if tok.isdigit() else tok for tok in re.split(r'(\d+)', name)]
+
+
+def channel_source(file_path, signal_scaling, cache=None):
+    """
+    Opens one .ncs file for reading without loading its samples
+
+    :param file_path: str, .ncs file
+    :param signal_scaling: tuple, (scale factor from volts, units)
+    :param cache: NcsCache to read the samples from, or None for the file
+    :return: dict with keys 'header', 'samples' (memory-mapped records x
+             512 int16), 'timestamp', 'scale', 'data_units',
+             'sampling_rate', 'channel_number', 'valid_samples' and 'close'
+             (callable releasing the mapping)
+    """
+    if cache is None:
+        ncs_file = NcsFile(file_path, signal_scaling=signal_scaling)
+        return {
+            'header': ncs_file.header,
+            'samples': ncs_file.records['Samples'],
+            'timestamp': ncs_file.timestamp,
+            'scale': ncs_file.samples.scale,
+            'data_units': ncs_file.data_units,
+            'sampling_rate': int(ncs_file.sampling_rate) if len(ncs_file) else None,
+            'channel_number': int(ncs_file.channel_number) if len(ncs_file) else None,
+            'valid_samples': ncs_file.records['NumValidSamples'],
+            'close': ncs_file.close,
+        }
+
+    entry = cache.load(file_path)
+    scale = entry['ad_bit_volts'] * signal_scaling[0] if entry['ad_bit_volts'] is not None else None
+    return {
+        'header': entry['header'],
+        'samples': entry['samples'].reshape(-1, NCS_SAMPLES_PER_RECORD),
+        'timestamp': entry['timestamp'],
+        'scale': scale,
+        'data_units': signal_scaling[1] if scale is not None else 'ADC counts',
+        'sampling_rate': entry['sampling_rate'],
+        'channel_number': entry['channel_number'],
+        'valid_samples': entry['validation'].valid_samples,
+        'close': lambda: None,
+    }
+
+
+def _epoch_windows(source, starts, n_samples, sampling_rate):
+    # Raw samples of one channel in the windows of n_samples starting at each time in starts (µs). Returns
+    # (counts, contiguous, onsets, missing): an (events x n_samples) int16 array, whether each window lies inside one
+    # continuous segment, the sample index each window starts at, and event index -> mask of the samples that were not
+    # recorded, for windows with any. Contiguous windows are read with a single gather of the records they span, so
+    # only those records are touched in the mapped file; samples of the other windows are looked up one by one, and
+    # those falling in gaps, partial record padding or outside the recording are left as 0.
+    samples = source['samples']
+    valid = np.asarray(source['valid_samples'], dtype=np.int64)
+    index = TimeIndex(source['timestamp'], sampling_rate)
+    counts = np.zeros((len(starts), n_samples), dtype=np.int16)
+    if len(samples) == 0 or len(starts) == 0:
+        missing = dict((i, np.ones(n_samples, dtype=bool)) for i in range(len(starts)))
+        return counts, np.zeros(len(starts), dtype=bool), np.zeros(len(starts), dtype=np.int64), missing
+
+    # Segments end after the last valid sample of their last record
+    segments = index.segments()
+    last_record = np.searchsorted(index.record_start(np.arange(len(valid) + 1)), segments[:, 1]) - 1
+    segment_stop = segments[:, 1] - (NCS_SAMPLES_PER_RECORD - valid[last_record])
+
+    def recorded_sample(time):
+        # First sample at or after each time, skipping the padding of partial records
+        position = np.asarray(index.time_to_sample(time), dtype=np.int64)
+        record, offset = np.divmod(np.minimum(position, len(index) - 1), NCS_SAMPLES_PER_RECORD)
+        return np.where(offset >= valid[record], (record + 1) * NCS_SAMPLES_PER_RECORD, position)
+
+    onsets = recorded_sample(starts)
+    segment = np.maximum(np.searchsorted(segments[:, 0], onsets, side='right') - 1, 0)
+    onset_time = index.sample_to_time(np.minimum(onsets, len(index) - 1))
+    contiguous = ((onsets < len(index)) & (onset_time - starts < index.sample_period) &
+                  (onsets + n_samples <= segment_stop[segment]))
+
+    span = (NCS_SAMPLES_PER_RECORD - 1 + n_samples - 1) // NCS_SAMPLES_PER_RECORD + 1
+    if contiguous.any() and span <= len(samples):
+        first = np.minimum(onsets[contiguous] // NCS_SAMPLES_PER_RECORD, len(samples) - span)
+        offset = onsets[contiguous] - first * NCS_SAMPLES_PER_RECORD
+        blocks = np.lib.stride_tricks.sliding_window_view(samples, span, axis=0)[first]
+        blocks = blocks.transpose(0, 2, 1).reshape(len(first), -1)
+        counts[contiguous] = blocks[np.arange(len(first))[:, None], offset[:, None] + np.arange(n_samples)]
+
+    missing = {}
+    for i in np.flatnonzero(~contiguous):
+        times = starts[i] + np.arange(n_samples) * index.sample_period
+        position = np.minimum(recorded_sample(times), len(index) - 1)
+        record, offset = np.divmod(position, NCS_SAMPLES_PER_RECORD)
+        recorded = (np.abs(index.sample_to_time(position) - times) < index.sample_period) & (offset < valid[record])
+        counts[i, recorded] = samples[record[recorded], offset[recorded]]
+        if not recorded.all():
+            missing[i] = ~recorded
+
+    return counts, contiguous, onsets, missing
+
+
+def _finite_welch(block, sampling_rate, nperseg):
+    # Welch PSD of each row of block along its last axis, leaving out NaN spans (records missing from a channel, or
+    # masked padding). A row with NaN is split into its finite runs, and the PSDs of the runs holding at least one
+    # window are averaged weighted by their number of windows, as Welch would over the runs without windows straddling
+    # the missing samples. Rows with no such run are NaN.
+    nperseg = min(nperseg, block.shape[-1])
+    finite = np.isfinite(block)
+    complete = finite.all(axis=-1)
+    if complete.all():
+        return welch(block, sampling_rate, nperseg=nperseg, axis=-1)
+
+    freqs = np.fft.rfftfreq(nperseg, 1. / sampling_rate)
+    psd = np.full((block.shape[0], len(freqs)), np.nan)
+    if complete.any():
+        psd[complete] = welch(block[complete], sampling_rate, nperseg=nperseg, axis=-1)[1]
+
+    step = nperseg - nperseg // 2
+    for row in np.flatnonzero(~complete):
+        edges = np.flatnonzero(np.diff(np.concatenate(([False], finite[row], [False])).astype(np.int8)))
+        total, count = 0., 0
+        for start, stop in edges.reshape(-1, 2):
+            if stop - start < nperseg:
+                continue
+            windows = (stop - start - nperseg) // step + 1
+            total = total + welch(block[row, start:stop], sampling_rate, nperseg=nperseg)[1] * windows
+            count += windows
+        if count:
+            psd[row] = total / count
+        else:
+            warnings.warn('Row {} has no run of {} recorded samples; its band power is NaN'.format(row, nperseg))
+
+    return freqs, psd
 
 
 class Session:
 
 
-    def __init__(self, session_path):
+    def __init__(self, session_path, cache_size=None, cache=None):
+        """
+        :param session_path: str, path to recording directory
+        :param cache_size: int, maximum number of Terminals kept by
+                           get_terminal (least recently used are dropped
+                           first). None keeps every Terminal, 0 disables
+                           the cache.
+        :param cache: NcsCache or str, on-disk cache of decoded channel data
+                      (None uses degpy.neuralynx_io.set_cache_dir, if set)
+        """
         self.session_path = os.path.abspath(session_path)
         self.events_file = self._get_eventsfile()
         self.data_files = self._get_datafiles()
@@ -16,6 +171,11 @@ class Session:
         self.records = None
         self.timestamps = None
         self.events = None
+        self.exposure_table = None
+        self.cache_size = cache_size
+        self.cache = cache
+        self._terminals = OrderedDict()
+        self._recorder = Recorder()
 
         # Read in events data to null attributes
         self._get_events_data()
@@ -55,20 +215,318 @@ class Session:
             return files
 
 
+    @instrumented_method('Session._get_events_data')
     def _get_events_data(self):
         events_file = self._get_eventsfile()
         events_data = load_nev(os.path.join(self.session_path, events_file))
         self.header = events_data['header']
         self.records = events_data['records']
         self.timestamps = events_data['events']['TimeStamp']
-        self.events = [x.decode('utf8') for x in events_data['events']['EventString']]
-        self.events = np.array(self.events)
+        self.events = events_data['event_strings']
+        self.exposure_table = ExposureTable(self.events, self.timestamps)
 
     
-    def get_terminal(self, file):
+    def get_terminal(self, file, **kwargs):
+        """
+        Returns the Terminal for the given data file. Terminals are cached
+        per file and options, so repeated calls share loaded data and
+        targets. Keyword arguments (e.g. dtype, raw, target_rate=2000 to
+        decimate 32 kHz LFP on load) are passed to Terminal.
+        """
         if file not in self.data_files:
             raise FileNotFoundError("'{}' does not exist in directory '{}'".format(file, self.session_path))
-        
-        return Terminal(os.path.join(self.session_path, file), self.events, self.timestamps)
 
+        key = (file, tuple(sorted((name, str(value)) for name, value in kwargs.items())))
+        if key in self._terminals:
+            self._terminals.move_to_end(key)
+            return self._terminals[key]
+
+        kwargs.setdefault('cache', self.cache)
+        kwargs.setdefault('exposure_table', self.exposure_table)
+        kwargs.setdefault('recorder', self._recorder)
+        terminal = Terminal(os.path.join(self.session_path, file), self.events, self.timestamps, **kwargs)
+        if self.cache_size is None or self.cache_size > 0:
+            self._terminals[key] = terminal
+            if self.cache_size is not None:
+                while len(self._terminals) > self.cache_size:
+                    self._terminals.popitem(last=False)
+
+        return terminal
+
+
+    def stats(self):
+        """
+        Instrumentation totals of every stage run for this session: reading
+        events, its Terminals and load_channels / bandpower. Empty unless
+        degpy.instrument is enabled.
+
+        :return: dict of stage name -> dict of 'calls', 'wall_time' (s),
+                 'bytes_read' and 'peak_memory' (bytes)
+        """
+        return self._recorder.stats()
+
+
+    def reset_stats(self):
+        self._recorder.reset()
+
+
+    def clear_terminals(self, file=None):
+        """
+        Drops the cached Terminal for `file`, or every cached Terminal
+        """
+        if file is None:
+            self._terminals.clear()
+        else:
+            for key in [key for key in self._terminals if key[0] == file]:
+                del self._terminals[key]
+
+
+    @instrumented_method('Session.load_channels')
+    def load_channels(self, pattern="LFP*.ncs", workers=None, dtype=np.float64, signal_scaling=MICROVOLT_SCALING,
+                      invalid_samples='keep'):
+        """
+        Reads every .ncs file matching `pattern` concurrently into a single
+        preallocated (channels x samples) array aligned on record timestamps.
+        Records missing from a channel are left as NaN.
+
+        :param pattern: str, glob matched against the session's data files
+        :param workers: int, number of reader threads (default: one per file)
+        :param dtype: numpy float dtype of the returned samples
+        :param signal_scaling: tuple, (scale factor from volts, units)
+        :param invalid_samples: str, 'keep' leaves the padding of records
+                                with fewer than 512 valid samples as read;
+                                'mask' sets it to NaN and adds 'valid_mask'
+        :return: dict with keys 'data', 'timestamp' (record start times),
+                 'time_index' (TimeIndex of the samples), 'sampling_rate',
+                 'data_units' and 'channels' (per-file metadata taken from
+                 each header)
+        """
+        if invalid_samples not in ('keep', 'mask'):
+            raise ValueError("invalid_samples must be 'keep' or 'mask'")
+        files = sorted(fnmatch.filter(self.data_files, pattern), key=natural_key)
+        if len(files) == 0:
+            raise FileNotFoundError("No data files matching '{}' in '{}'".format(pattern, self.session_path))
+
+        cache = get_cache(self.cache)
+
+        def open_source(file):
+            # Cache lookups in the reader threads are recorded as this session's stages
+            with self._recorder.activate():
+                return channel_source(os.path.join(self.session_path, file), signal_scaling, cache)
+
+        with ThreadPoolExecutor(max_workers=workers or len(files)) as pool:
+            sources = list(pool.map(open_source, files))
+            try:
+                timestamps = list(pool.map(lambda src: np.array(src['timestamp']), sources))
+
+                sampling_rates = set(src['sampling_rate'] for src in sources if src['sampling_rate'] is not None)
+                if len(sampling_rates) > 1:
+                    raise ValueError("Channels matching '{}' have different sampling rates: {}".format(
+                        pattern, sorted(sampling_rates)))
+
+                # Align every channel on the union of record start times
+                reference = np.unique(np.concatenate(timestamps))
+                data = np.full((len(files), len(reference) * NCS_SAMPLES_PER_RECORD), np.nan, dtype=dtype)
+
+                def fill(i):
+                    rows = data[i].reshape(-1, NCS_SAMPLES_PER_RECORD)
+                    positions = np.searchsorted(reference, timestamps[i])
+                    samples = sources[i]['samples']
+                    scale = sources[i]['scale']
+                    scale = 1 if scale is None else np.dtype(dtype).type(scale)
+                    if len(positions) and positions[-1] - positions[0] == len(positions) - 1:
+                        # Contiguous records are scaled straight from the mapped file into place
+                        np.multiply(samples, scale, out=rows[positions[0]:positions[-1] + 1], casting='unsafe')
+                    else:
+                        rows[positions] = samples * scale
+
+                    if invalid_samples == 'keep':
+                        return
+
+                    # Padding after the valid samples of partial records is set to NaN
+                    valid = np.asarray(sources[i]['valid_samples'])
+                    partial = np.flatnonzero(valid != NCS_SAMPLES_PER_RECORD)
+                    if len(partial):
+                        padding = np.arange(NCS_SAMPLES_PER_RECORD) >= valid[partial, None]
+                        block = rows[positions[partial]]
+                        block[padding] = np.nan
+                        rows[positions[partial]] = block
+
+                list(pool.map(fill, range(len(files))))
+            finally:
+                for src in sources:
+                    src['close']()
+
+        channels = []
+        for file, src in zip(files, sources):
+            header = src['header']
+            channels.append({
+                'file': file,
+                'name': os.path.splitext(file)[0],
+                'channel_number': src['channel_number'],
+                'acq_ent_name': header.get('AcqEntName'),
+                'ad_bit_volts': float(header['ADBitVolts']) if 'ADBitVolts' in header else None,
+                'data_units': src['data_units'],
+                'header': header,
+            })
+
+        sampling_rate = sampling_rates.pop() if sampling_rates else None
+        loaded = {
+            'data': data,
+            'timestamp': reference,
+            'time_index': TimeIndex(reference, sampling_rate) if sampling_rate else None,
+            'sampling_rate': sampling_rate,
+            'data_units': channels[0]['data_units'],
+            'channels': channels,
+        }
+        if invalid_samples == 'mask':
+            # Samples that were recorded: not in a missing record or in partial record padding
+            loaded['valid_mask'] = ~np.isnan(data)
+
+        return loaded
+
+
+    @instrumented_method('Session.bandpower')
+    def bandpower(self, bands=None, exposures=None, pattern="LFP*.ncs", window_sec=None, relative=False,
+                  channels=None, workers=None):
+        """
+        Computes band power for every channel, exposure and band. Welch is
+        run once per exposure over the whole (channels x samples) block
+        along its sample axis, and every band is integrated from that PSD.
+        Samples missing from a channel (NaN) are left out of its windows.
+
+        :param bands: dict of name -> [low, high], or list of [low, high]
+                      (default: degpy.terminal.terminal.BANDS)
+        :param exposures: list of exposure names (default: all exposures)
+        :param pattern: str, glob selecting the channels to load
+        :param window_sec: float, Welch window length in seconds. If None,
+                           (1 / lowest band frequency) * 2
+        :param relative: bool, if True divide by the total power
+        :param channels: dict, output of load_channels to reuse instead of
+                         loading the channels again
+        :param workers: int, reader threads used by load_channels
+        :return: dict with keys 'bandpower' (channels x exposures x bands
+                 array), 'channels', 'exposures' and 'bands' (axis labels)
+        """
+        bands = as_band_dict(BANDS if bands is None else bands)
+        exposures = exposure_names(self.events) if exposures is None else list(exposures)
+        if channels is None:
+            channels = self.load_channels(pattern, workers=workers)
+
+        data = channels['data']
+        sampling_rate = channels['sampling_rate']
+        nperseg = window_samples(np.array(list(bands.values())), window_sec, sampling_rate)
+        bounds = exposure_bounds(channels['time_index'], self.exposure_table, exposures)
+
+        bandpower = np.zeros((data.shape[0], len(exposures), len(bands)))
+        for i, (start, stop) in enumerate(bounds):
+            freqs, psd = _finite_welch(data[:, start:stop], sampling_rate, nperseg)
+            for j, band in enumerate(bands.values()):
+                bandpower[:, i, j] = integrate_band(freqs, psd, band, relative)
+
+        return {
+            'bandpower': bandpower,
+            'channels': [channel['name'] for channel in channels['channels']],
+            'exposures': exposures,
+            'bands': list(bands),
+        }
+
+
+    @instrumented_method('Session.epochs')
+    def epochs(self, event_names, tmin, tmax, pattern="LFP*.ncs", dtype=np.float64, signal_scaling=MICROVOLT_SCALING,
+               copy=True, workers=None):
+        """
+        Cuts a window from tmin to tmax seconds around every occurrence of
+        the given events, on every channel matching `pattern`. Event times
+        are resolved to sample offsets by binary search over the record
+        timestamps, and only the records spanned by the windows are read
+        from the memory-mapped files (or cache entries), never whole files.
+        Samples of a window that fall in a recording gap, in the padding of
+        a partial record or outside the recording are NaN.
+
+        :param event_names: str or list of str, events to lock to (e.g.
+                            ['s1', 'o1'])
+        :param tmin: float, window start relative to each event (s), e.g. -1
+        :param tmax: float, window end relative to each event (s)
+        :param pattern: str, glob selecting the channels
+        :param dtype: numpy float dtype of the returned samples
+        :param signal_scaling: tuple, (scale factor from volts, units)
+        :param copy: bool, if False return views instead of copies: 'data'
+                     is a list (per event) of lists (per channel) of raw
+                     int16 views into the cached samples, with None for
+                     windows that cross a gap or a partial record. Needs
+                     the cache, whose samples are contiguous on disk.
+        :param workers: int, number of reader threads (default: one per file)
+        :return: dict with keys 'data' (events x channels x samples array),
+                 'complete' (events x channels bool, every sample of the
+                 window was recorded), 'onsets' (events x channels index
+                 of each window's first sample), 'times' (window sample
+                 times relative to the event, s), 'events' and 'timestamps'
+                 (the events epoched), 'sampling_rate', 'data_units',
+                 'scale' (per channel ADC count to data_units factor) and
+                 'channels' (channel names)
+        """
+        names = [event_names] if isinstance(event_names, str) else list(event_names)
+        files = sorted(fnmatch.filter(self.data_files, pattern), key=natural_key)
+        if len(files) == 0:
+            raise FileNotFoundError("No data files matching '{}' in '{}'".format(pattern, self.session_path))
+
+        cache = get_cache(self.cache)
+        if not copy and cache is None:
+            raise ValueError('copy=False needs the cache (see degpy.neuralynx_io.set_cache_dir): the samples of an '
+                             '.ncs file are interleaved with record headers, so windows cannot be viewed in place')
+
+        selected = np.flatnonzero(np.isin(np.asarray(self.events, dtype=object), names))
+        timestamps = np.asarray(self.timestamps)[selected]
+
+        def open_source(file):
+            with self._recorder.activate():
+                return channel_source(os.path.join(self.session_path, file), signal_scaling, cache)
+
+        with ThreadPoolExecutor(max_workers=workers or len(files)) as pool:
+            sources = list(pool.map(open_source, files))
+            try:
+                sampling_rates = set(src['sampling_rate'] for src in sources if src['sampling_rate'] is not None)
+                if len(sampling_rates) != 1:
+                    raise ValueError("Channels matching '{}' have different (or no) sampling rates: {}".format(
+                        pattern, sorted(sampling_rates)))
+                sampling_rate = sampling_rates.pop()
+
+                n_samples = int(round((tmax - tmin) * sampling_rate))
+                starts = timestamps.astype(np.float64) + tmin * 1e6
+                windows = list(pool.map(lambda src: _epoch_windows(src, starts, n_samples, sampling_rate), sources))
+
+                contiguous = np.column_stack([w[1] for w in windows])
+                complete = np.ones(contiguous.shape, dtype=bool)
+                for j, window in enumerate(windows):
+                    complete[list(window[3]), j] = False
+                onsets = np.column_stack([w[2] for w in windows])
+                if copy:
+                    data = np.full((len(timestamps), len(files), n_samples), np.nan, dtype=dtype)
+                    for j, (counts, _, _, missing) in enumerate(windows):
+                        scale = sources[j]['scale']
+                        scale = 1 if scale is None else np.dtype(dtype).type(scale)
+                        np.multiply(counts, scale, out=data[:, j], casting='unsafe')
+                        for i, mask in missing.items():
+                            data[i, j, mask] = np.nan
+                else:
+                    flat = [src['samples'].reshape(-1) for src in sources]
+                    data = [[flat[j][onsets[i, j]:onsets[i, j] + n_samples] if contiguous[i, j] else None
+                             for j in range(len(files))] for i in range(len(timestamps))]
+            finally:
+                if copy:
+                    for src in sources:
+                        src['close']()
 
+        return {
+            'data': data,
+            'complete': complete,
+            'onsets': onsets,
+            'times': tmin + np.arange(n_samples) / float(sampling_rate),
+            'events': [self.events[i] for i in selected],
+            'timestamps': timestamps,
+            'sampling_rate': sampling_rate,
+            'data_units': sources[0]['data_units'],
+            'scale': [src['scale'] for src in sources],
+            'channels': [os.path.splitext(file)[0] for file in files],
+        }
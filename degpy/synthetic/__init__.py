@@ -0,0 +1,2 @@
+from .synthetic import (write_ncs, write_nev, write_ntt, write_session, write_dataset, append_ncs, append_nev,
+                        make_header, PROTOCOL_EVENTS, SHORT_PROTOCOL_EVENTS)
\ No newline at end of file
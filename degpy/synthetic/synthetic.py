@@ -0,0 +1,378 @@
+"""
+This module writes synthetic Neuralynx files and data trees, for exercising
+and benchmarking degpy without the lab drives
+
+data
+    080602                              <- degu_id
+        080602_ps01_160614              <- session (ps01)
+            2016-06-14_09-39-10         <- recording
+                Events.nev
+                LFP1.ncs
+                TT1.ntt
+
+Files have valid 16 kB headers and are written a chunk of records at a
+time, so recordings of any length can be generated in bounded memory.
+Continuous data is a few sinusoids plus noise; recording gaps, partial
+records and the exposure protocol are configurable.
+"""
+
+import os
+import datetime
+
+import numpy as np
+
+from degpy.neuralynx_io.neuralynx_io import (HEADER_LENGTH, NCS_RECORD, NEV_RECORD, NTT_RECORD, NCS_SAMPLES_PER_RECORD,
+                                             map_records)
+
+
+# Full exposure protocol of a session, in the order Cheetah records it
+PROTOCOL_EVENTS = ['Starting Recording', 'r1s', 'r1e', 'b1s', 'b1e', 'b2s', 'b2e',
+                   'b3s', 's1', 's1o', 's2', 's2o', 'b3e', 'b4s', 's1', 's1o', 's2',
+                   's2o', 'b4e', 'b5s', 's1', 's2', 's1o', 's2o', 'b5e', 'b6s', 's1',
+                   's2', 's1o', 's2o', 'b6e', 'b7s', 'o1', 'o1o', 'o2', 'o2o', 'b7e',
+                   'b8s', 'o1', 'o1o', 'o2', 'o2o', 'b8e', 'b9s', 'o1', 'o2', 'o1o',
+                   'o2o', 'b9e', 'b10s', 'o1', 'o2', 'o1o', 'o2o', 'b10e', 'b11s',
+                   'b11e', 'b12s', 'b12e', 'r2s', 'r2e', 'Stopping Recording']
+
+# Short protocol with one of each kind of exposure
+SHORT_PROTOCOL_EVENTS = ['Starting Recording', 'r1s', 'r1e', 'b1s', 'b1e', 'b3s', 's1', 's1o', 's2', 's2o', 'b3e',
+                         'Stopping Recording']
+
+AD_BIT_VOLTS = 0.000000030518  # Volts per ADC count
+START_TIME = 1000000  # Timestamp (µs) of the first record
+TIME_OPENED = datetime.datetime(2016, 6, 14, 9, 39, 10, 484000)
+CHEETAH_DIR = '080602_ps01_160614'  # Directory Cheetah wrote to, recorded in the header (FileName)
+WRITE_CHUNK_RECORDS = 4096  # Records generated and written per step
+
+# Components of the synthetic LFP, (frequency Hz, amplitude in ADC counts)
+LFP_COMPONENTS = ((2.5, 2000.), (8., 3000.), (20., 800.), (50., 300.))
+
+
+def _time_string(dt):
+    # Neuralynx header time, e.g. '6/14/2016  (h:m:s.ms) 9:39:10.484'
+    return '{}/{}/{}  (h:m:s.ms) {}:{:02d}:{:02d}.{:03d}'.format(dt.month, dt.day, dt.year, dt.hour, dt.minute,
+                                                                 dt.second, dt.microsecond // 1000)
+
+
+def make_header(file_name, parameters=(), time_opened=TIME_OPENED, duration_sec=0., cheetah_dir=CHEETAH_DIR):
+    """
+    Builds a 16 kB Neuralynx header
+
+    :param file_name: str, original file name recorded in the header
+    :param cheetah_dir: str, directory of the original file, named after
+                        the session (<degu_id>_<session>_<date>)
+    :param parameters: iterable of (name, value) parameter lines
+    :param time_opened: datetime, time the file was opened
+    :param duration_sec: float, time between opening and closing the file
+    :return: bytes, the null padded header
+    """
+    time_closed = time_opened + datetime.timedelta(seconds=duration_sec)
+    lines = ['######## Neuralynx Data File Header',
+             '## File Name C:\\CheetahData\\{}\\{}'.format(cheetah_dir, file_name),
+             '## Time Opened (m/d/y): ' + _time_string(time_opened),
+             '## Time Closed (m/d/y): ' + _time_string(time_closed)]
+    lines += ['-{} {}'.format(name, value) for name, value in parameters]
+
+    header = '\r\n'.join(lines).encode('iso-8859-1')
+    if len(header) > HEADER_LENGTH:
+        raise ValueError('Header is longer than {} bytes'.format(HEADER_LENGTH))
+    return header + b'\0' * (HEADER_LENGTH - len(header))
+
+
+def record_timestamps(n_records, sampling_rate=2000, start_time=START_TIME, gaps=None, partial_records=None,
+                      valid_samples=NCS_SAMPLES_PER_RECORD // 2):
+    """
+    Start time of every record of a continuous recording
+
+    :param n_records: int, number of records
+    :param sampling_rate: int, samples per second
+    :param start_time: int, timestamp (µs) of the first record
+    :param gaps: dict of record index -> pause (s) before that record
+    :param partial_records: iterable of indices of records holding only
+                            valid_samples samples; the next record starts
+                            where their valid samples end
+    :param valid_samples: int, valid samples in each partial record
+    :return: tuple, (uint64 timestamps, uint32 valid samples per record)
+    """
+    valid = np.full(n_records, NCS_SAMPLES_PER_RECORD, dtype=np.uint32)
+    if partial_records is not None:
+        valid[np.asarray(list(partial_records), dtype=np.int64)] = valid_samples
+
+    duration = valid * (1e6 / sampling_rate)
+    offsets = np.concatenate(([0.], np.cumsum(duration[:-1])))
+    for record, pause in (gaps or {}).items():
+        offsets[record:] += pause * 1e6
+
+    return (start_time + np.round(offsets)).astype(np.uint64), valid
+
+
+def lfp_signal(start, stop, sampling_rate=2000, seed=0, components=LFP_COMPONENTS, noise=400.):
+    """
+    Samples start:stop of a deterministic synthetic LFP, in ADC counts
+
+    :param seed: int, selects the phases and the noise of the channel
+    :return: int16 array
+    """
+    rng = np.random.RandomState([seed, start // NCS_SAMPLES_PER_RECORD])
+    phases = np.random.RandomState(seed).uniform(0, 2 * np.pi, len(components))
+    t = np.arange(start, stop) / float(sampling_rate)
+    signal = noise * rng.standard_normal(len(t))
+    for (frequency, amplitude), phase in zip(components, phases):
+        signal += amplitude * np.sin(2 * np.pi * frequency * t + phase)
+
+    return np.clip(signal, -32768, 32767).astype(np.int16)
+
+
+def write_ncs(path, n_records, sampling_rate=2000, channel_number=0, start_time=START_TIME, gaps=None,
+              partial_records=None, seed=0, ad_bit_volts=AD_BIT_VOLTS, time_opened=TIME_OPENED,
+              cheetah_dir=CHEETAH_DIR):
+    """
+    Writes a continuous .ncs file
+
+    :param path: str, output file
+    :param n_records: int, number of 512 sample records
+    :param sampling_rate: int, samples per second
+    :param channel_number: int, ChannelNumber of every record
+    :param start_time: int, timestamp (µs) of the first record
+    :param gaps: dict of record index -> pause (s) before that record
+    :param partial_records: iterable of indices of records with only half
+                            their samples valid
+    :param seed: int, selects the synthetic signal of this channel
+    :param ad_bit_volts: float, volts per ADC count written to the header
+    :return: tuple, (record timestamps, valid samples per record)
+    """
+    timestamps, valid = record_timestamps(n_records, sampling_rate, start_time, gaps, partial_records)
+    duration = (float(timestamps[-1]) - start_time) / 1e6 + NCS_SAMPLES_PER_RECORD / sampling_rate if n_records else 0
+    name = os.path.splitext(os.path.basename(path))[0]
+    parameters = [('AcqEntName', name), ('FileType', 'CSC'), ('RecordSize', NCS_RECORD.itemsize),
+                  ('SamplingFrequency', sampling_rate), ('ADMaxValue', 32767), ('ADBitVolts', '%.12f' % ad_bit_volts),
+                  ('ADChannel', channel_number), ('InputRange', 1000), ('InputInverted', 'True')]
+
+    with open(path, 'wb') as fid:
+        fid.write(make_header(os.path.basename(path), parameters, time_opened, duration, cheetah_dir))
+        _write_ncs_records(fid, timestamps, valid, 0, sampling_rate, channel_number, seed)
+
+    return timestamps, valid
+
+
+def _write_ncs_records(fid, timestamps, valid, first_record, sampling_rate, channel_number, seed):
+    # Append records first_record, first_record + 1, ... of the synthetic signal with the given timestamps
+    for start in range(0, len(timestamps), WRITE_CHUNK_RECORDS):
+        stop = min(start + WRITE_CHUNK_RECORDS, len(timestamps))
+        records = np.zeros(stop - start, NCS_RECORD)
+        records['TimeStamp'] = timestamps[start:stop]
+        records['ChannelNumber'] = channel_number
+        records['SampleFreq'] = sampling_rate
+        records['NumValidSamples'] = valid[start:stop]
+        first_sample = (first_record + start) * NCS_SAMPLES_PER_RECORD
+        samples = lfp_signal(first_sample, first_sample + len(records) * NCS_SAMPLES_PER_RECORD, sampling_rate, seed)
+        records['Samples'] = samples.reshape(-1, NCS_SAMPLES_PER_RECORD)
+        # Padding after the valid samples of partial records is zeroed, as Cheetah does
+        records['Samples'][np.arange(NCS_SAMPLES_PER_RECORD) >= records['NumValidSamples'][:, None]] = 0
+        records.tofile(fid)
+
+
+def append_ncs(path, n_records, gap_sec=0., seed=0):
+    """
+    Appends records to an existing .ncs file, continuing its signal and
+    timestamps as Cheetah does while recording
+
+    :param path: str, .ncs file written by write_ncs
+    :param n_records: int, number of records to append
+    :param gap_sec: float, pause (s) before the first appended record
+    :param seed: int, the seed the file was written with
+    :return: int, number of records in the file
+    """
+    records = map_records(path, NCS_RECORD)
+    if len(records) == 0:
+        raise ValueError("'{}' has no records to continue from".format(path))
+    last = records[-1]
+    sampling_rate = int(last['SampleFreq'])
+    channel_number = int(last['ChannelNumber'])
+    start_time = int(last['TimeStamp']) + int(round(int(last['NumValidSamples']) * 1e6 / sampling_rate))
+    first_record = len(records)
+    del records, last
+
+    timestamps, valid = record_timestamps(n_records, sampling_rate, start_time + int(round(gap_sec * 1e6)))
+    with open(path, 'ab') as fid:
+        _write_ncs_records(fid, timestamps, valid, first_record, sampling_rate, channel_number, seed)
+
+    return first_record + n_records
+
+
+def event_records(events, timestamps):
+    """
+    Builds .nev records for the given event strings and times
+
+    :param events: list of str, event strings
+    :param timestamps: array, time (µs) of each event
+    :return: NEV_RECORD array
+    """
+    records = np.zeros(len(events), NEV_RECORD)
+    records['pkt_data_size'] = 2
+    records['TimeStamp'] = timestamps
+    records['event_id'] = 19
+    records['EventString'] = [event.encode('ascii') for event in events]
+
+    return records
+
+
+def protocol_timestamps(events, start_time, stop_time):
+    """
+    Spreads events evenly over a recording, the first just before
+    start_time (so every sample follows an event) and the last at
+    stop_time
+
+    :return: uint64 array of event times (µs)
+    """
+    timestamps = np.linspace(start_time, stop_time, len(events))
+    if len(events):
+        timestamps[0] = max(start_time - 1000, 0)
+
+    return np.round(timestamps).astype(np.uint64)
+
+
+def write_nev(path, events=SHORT_PROTOCOL_EVENTS, timestamps=None, start_time=START_TIME, stop_time=None,
+              time_opened=TIME_OPENED, cheetah_dir=CHEETAH_DIR):
+    """
+    Writes an events .nev file
+
+    :param path: str, output file
+    :param events: list of str, event strings in order
+    :param timestamps: array, time (µs) of each event (default: spread
+                       evenly between start_time and stop_time)
+    :param start_time: int, timestamp (µs) of the start of the recording
+    :param stop_time: int, timestamp (µs) of the end of the recording
+    :return: NEV_RECORD array of the written events
+    """
+    if timestamps is None:
+        stop_time = start_time + 60 * 1e6 if stop_time is None else stop_time
+        timestamps = protocol_timestamps(events, start_time, stop_time)
+    records = event_records(events, timestamps)
+    duration = (float(records['TimeStamp'][-1]) - float(records['TimeStamp'][0])) / 1e6 if len(records) else 0
+
+    with open(path, 'wb') as fid:
+        fid.write(make_header(os.path.basename(path), [('FileType', 'Event'), ('RecordSize', NEV_RECORD.itemsize)],
+                              time_opened, duration, cheetah_dir))
+        records.tofile(fid)
+
+    return records
+
+
+def append_nev(path, events, timestamps):
+    """
+    Appends events to an existing .nev file
+
+    :param path: str, .nev file
+    :param events: list of str, event strings
+    :param timestamps: array, time (µs) of each event
+    """
+    with open(path, 'ab') as fid:
+        event_records(events, timestamps).tofile(fid)
+
+
+def write_ntt(path, n_spikes, start_time=START_TIME, stop_time=None, n_cells=4, sc_number=0, seed=0,
+              ad_bit_volts=AD_BIT_VOLTS / 2, time_opened=TIME_OPENED, cheetah_dir=CHEETAH_DIR):
+    """
+    Writes a tetrode .ntt file of n_spikes spikes from n_cells cells, each
+    with its own waveform shape, at random times between start_time and
+    stop_time
+
+    :return: NTT_RECORD array of the written spikes
+    """
+    stop_time = start_time + 60 * 1e6 if stop_time is None else stop_time
+    rng = np.random.RandomState(seed)
+    records = np.zeros(n_spikes, NTT_RECORD)
+    records['TimeStamp'] = np.sort(rng.randint(start_time, stop_time, n_spikes)).astype(np.uint64)
+    records['ScNumber'] = sc_number
+    records['CellNumber'] = rng.randint(1, n_cells + 1, n_spikes)
+
+    # Spike shape (32 points) scaled per cell and channel, plus noise
+    t = np.arange(32)
+    shape = -np.exp(-(t - 8) ** 2 / 4.) + 0.4 * np.exp(-(t - 14) ** 2 / 16.)
+    gains = rng.uniform(200, 1500, (n_cells + 1, 4))
+    waveforms = shape[None, :, None] * gains[records['CellNumber']][:, None, :]
+    records['Data'] = np.round(waveforms + 30 * rng.standard_normal(waveforms.shape)).astype(np.int16)
+    records['Params'] = np.abs(records['Data']).max(axis=1).repeat(2, axis=1)
+
+    name = os.path.splitext(os.path.basename(path))[0]
+    parameters = [('AcqEntName', name), ('FileType', 'Spike'), ('RecordSize', NTT_RECORD.itemsize),
+                  ('SamplingFrequency', 32000), ('ADMaxValue', 32767),
+                  ('ADBitVolts', ' '.join(['%.12f' % ad_bit_volts] * 4)), ('WaveformLength', 32)]
+    with open(path, 'wb') as fid:
+        fid.write(make_header(os.path.basename(path), parameters, time_opened, (stop_time - start_time) / 1e6,
+                              cheetah_dir))
+        records.tofile(fid)
+
+    return records
+
+
+def write_session(directory, duration_sec=60., sampling_rate=2000, n_channels=2, events=SHORT_PROTOCOL_EVENTS,
+                  gaps=None, partial_records=None, n_tetrodes=0, spikes_per_tetrode=1000, seed=0,
+                  time_opened=TIME_OPENED, cheetah_dir=None):
+    """
+    Writes a recording directory: Events.nev, LFP1.ncs ... LFP<n>.ncs and
+    TT1.ntt ... TT<n>.ntt, with events spread over the recording
+
+    :param directory: str, recording directory (created if needed)
+    :param duration_sec: float, length of the continuous data, excluding
+                         gaps (rounded up to whole records)
+    :param sampling_rate: int, samples per second of the .ncs files
+    :param n_channels: int, number of .ncs files
+    :param events: list of str, event strings, e.g. PROTOCOL_EVENTS
+    :param gaps: dict of record index -> pause (s) before that record
+    :param partial_records: iterable of indices of partial records
+    :param n_tetrodes: int, number of .ntt files
+    :param spikes_per_tetrode: int, spikes in each .ntt file
+    :param seed: int, base seed of the synthetic signals
+    :param cheetah_dir: str, session name recorded in the headers
+                        (default: the parent directory's name)
+    :return: str, the recording directory
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    if cheetah_dir is None:
+        cheetah_dir = os.path.basename(os.path.dirname(os.path.abspath(directory)))
+
+    n_records = int(np.ceil(duration_sec * sampling_rate / NCS_SAMPLES_PER_RECORD))
+    timestamps = None
+    for channel in range(n_channels):
+        timestamps, valid = write_ncs(os.path.join(directory, 'LFP{}.ncs'.format(channel + 1)), n_records,
+                                      sampling_rate, channel, START_TIME, gaps, partial_records, seed + channel,
+                                      time_opened=time_opened, cheetah_dir=cheetah_dir)
+
+    if timestamps is None:
+        timestamps, valid = record_timestamps(n_records, sampling_rate, START_TIME, gaps, partial_records)
+    stop_time = int(timestamps[-1]) + int(valid[-1] * 1e6 / sampling_rate) if n_records else START_TIME
+    write_nev(os.path.join(directory, 'Events.nev'), events, start_time=START_TIME, stop_time=stop_time,
+              time_opened=time_opened, cheetah_dir=cheetah_dir)
+
+    for tetrode in range(n_tetrodes):
+        write_ntt(os.path.join(directory, 'TT{}.ntt'.format(tetrode + 1)), spikes_per_tetrode, START_TIME,
+                  stop_time, sc_number=tetrode, seed=seed + tetrode, time_opened=time_opened, cheetah_dir=cheetah_dir)
+
+    return directory
+
+
+def write_dataset(root, degu_ids=('080602',), sessions_per_degu=2, **kwargs):
+    """
+    Writes a data tree of sessions laid out like the lab drives (see the
+    module docstring), one recording per session on consecutive days
+
+    :param root: str, root data directory
+    :param degu_ids: iterable of str, degu IDs
+    :param sessions_per_degu: int, sessions written for each degu
+    :param kwargs: passed to write_session
+    :return: list of str, the recording directories
+    """
+    recordings = []
+    seed = kwargs.pop('seed', 0)
+    for degu_index, degu_id in enumerate(degu_ids):
+        for session in range(sessions_per_degu):
+            opened = TIME_OPENED + datetime.timedelta(days=session)
+            session_dir = '{}_ps{:02d}_{}'.format(degu_id, session + 1, opened.strftime('%y%m%d'))
+            directory = os.path.join(root, degu_id, session_dir, opened.strftime('%Y-%m-%d_%H-%M-%S'))
+            recordings.append(write_session(directory, seed=seed + 100 * degu_index + 10 * session,
+                                            time_opened=opened, **kwargs))
+
+    return recordings
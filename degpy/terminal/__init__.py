@@ -1 +1 @@
-from .terminal import Terminal
\ No newline at end of file
+from .terminal import Terminal, as_band_dict
\ No newline at end of file
@@ -1,21 +1,474 @@
 from __future__ import division
 
 import os
-import warnings
 
 import numpy as np
 import pandas as pd
 
-from scipy.signal import welch
+from scipy.signal import welch, periodogram
 from scipy.integrate import simps
 
-from degpy.neuralynx_io import read_records, parse_header, check_ncs_records, read_header
+from degpy.neuralynx_io import (parse_header, read_header, read_ncs, scale_samples, TimeIndex, load_spikes,
+                               ncs_time_index, iter_ncs_chunks, map_records, validate_ncs_records, decimation_factor)
+from degpy.neuralynx_io.neuralynx_io import NCS_RECORD, RECORD_DTYPES
+from degpy.instrument.instrument import Recorder, stage, instrumented_method
+
+
+def _code_dtype(n_categories):
+    return np.int16 if n_categories < np.iinfo(np.int16).max else np.int32
+
+
+def label_segments(sample_times, event_timestamps, events):
+    """
+    Splits the samples into segments that share the same last preceding
+    event, using a single binary search of the event timestamps into the
+    (sorted) sample times
+
+    :param sample_times: TimeIndex, or array of sorted time of each sample
+    :param event_timestamps: array, time of each event
+    :param events: array, name of each event
+    :return: tuple, (first sample of each segment; integer code of each
+             segment, -1 before the first event; array of label names
+             indexed by code)
+    """
+    categories, event_codes = np.unique(np.asarray(events), return_inverse=True)
+
+    # First sample strictly after each event. Later events win ties.
+    if isinstance(sample_times, TimeIndex):
+        boundaries = sample_times.time_to_sample(event_timestamps, side='right')
+    else:
+        boundaries = np.searchsorted(sample_times, event_timestamps, side='right')
+    boundaries = np.maximum.accumulate(boundaries) if len(boundaries) else boundaries
+
+    starts = np.concatenate(([0], boundaries)).astype(np.int64)
+    codes = np.concatenate(([-1], event_codes)).astype(_code_dtype(len(categories)))
+    keep = np.diff(np.append(starts, len(sample_times))) > 0
+
+    return starts[keep], codes[keep], categories
+
+
+def label_samples(sample_times, event_timestamps, events):
+    """
+    Labels every sample with the last event that precedes it
+
+    :param sample_times: TimeIndex, or array of sorted time of each sample
+    :param event_timestamps: array, time of each event
+    :param events: array, name of each event
+    :return: tuple, (integer code per sample, -1 before the first event;
+             array of label names indexed by code)
+    """
+    starts, segment_codes, categories = label_segments(sample_times, event_timestamps, events)
+    codes = np.repeat(segment_codes, np.diff(np.append(starts, len(sample_times))))
+
+    return codes, categories
+
+
+def decode_labels(codes, categories):
+    """
+    Maps integer label codes back to an object array of names, with NaN
+    where the code is -1
+    """
+    lookup = np.append(np.asarray(categories, dtype=object), np.nan)
+    return lookup[codes]
+
+
+# Standard frequency bands (Hz)
+BANDS = {
+    'delta': [1, 4],
+    'theta': [4, 8],
+    'alpha': [8, 12],
+    'beta': [12, 30],
+    'low_gamma': [30, 60],
+    'high_gamma': [60, 100],
+}
+
+
+def as_band_dict(bands):
+    """
+    Returns bands as a dict of name -> [low, high]. Accepts such a dict or
+    a list of [low, high] pairs, which are named 'low-high'
+    """
+    if isinstance(bands, dict):
+        return dict(bands)
+    return dict(('{:g}-{:g}'.format(*band), band) for band in bands)
+
+
+def exposure_names(events):
+    """
+    Returns the names of exposures that have a start event, e.g. 'b1' for
+    'b1s', in order of appearance
+    """
+    exposures = []
+    for e in events:
+        if e[-1] == 's' and e[:-1] not in exposures:
+            exposures.append(e[:-1])
+    return exposures
+
+
+class ExposureTable:
+    """
+    Interval table of the exposures in an events file, built once per
+    Session. Blocks run from '<name>s' to '<name>e' (e.g. b3s -> b3e) and
+    stimuli from '<name>' to '<name>o' (e.g. s1 -> s1o). Each interval
+    records its start/stop timestamps, nesting depth and enclosing
+    interval, and lookups are binary searches over precomputed boundaries.
+    """
+
+    def __init__(self, events, event_timestamps):
+        names = []
+        kinds = []
+        starts = []
+        stops = []
+        open_intervals = {}
+
+        for event, ts in zip(events, event_timestamps):
+            if event[-1] == 's' or event[-1] in '1234567890':
+                name = event[:-1] if event[-1] == 's' else event
+                open_intervals.setdefault(name, []).append(len(names))
+                names.append(name)
+                kinds.append('block' if event[-1] == 's' else 'stimulus')
+                starts.append(ts)
+                stops.append(None)
+            elif event[-1] == 'e' or event[-1] == 'o':
+                pending = open_intervals.get(event[:-1])
+                if pending:
+                    stops[pending.pop(0)] = ts
+
+        # Intervals that are never closed run to the last event
+        last = event_timestamps[-1] if len(event_timestamps) else 0
+        self.names = np.array(names, dtype=object)
+        self.kinds = np.array(kinds, dtype=object)
+        self.start = np.array(starts, dtype=np.uint64)
+        self.stop = np.array([last if stop is None else stop for stop in stops], dtype=np.uint64)
+
+        # contains[i, j]: interval j encloses interval i
+        contains = ((self.start[None, :] <= self.start[:, None]) & (self.stop[None, :] >= self.stop[:, None]) &
+                    ~np.eye(len(self.names), dtype=bool))
+        self.depth = contains.sum(axis=1)
+        self.parent = np.where(contains.any(axis=1),
+                               np.argmax(np.where(contains, self.depth[None, :], -1), axis=1), -1)
+
+        self._index = {}
+        for i, name in enumerate(self.names):
+            self._index.setdefault(name, []).append(i)
+        self._index = dict((name, np.array(idx)) for name, idx in self._index.items())
+
+        # Innermost interval active in each elementary segment between boundaries
+        self.boundaries = np.unique(np.concatenate((self.start, self.stop)))
+        active = ((self.start[None, :] <= self.boundaries[:, None]) & (self.stop[None, :] > self.boundaries[:, None]))
+        self.innermost = np.where(active.any(axis=1),
+                                  np.argmax(np.where(active, self.depth[None, :] * len(self.names) +
+                                                     np.arange(len(self.names))[None, :], -1), axis=1), -1)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __repr__(self):
+        return 'ExposureTable({} intervals)'.format(len(self))
+
+    def index(self, name):
+        """
+        Returns the row indices of every interval of the named exposure
+        """
+        return self._index.get(name, np.zeros(0, dtype=np.int64))
+
+    def intervals(self, name):
+        """
+        Returns the (k x 2) start/stop timestamps of every interval of the
+        named exposure, e.g. intervals('b3')
+        """
+        idx = self.index(name)
+        return np.column_stack((self.start[idx], self.stop[idx]))
+
+    def containing(self, time):
+        """
+        Returns the row of the innermost interval containing each time
+        (-1 where no exposure is active). Intervals are half-open [start, stop).
+        """
+        segment = np.searchsorted(self.boundaries, np.asarray(time, dtype=np.float64), side='right') - 1
+        rows = np.where(segment >= 0, self.innermost[np.maximum(segment, 0)], -1)
+        return rows[()] if rows.ndim == 0 else rows
+
+    def active(self, time):
+        """
+        Returns the rows of every interval containing the given time
+        """
+        return np.flatnonzero((self.start <= time) & (self.stop > time))
+
+    def to_frame(self):
+        return pd.DataFrame({'name': self.names, 'kind': self.kinds, 'start': self.start, 'stop': self.stop,
+                             'depth': self.depth, 'parent': self.parent})
+
+
+def exposure_bounds(time_index, exposure_table, exposures):
+    """
+    Returns the (start, stop) sample indices of each exposure: from the
+    first sample after the start of its first interval to the first
+    sample at or after its end
+
+    :param time_index: TimeIndex of the samples
+    :param exposure_table: ExposureTable of the session's events
+    :param exposures: list of exposure names
+    :return: array, (exposures x 2) sample indices
+    """
+    bounds = np.array([exposure_table.intervals(exposure)[0] for exposure in exposures],
+                      dtype=np.float64).reshape(-1, 2)
+
+    return np.column_stack((time_index.time_to_sample(bounds[:, 0], side='right'),
+                            time_index.time_to_sample(bounds[:, 1], side='left')))
+
+
+def window_samples(bands, window_sec, sampling_rate):
+    """
+    Welch window length in samples: window_sec, or by default two cycles
+    of the lowest frequency in bands
+    """
+    if window_sec is None:
+        window_sec = 2 / np.min(bands)
+    return int(window_sec * sampling_rate)
+
+
+WELCH_CHUNK_SAMPLES = 1 << 20  # Samples sliced (and scaled) at a time by chunked_welch
+
+
+def chunked_welch(data, sampling_rate, nperseg, start=0, stop=None, chunk_samples=None):
+    """
+    Welch PSD of data[start:stop], taken over pieces of about chunk_samples
+    samples that hold whole windows of Welch's grid and averaged weighted by
+    their number of windows, which equals Welch over the whole span. Only
+    one piece is sliced at a time, so a ScaledArray is scaled piece by piece
+    instead of as a whole.
+
+    :param chunk_samples: int, samples per piece (None uses WELCH_CHUNK_SAMPLES)
+    :return: tuple, (freqs, psd)
+    """
+    chunk_samples = WELCH_CHUNK_SAMPLES if chunk_samples is None else chunk_samples
+    stop = len(data) if stop is None else stop
+    if stop - start <= max(chunk_samples, nperseg):
+        return welch(data[start:stop], sampling_rate, nperseg=nperseg)
+
+    step = nperseg - nperseg // 2
+    windows = (stop - start - nperseg) // step + 1
+    per_piece = max(1, (chunk_samples - nperseg) // step + 1)
+    total = 0.
+    for first in range(0, windows, per_piece):
+        count = min(per_piece, windows - first)
+        piece = start + first * step
+        freqs, psd = welch(data[piece:piece + (count - 1) * step + nperseg], sampling_rate, nperseg=nperseg)
+        total = total + psd * count
+    return freqs, total / windows
+
+
+def integrate_band(freqs, psd, band, relative=False):
+    """
+    Integrates the PSD (along its last axis) over the band [low, high]
+    using Simpson's rule
+
+    :return: float or array, absolute or relative band power
+    """
+    low, high = band
+
+    # Frequency resolution
+    freq_res = freqs[1] - freqs[0]
+
+    # Find closest indices of band in frequency vector
+    idx_band = np.logical_and(freqs >= low, freqs <= high)
+
+    # Integral approximation of the spectrum using Simpson's rule.
+    bp = simps(psd[..., idx_band], dx=freq_res, axis=-1)
+
+    if relative:
+        bp /= simps(psd, dx=freq_res, axis=-1)
+    return bp
+
+
+def _runs(codes):
+    # Start index and value of each run of equal codes
+    if len(codes) == 0:
+        return np.zeros(0, np.int64), codes[:0]
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(codes)) + 1))
+    return starts, codes[starts]
+
+
+def _encode_step(lab, stack, end_states):
+    # Advance the exposure stack by one label
+    if not isinstance(lab, str):
+        return
+
+    if lab[-1] in '1234567890':
+        lab += 'i'
+
+    if lab[:-1] not in stack:
+
+        if lab[-1] == 's' or lab[-1] == 'i':
+            stack.append(lab[:-1])
+            try:
+                end_states.pop()
+            except IndexError:
+                pass
+
+    if lab[:-1] not in end_states:
+        if lab[-1] == 'e' or lab[-1] == 'o':
+            end_states.append(lab[:-1])
+            stack.pop()
+
+
+def encode_segments(segment_codes, categories):
+    """
+    Runs the exposure stack state machine once per label segment, giving
+    the nested exposure (e.g. 'b3-s1') active during each segment
+
+    :param segment_codes: array, integer label code per segment (-1 for no label)
+    :param categories: array, label names indexed by code
+    :return: tuple, (integer encoded code per segment, array of encoded names)
+    """
+    labels = decode_labels(segment_codes, categories)
+
+    stack = []
+    end_states = []
+    encoded_segments = []
+    for lab in labels:
+        _encode_step(lab, stack, end_states)
+        encoded_segments.append("-".join(stack))
+
+    encoded_categories, encoded_codes = np.unique(np.array(encoded_segments, dtype=str), return_inverse=True)
+
+    return encoded_codes.astype(_code_dtype(len(encoded_categories))), encoded_categories.astype(object)
+
+
+def encode_labels(codes, categories):
+    """
+    Encodes nested exposures (e.g. 'b3-s1') from per-sample label codes.
+    The stack state machine only changes at label boundaries, so it is run
+    once per run of equal labels and the result is broadcast to samples.
+
+    :param codes: array, integer label code per sample (-1 for no label)
+    :param categories: array, label names indexed by code
+    :return: tuple, (integer encoded code per sample, array of encoded names)
+    """
+    starts, run_codes = _runs(codes)
+    encoded_run_codes, encoded_categories = encode_segments(run_codes, categories)
+    encoded_codes = np.repeat(encoded_run_codes, np.diff(np.append(starts, len(codes))))
+
+    return encoded_codes, encoded_categories
+
+
+def dominant_labels(segment_starts, segment_codes, window_starts, window_length):
+    """
+    Returns the label code covering the most samples of each window
+    [start, start + window_length). Ties go to the earlier segment.
+    """
+    first = np.searchsorted(segment_starts, window_starts, side='right') - 1
+    last = np.searchsorted(segment_starts, window_starts + window_length - 1, side='right') - 1
+    labels = segment_codes[np.maximum(first, 0)].copy()
+
+    # Only windows that straddle a label boundary need a closer look
+    segment_ends = np.append(segment_starts[1:], np.iinfo(np.int64).max)
+    for i in np.flatnonzero(first != last):
+        idx = np.arange(first[i], last[i] + 1)
+        overlap = (np.minimum(segment_ends[idx], window_starts[i] + window_length) -
+                   np.maximum(segment_starts[idx], window_starts[i]))
+        labels[i] = segment_codes[idx[np.argmax(overlap)]]
+
+    return labels
+
+
+class cached_attribute:
+    """
+    Decorator for an attribute that is computed on first access and then
+    stored on the instance. Deleting it from the instance (see
+    Terminal.invalidate) makes the next access recompute it.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.name = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, owner):
+        if obj is None:
+            return self
+        value = self.func(obj)
+        obj.__dict__[self.name] = value
+        return value
+
+
+class BinaryTargetMatrix:
+    """
+    Run-length, bit-packed (samples x columns) binary target matrix.
+    Each run of equal encoded labels stores a single code, and the 0/1 row
+    for each code is kept bit-packed.
+    """
+
+    def __init__(self, columns, categories, run_starts, run_codes, n_rows):
+        self.columns = columns
+        self.run_starts = run_starts
+        self.run_codes = run_codes
+        self.n_rows = n_rows
+
+        # Row pattern per encoded label: column is set if it is one of
+        # the label's '-' separated exposures
+        patterns = np.array([[col in str(cat).split('-') for col in columns] for cat in categories],
+                            dtype=np.uint8).reshape(len(categories), len(columns))
+        self.packed_patterns = np.packbits(patterns, axis=1)
+
+    @property
+    def shape(self):
+        return (self.n_rows, len(self.columns))
+
+    def __len__(self):
+        return self.n_rows
+
+    def __array__(self, dtype=None, copy=None):
+        # The dense matrix is always built anew, which satisfies copy=True; it cannot be returned without that copy
+        if copy is False:
+            raise ValueError('BinaryTargetMatrix cannot be converted to an array without materialising a dense copy')
+        arr = self.toarray()
+        return arr if dtype is None else arr.astype(dtype, copy=False)
+
+    @property
+    def run_lengths(self):
+        return np.diff(np.append(self.run_starts, self.n_rows))
+
+    def patterns(self):
+        """
+        Returns the unpacked (codes x columns) uint8 row pattern table
+        """
+        return np.unpackbits(self.packed_patterns, axis=1, count=len(self.columns))
+
+    def packbits(self):
+        """
+        Returns the per-sample rows bit-packed along the columns axis
+        """
+        return np.repeat(self.packed_patterns[self.run_codes], self.run_lengths, axis=0)
+
+    def column(self, name):
+        """
+        Returns the boolean mask of samples where column `name` is set
+        """
+        j = list(self.columns).index(name)
+        return np.repeat(self.patterns()[self.run_codes, j].astype(bool), self.run_lengths)
+
+    def toarray(self):
+        """
+        Materialises the dense (samples x columns) uint8 matrix
+        """
+        return np.repeat(self.patterns()[self.run_codes], self.run_lengths, axis=0)
 
 
 class Terminal:
     """
-    Instantiate the Channel object
-    Then run .load_ncs_data()
+    One channel's .ncs (or spike) file and the exposure labels of its
+    samples. Nothing is read from disk on construction: data, time_index,
+    validation, target, encoded_target and the other cached_attribute
+    members are loaded on first access and kept on the instance, and
+    invalidate() drops them (with everything derived from them) so they
+    are recomputed.
+
+    .ncs samples are decoded through the cache (an on-disk NcsCache, with
+    decimated samples cached separately from the full rate ones). With
+    invalid_samples='drop' the padding of records with fewer than 512
+    valid samples is removed from the data and the time base.
     """
 
     # Standard variables per Neuralynx file formatting
@@ -25,88 +478,211 @@ class Terminal:
     _millivolt_scaling = (10000, u'mV')
     _microvolt_scaling=(1000000, u'µV')
 
-    def __init__(self, file_path, events, event_timestamps):
+    # Lazily computed attributes cleared by invalidate(), keyed by the
+    # attribute that is being invalidated
+    _dependents = {
+        'data': ('data', 'data_units', 'sampling_rate', 'channel_number', 'timestamp', 'validation', 'time_index',
+                 '_psds', 'spikes',
+                 'timestamp_expanded', '_exposure_labels', 'target', '_encoded_labels', 'encoded_target'),
+        'timestamp_expanded': ('timestamp_expanded', '_exposure_labels', 'target',
+                               '_encoded_labels', 'encoded_target'),
+        'target': ('_exposure_labels', 'target', '_encoded_labels', 'encoded_target'),
+        'encoded_target': ('_encoded_labels', 'encoded_target'),
+    }
+
+    def __init__(self, file_path, events, event_timestamps, cache=None, dtype=np.float64, raw=False,
+                 exposure_table=None, invalid_samples='keep', decimate=None, target_rate=None, recorder=None):
         """
-        TODO: Add _load_ncs() arguments to instance attributes?
+        :param file_path: str, Neuralynx .ncs, .nse, .nst or .ntt file
+        :param events: list, event strings of the session
+        :param event_timestamps: list, timestamps of the events
+        :param cache: NcsCache of decoded samples (None uses the default)
+        :param dtype: float type of the rescaled data
+        :param raw: bool, keep int16 data in a ScaledArray scaled on read (PSDs and band powers then scale it in chunks)
+        :param exposure_table: ExposureTable shared by the Session
+        :param invalid_samples: str, 'keep' or 'drop' record padding
+        :param decimate: int, decimation factor dividing 512
+        :param target_rate: float, sampling rate to decimate to (Hz)
+        :param recorder: Recorder that this Terminal's stages report to
         """
         self.file_path = file_path
         self.events = events
         self.event_timestamps = event_timestamps
-        
-        # Load in data
+        self.cache = cache
+        self.dtype = dtype
+        self.raw = raw
+        self.invalid_samples = invalid_samples
+        self.decimate = decimate
+        self.target_rate = target_rate
+        self._recorder = Recorder(parent=recorder)
+        if exposure_table is not None:
+            self.exposure_table = exposure_table
+
+
+    def stats(self):
+        """
+        Instrumentation totals of this Terminal's stages (empty unless
+        degpy.instrument is enabled)
+
+        :return: dict of stage name -> dict of 'calls', 'wall_time' (s),
+                 'bytes_read' and 'peak_memory' (bytes)
+        """
+        return self._recorder.stats()
+
+
+    def reset_stats(self):
+        self._recorder.reset()
+
+
+    def invalidate(self, *names):
+        """
+        Drops memoised attributes so they are recomputed on next access.
+        Attributes derived from an invalidated one are dropped with it, e.g.
+        invalidate('target') also drops encoded_target. With no names, every
+        memoised attribute is dropped. Call invalidate('data') after
+        changing dtype, raw, invalid_samples, decimate or target_rate so
+        the data is loaded again with the new settings.
+        """
+        if not names:
+            names = list(self._dependents)
+        for name in names:
+            for attr in self._dependents.get(name, (name,)):
+                self.__dict__.pop(attr, None)
+
+
+    @cached_attribute
+    def exposure_table(self):
+        return ExposureTable(self.events, self.event_timestamps)
+
+    @cached_attribute
+    def raw_header(self):
+        with open(os.path.abspath(self.file_path), 'rb') as fid:
+            return read_header(fid)
+
+    @cached_attribute
+    def header(self):
+        return parse_header(self.raw_header)
+
+    @cached_attribute
+    def data(self):
+        self._load_data()
+        return self.__dict__['data']
+
+    @cached_attribute
+    def data_units(self):
+        self._load_data()
+        return self.__dict__['data_units']
+
+    @cached_attribute
+    def sampling_rate(self):
+        self._load_data()
+        return self.__dict__['sampling_rate']
+
+    @cached_attribute
+    def channel_number(self):
+        self._load_data()
+        return self.__dict__['channel_number']
+
+    @cached_attribute
+    def timestamp(self):
+        self._load_data()
+        return self.__dict__['timestamp']
+
+    @cached_attribute
+    def validation(self):
+        # RecordValidation of the .ncs records, found while loading them (None for spike files)
         self._load_data()
+        return self.__dict__.get('validation')
+
+    @cached_attribute
+    def time_index(self):
+        # Continuous data are indexed by record; each spike has its own time
+        if self.file_type == 'ncs':
+            return ncs_time_index(self.timestamp, self.sampling_rate, self.validation, self.invalid_samples)
+        return np.asarray(self.timestamp)
+
+    @cached_attribute
+    def timestamp_expanded(self):
+        # Per-sample times, measured from the start of each record so they
+        # stay aligned across recording gaps
+        if isinstance(self.time_index, TimeIndex):
+            return self.time_index.times()
+        return self.time_index.astype(np.float64)
+
+    @cached_attribute
+    def _exposure_labels(self):
+        return self._get_exposure_codes()
 
-        # Load target vector
-        self.target = self._get_exposure_vec()
+    @property
+    def target_codes(self):
+        return self._exposure_labels[0]
 
-        self.encoded_target = self._get_encoded_labels()
+    @property
+    def target_categories(self):
+        return self._exposure_labels[1]
 
+    @cached_attribute
+    def target(self):
+        return self._get_exposure_vec()
 
+    @cached_attribute
+    def _encoded_labels(self):
+        return self._get_encoded_codes()
 
+    @property
+    def encoded_codes(self):
+        return self._encoded_labels[0]
+
+    @property
+    def encoded_categories(self):
+        return self._encoded_labels[1]
+
+    @cached_attribute
+    def encoded_target(self):
+        return self._get_encoded_labels()
+
+
+    @staticmethod
     def _get_data_record(file_path):
-        if file_path.split(".")[1] == "ncs":
-            return np.dtype([('TimeStamp',       np.uint64),       # Cheetah timestamp for this record. This corresponds to
-                                                                    # the sample time for the first data point in the Samples
-                                                                    # array. This value is in microseconds.
-                            ('ChannelNumber',   np.uint32),       # The channel number for this record. This is NOT the A/D
-                                                                    # channel number
-                            ('SampleFreq',      np.uint32),       # The sampling frequency (Hz) for the data stored in the
-                                                                    # Samples Field in this record
-                            ('NumValidSamples', np.uint32),       # Number of values in Samples containing valid data
-                            ('Samples',         np.int16, Terminal._ncs_samples_per_record)])  # Data points for this record. Cheetah
-                                                                                        # currently supports 512 data points per
-                                                                                        # record. At this time, the Samples
-                                                                                        # array is a [512] array.
-        elif file_path.split(".")[1] == "nse":
-            return np.dtype([('TimeStamp',  np.uint64),       # Cheetah timestamp for this record in microseconds.
-                            ('ScNumber',   np.uint32),       # The spike acquisition entity number for this record. 
-                                                                # This is NOT the A/D channel number.
-                            ('CellNumber', np.uint32),       # The classified cell number for this record. If no cells 
-                                                                # have been classified, this number will be zero.
-                            ('Params',     np.uint32, 8),    # Array of selected feature data for this spike channel. Cheetah
-                                                                # currently allows eight (8) selected features, so this array is fixed
-                                                                # at length eight.
-                            ('Data',       np.int, (32, 1))  # Data points for this record. Cheetah currently supports 32 points per
-                                                                # spike record. The array is organized as [DATAPOINTS, CHANNEL]. At this 
-                                                                # time, the Data array is a [32, 1] array.
-        ])
-        elif file_path.split(".")[1] == "nst":
-            NST_RECORD = np.dtype([('TimeStamp',  np.uint64),       # Cheetah timestamp for this record in microseconds.
-                                ('ScNumber',   np.uint32),       # The spike acquisition entity number for this record. 
-                                                                    # This is NOT the A/D channel number.
-                                ('CellNumber', np.uint32),       # The classified cell number for this record. If no cells 
-                                                                    # have been classified, this number will be zero.
-                                ('Params',     np.uint32, 8),    # Array of selected feature data for this spike channel. Cheetah
-                                                                    # currently allows eight (8) selected features, so this array is fixed
-                                                                    # at length eight.
-                                ('Data',       np.int, (32, 2))  # Data points for this record. Cheetah currently supports 32 points per
-                                                                    # spike record. The array is organized as [DATAPOINTS, CHANNEL]. At this 
-                                                                    # time, the Data array is a [32, 2] array.
-            ])
-
-        elif file_path.split(".")[1] == "ntt":
-            return np.dtype([('TimeStamp',  np.uint64),       # Cheetah timestamp for this record in microseconds.
-                            ('ScNumber',   np.uint32),       # The spike acquisition entity number for this record. 
-                                                                # This is NOT the A/D channel number.
-                            ('CellNumber', np.uint32),       # The classified cell number for this record. If no cells 
-                                                                # have been classified, this number will be zero.
-                            ('Params',     np.uint32, 8),    # Array of selected feature data for this spike channel. Cheetah
-                                                                # currently allows eight (8) selected features, so this array is fixed
-                                                                # at length eight.
-                            ('Data',       np.int, (32, 4))  # Data points for this record. Cheetah currently supports 32 points per
-                                                                # spike record. The array is organized as [DATAPOINTS, CHANNEL]. At this 
-                                                                # time, the Data array is a [32, 4] array.
-        ])
-        else:
-            raise FileNotFoundError("file '{}' does not contain .ncs, .nse, .nst, or .ntt extension")
+        extension = os.path.splitext(file_path)[1][1:]
+        if extension not in RECORD_DTYPES or extension == 'nev':
+            raise FileNotFoundError("file '{}' does not contain .ncs, .nse, .nst, or .ntt extension".format(file_path))
+        return RECORD_DTYPES[extension]
+
+    @property
+    def file_type(self):
+        return os.path.splitext(self.file_path)[1][1:]
 
+    @instrumented_method('Terminal._load_data')
     def _load_data(self):
 
-        if self.file_path.split(".")[1] == "ncs":
+        if self.file_type == "ncs":
             return self._load_ncs()
-        
-        elif (self.file_path.split(".")[1] == 'ntt') or (self.file_path.split(".")[1] == "nse"):
-            raise NotImplementedError("Still working on ntt and nse data load utility")
+
+        elif self.file_type in ('nse', 'nst', 'ntt'):
+            return self._load_spikes()
+
+        raise FileNotFoundError("file '{}' does not contain .ncs, .nse, .nst, or .ntt extension".format(self.file_path))
+
+
+    def _load_spikes(self):
+        """
+        Loads a spike file memory-mapped. data holds the (spikes, 32,
+        channels) int16 waveforms and timestamp the time of each spike; the
+        full record fields are available as self.spikes.
+        """
+        spikes = load_spikes(self.file_path, Terminal._get_data_record(self.file_path))
+
+        self.file_path = spikes['file_path']
+        self.raw_header = spikes['raw_header']
+        self.header = spikes['header']
+        self.spikes = spikes
+        self.data = spikes['waveforms']
+        self.data_units = spikes['data_units']
+        self.sampling_rate = float(self.header.get('SamplingFrequency', 0))
+        self.channel_number = spikes['sc_number'][0] if len(spikes['sc_number']) else None
+        self.timestamp = spikes['timestamp']
+        self.validation = None
 
 
     def _load_ncs(self, load_time=True, rescale_data=True, signal_scaling=_microvolt_scaling):
@@ -119,64 +695,39 @@ class Terminal:
         """
         # Load the given file as a Neuralynx .ncs continuous acquisition file and extract the contents
         file_path = os.path.abspath(self.file_path)
-        data_record = Terminal._get_data_record(file_path)
-        with open(file_path, 'rb') as fid:
-            raw_header = read_header(fid)
-            records = read_records(fid, data_record)
-
-        header = parse_header(raw_header)
-        check_ncs_records(records)
-
-        # Reshape (and rescale, if requested) the data into a 1D array
-        data = records['Samples'].ravel()
-        #data = records['Samples'].reshape((NCS_SAMPLES_PER_RECORD * len(records), 1))
-        if rescale_data:
-            try:
-                # ADBitVolts specifies the conversion factor between the ADC counts and volts
-                data = data.astype(np.float64) * (np.float64(header['ADBitVolts']) * signal_scaling[0])
-            except KeyError:
-                warnings.warn('Unable to rescale data, no ADBitVolts value specified in header')
-                rescale_data = False
+        raw_header, header, data, timestamp, sampling_rate, channel_number, validation = read_ncs(
+            file_path, self.cache, self.decimate, self.target_rate)
+        if self.invalid_samples == 'drop' and validation is not None:
+            data = validation.compact(data)
+
+        # Rescale the data, if requested
+        data, data_units = scale_samples(data, header, rescale_data, signal_scaling, self.dtype, self.raw)
 
         # Pack the extracted data to instance variables
         self.file_path = file_path
         self.raw_header = raw_header
         self.header = header
         self.data = data
-        self.data_units = signal_scaling[1] if rescale_data else 'ADC counts'
-        self.sampling_rate = records['SampleFreq'][0]
-        self.channel_number = records['ChannelNumber'][0]
-        self.timestamp = records['TimeStamp']
-        #TODO: Ask Nathan if below is a fair means of getting timestamp same length as signal data
-        self.timestamp_expanded = np.linspace(self.timestamp.min(), self.timestamp.max(), len(self.data))
+        self.data_units = data_units
+        self.sampling_rate = sampling_rate
+        self.channel_number = channel_number
+        self.timestamp = timestamp
+        self.validation = validation
 
 
+    @instrumented_method('Terminal.get_dataframe')
     def get_dataframe(self):
         """
-        Function to return pandas dataframe from ncs data and event data
+        Function to return pandas dataframe from ncs data and event data.
+        The data column holds the scaled samples, so with raw=True this
+        scales a full copy of the signal
 
         :return: pandas dataframe
         """
 
-        # Creating event mapping, of float to event so nan's are
-        # easily replaced, then mapping is used to fill event strings
-        event_map = {}
-        for i in range(len(self.events)):
-            event_map[float(i)] = self.events[i]
-
-        # Creating dataframe
-        df = pd.DataFrame({'timestamp': self.timestamp_expanded, 'data': self.data})
-        df['exposure'] = np.nan * len(df)
-
-        # TODO: Validate removing last event timestamp works
-        event_ts = self.event_timestamps[:-1]
-
-        for i, ts in enumerate(event_ts):
-            # TODO: last value from argmax op is 0. Delete last value?
-            ix = np.argmax(df['timestamp'].values > ts)
-            df.at[ix, 'exposure'] = float(i)
-
-        df['exposure'] = df['exposure'].fillna(method='ffill').map(event_map)
+        # Creating dataframe, with exposures stored as categorical codes
+        df = pd.DataFrame({'timestamp': self.timestamp_expanded, 'data': np.asarray(self.data)})
+        df['exposure'] = pd.Categorical.from_codes(self.target_codes, self.target_categories)
 
         # Adding degunum to dataframe
         df['degu_id'] = [self.header['FileName'].split('\\')[2].split('_')[0]] * len(df)
@@ -184,82 +735,86 @@ class Terminal:
         return df
 
 
-    def _get_exposure_vec(self):
+    @instrumented_method('Terminal._get_exposure_codes')
+    def _get_exposure_codes(self):
 
-        event_map = {}
+        # TODO: Validate removing last event timestamp works
+        return label_samples(self.time_index, self.event_timestamps[:-1], self.events[:-1])
 
-        for i in range(len(self.events)):
-            event_map[float(i)] = self.events[i]
 
-        exposures = pd.Series([np.nan] * len(self.data))
+    @instrumented_method('Terminal._get_exposure_vec')
+    def _get_exposure_vec(self):
 
-        # TODO: Validate removing last event timestamp works
-        event_ts = self.event_timestamps[:-1]
+        return decode_labels(self.target_codes, self.target_categories)
 
-        for i, ts in enumerate(event_ts):
-            # TODO: last value from argmax op is 0. Delete last value?
-            ix = np.argmax(self.timestamp_expanded > ts)
-            exposures[ix] = float(i)
 
-        exposures = exposures.fillna(method='ffill').map(event_map)
+    @instrumented_method('Terminal._get_encoded_codes')
+    def _get_encoded_codes(self):
 
-        return exposures.values
+        return encode_labels(self.target_codes, self.target_categories)
 
 
+    @instrumented_method('Terminal._get_encoded_labels')
     def _get_encoded_labels(self):
 
-        stack = []
-        end_states = []
-        encoded_labels = []
+        return decode_labels(self.encoded_codes, self.encoded_categories)
 
-        for lab in self.target:
-            if lab[-1] in '1234567890':
-                lab += 'i'
 
-            if lab[:-1] not in stack:
-
-                if lab[-1] == 's' or lab[-1] == 'i':
-                    stack.append(lab[:-1])
-                    try:
-                        end_states.pop()
-                    except IndexError:
-                        pass
-
-            if lab[:-1] not in end_states:
-                if lab[-1] == 'e' or lab[-1] == 'o':
-                    end_states.append(lab[:-1])
-                    stack.pop()
+    @instrumented_method('Terminal.get_target_binary_matrix')
+    def get_target_binary_matrix(self, dense=False):
+        """
+        Returns the exposure target as a binary (samples x target columns)
+        matrix, where the columns are the unique encoded labels
 
-            encoded_labels.append("-".join(stack))
+        :param dense: bool, if True materialise the full uint8 matrix,
+                      otherwise return a run-length BinaryTargetMatrix
+        :return: tuple, (target columns, matrix)
+        """
+        starts, run_codes = _runs(self.encoded_codes)
 
-        return encoded_labels
+        # Encoded codes in order of first appearance
+        _, first = np.unique(run_codes, return_index=True)
+        target_cols = self.encoded_categories[run_codes[np.sort(first)]].astype(object)
 
+        matrix = BinaryTargetMatrix(target_cols, self.encoded_categories, starts, run_codes,
+                                    len(self.encoded_codes))
+        if dense:
+            return target_cols, matrix.toarray()
+        return target_cols, matrix
 
-    def get_target_binary_matrix(self):
 
-        cols = []
-        target_cols = pd.Series(self.encoded_target).unique()
 
-        for i, lab in enumerate(self.encoded_target):
-            exposures = lab.split('-')
-            #     if '' not in exposures:
-            #         for exp in exposures:
-            #             target_binary.loc[i, exp] = 1
-            #     if i % 10000 == 0:
-            #         print(i)
-            row = []
-            for col in target_cols:
-                if col in exposures:
-                    row.append(1)
-                else:
-                    row.append(0)
-            cols.append(row)
+    @cached_attribute
+    def _psds(self):
+        # Welch PSDs memoised by (start sample, stop sample, nperseg)
+        return {}
 
-        target_binary_matrix = np.array(cols)
+    def segment_psd(self, start, stop, nperseg):
+        """
+        Welch PSD of data[start:stop], computed once per segment and window
+        length and then served from the Terminal's PSD memo
 
-        return target_cols, target_binary_matrix
+        :return: tuple, (freqs, psd)
+        """
+        key = (int(start), int(stop), int(nperseg))
+        if key not in self._psds:
+            with stage('welch', self._recorder):
+                self._psds[key] = chunked_welch(self.data, self.sampling_rate, key[2], key[0], key[1])
+        return self._psds[key]
 
+    def exposure_bounds(self, exposure):
+        """
+        Returns the (start, stop) sample indices of an exposure, from the
+        first sample after its start event to the first sample at or after
+        its end event
+        """
+        return exposure_bounds(self.time_index, self.exposure_table, [exposure])[0]
 
+    def exposures(self):
+        """
+        Returns the list of exposures with start/end events, e.g. ['r1', 'b1', ...]
+        """
+        return exposure_names(self.events)
 
     def bandpower(self, band, exposure, window_sec=None, relative=False):
         """Compute the average power of the signal x in a specific frequency band.
@@ -284,61 +839,166 @@ class Terminal:
         """
         band = np.asarray(band)
         low, high = band
-        start_event = exposure + "s"
-        end_event = exposure + "e"
-
-        # Pulling out event timestamp
-        start_event_ts = self.event_timestamps[np.where(self.events == start_event)]
-        end_event_ts = self.event_timestamps[np.where(self.events == end_event)]
-
-        # Finding index of timestamp for slicing sample
-        # TODO: Timestamps to exactly match. ie:
-        # Start event ts:  [2460552980]
-        # Start event ts (from expanded):  2460553356.988559
-        # end event ts:  [2647660347]
-        # end event ts (from expanded):  2647660720.174286
 
-        start_event_data_idx = np.argmax(self.timestamp_expanded > start_event_ts)
-        end_event_data_idx = np.argmin(self.timestamp_expanded < end_event_ts)
-
-        data = self.data[start_event_data_idx:end_event_data_idx]
-
-        # Define window length
-        if window_sec is not None:
-            nperseg = window_sec * self.sampling_rate
-        else:
-            nperseg = (2 / low) * self.sampling_rate
+        start_event_data_idx, end_event_data_idx = self.exposure_bounds(exposure)
 
         # Compute the modified periodogram (Welch)
-        freqs, psd = welch(data, self.sampling_rate, nperseg=nperseg)
+        freqs, psd = self.segment_psd(start_event_data_idx, end_event_data_idx,
+                                      window_samples(band, window_sec, self.sampling_rate))
 
-        # Frequency resolution
-        freq_res = freqs[1] - freqs[0]
+        return integrate_band(freqs, psd, band, relative)
 
-        # Find closest indices of band in frequency vector
-        idx_band = np.logical_and(freqs >= low, freqs <= high)
-
-        # Integral approximation of the spectrum using Simpson's rule.
-        bp = simps(psd[idx_band], dx=freq_res)
-
-        if relative:
-            bp /= simps(psd, dx=freq_res)
-        return bp
+    @instrumented_method('Terminal.bandpower_table')
+    def bandpower_table(self, bands=None, exposures=None, window_sec=None, relative=False):
+        """
+        Computes the power of several bands over several exposures. Each
+        exposure's PSD is computed once (and memoised on the Terminal) and
+        every band is integrated from it.
+
+        :param bands: dict of name -> [low, high], or list of [low, high]
+                      (default: BANDS)
+        :param exposures: list of exposure names (default: all exposures)
+        :param window_sec: float, Welch window length in seconds. If None,
+                           (1 / lowest band frequency) * 2
+        :param relative: bool, if True divide by the total power
+        :return: pandas DataFrame, exposures x bands
+        """
+        bands = as_band_dict(BANDS if bands is None else bands)
+        exposures = self.exposures() if exposures is None else list(exposures)
+        nperseg = window_samples(np.array(list(bands.values())), window_sec, self.sampling_rate)
+
+        bounds = exposure_bounds(self.time_index, self.exposure_table, exposures)
+        table = np.zeros((len(exposures), len(bands)))
+        for i, (start, stop) in enumerate(bounds):
+            freqs, psd = self.segment_psd(start, stop, nperseg)
+            for j, band in enumerate(bands.values()):
+                table[i, j] = integrate_band(freqs, psd, band, relative)
+
+        return pd.DataFrame(table, index=pd.Index(exposures, name='exposure'),
+                            columns=pd.Index(list(bands), name='band'))
+
+    @instrumented_method('Terminal.window_features')
+    def window_features(self, bands=None, window_sec=2., step_sec=0.5, relative=False, chunk_records=1024,
+                        out=None):
+        """
+        Computes band power in sliding windows over the whole recording,
+        tagging each window with its dominant encoded_target label. The file
+        is streamed chunk by chunk (with enough overlap for windows that
+        straddle chunks) and each chunk's windows are transformed in one
+        vectorized periodogram, so the full signal is never held in memory.
+        Gaps, partial records and the Terminal's decimate, target_rate and
+        invalid_samples settings are taken from the record headers, and
+        windows that cross a gap or the padding of a partial record get NaN
+        features and are flagged in 'valid'.
+
+        :param bands: dict of name -> [low, high], or list of [low, high]
+                      (default: BANDS)
+        :param window_sec: float, window length in seconds
+        :param step_sec: float, step between window starts in seconds
+        :param relative: bool, if True divide by each window's total power
+        :param chunk_records: int, records read per chunk
+        :param out: str, optional .npy path the (windows x bands) feature
+                    matrix is written to as it is computed
+        :return: dict with keys 'features' (windows x bands float32),
+                 'bands', 'window_start' (first sample of each window),
+                 'window_time' (µs), 'valid' (window holds only continuous
+                 valid samples), 'labels' (encoded label code per window)
+                 and 'label_categories'
+        """
+        if self.file_type != 'ncs':
+            raise ValueError("window_features needs a continuous .ncs file, got '{}'".format(self.file_path))
+        bands = as_band_dict(BANDS if bands is None else bands)
+        file_path = os.path.abspath(self.file_path)
 
+        # Time base from the record headers only
+        records = map_records(file_path, NCS_RECORD)
+        sampling_rate = float(records['SampleFreq'][0]) if len(records) else 0.
+        q = 1
+        if self.decimate is not None or self.target_rate is not None:
+            q = decimation_factor(sampling_rate, self.decimate, self.target_rate)
+        validation = validate_ncs_records(records)
+        if q > 1:
+            validation = validation.decimated(q)
+        sampling_rate /= q
+        time_index = ncs_time_index(records['TimeStamp'], sampling_rate, validation, self.invalid_samples)
+        del records
+
+        window = int(round(window_sec * sampling_rate))
+        step = int(round(step_sec * sampling_rate))
+        if window <= 0 or step <= 0:
+            raise ValueError('window_sec and step_sec must span at least one sample')
+        n_windows = (len(time_index) - window) // step + 1 if len(time_index) >= window else 0
+        window_starts = np.arange(n_windows, dtype=np.int64) * step
+
+        # Continuous stretches end before the padding of their last record, unless the padding was dropped
+        segments = time_index.segments()
+        segment_stop = segments[:, 1].copy()
+        if self.invalid_samples != 'drop' and len(validation):
+            record_starts = time_index.record_start(np.arange(len(validation) + 1))
+            last = np.searchsorted(record_starts, segments[:, 1]) - 1
+            segment_stop -= validation.samples_per_record - validation.valid_samples[last].astype(np.int64)
+        segment = np.maximum(np.searchsorted(segments[:, 0], window_starts, side='right') - 1, 0)
+        valid = window_starts + window <= segment_stop[segment] if len(segments) else np.zeros(n_windows, bool)
+
+        if out is not None:
+            features = np.lib.format.open_memmap(out, mode='w+', dtype=np.float32, shape=(n_windows, len(bands)))
+        else:
+            features = np.zeros((n_windows, len(bands)), dtype=np.float32)
+
+        # Windows starting in the last `window` samples of a chunk are completed from the next one
+        chunk_records = max(chunk_records, -(-window * q // self._ncs_samples_per_record))
+        position = 0
+        carried = 0
+        next_window = 0
+        for data, _ in iter_ncs_chunks(file_path, chunk_records=chunk_records, overlap=window,
+                                       invalid_samples=self.invalid_samples, decimate=self.decimate,
+                                       target_rate=self.target_rate):
+            first_sample = position - carried
+            position += len(data) - carried
+            carried = min(window, len(data))
+
+            count = max(0, min(n_windows, (position - window) // step + 1) - next_window)
+            if count == 0:
+                continue
+
+            offset = window_starts[next_window] - first_sample
+            windows = np.lib.stride_tricks.as_strided(data[offset:], shape=(count, window),
+                                                      strides=(step * data.strides[0], data.strides[0]))
+            freqs, psd = periodogram(windows, sampling_rate, window='hann', axis=-1)
+            for j, band in enumerate(bands.values()):
+                features[next_window:next_window + count, j] = integrate_band(freqs, psd, band, relative)
+            next_window += count
+        features[~valid] = np.nan
+
+        if out is not None:
+            features.flush()
+
+        # Dominant nested exposure of each window, from label segments rather than per-sample labels
+        starts, codes, categories = label_segments(time_index, self.event_timestamps[:-1], self.events[:-1])
+        encoded_codes, encoded_categories = encode_segments(codes, categories)
+
+        return {
+            'features': features,
+            'bands': list(bands),
+            'window_start': window_starts,
+            'window_time': time_index.sample_to_time(window_starts),
+            'valid': valid,
+            'labels': dominant_labels(starts, encoded_codes, window_starts, window),
+            'label_categories': encoded_categories,
+        }
+
+    @instrumented_method('Terminal.bandpower_splits')
     def bandpower_splits(self, band, window_sec=None, relative=False):
-        
+
         # Get list of exposure types 
         # e.g. ['r1', 'b1', ...]
-        exposures = []
-        for e in self.events:
-            if e[-1] == 's':
-                exposures.append(e[:-1])
+        exposures = self.exposures()
+        if window_sec is None:
+            window_sec = 2 / band[0]
 
-        bp_dict = {}
-        for i in range(len(exposures)):
-            bp_dict[exposures[i]] = self.bandpower(band, exposures[i])
+        table = self.bandpower_table([band], exposures, window_sec, relative)
 
-        return bp_dict
+        return dict(zip(exposures, table.iloc[:, 0]))
 
 # exposures = ['Starting Recording', 'r1s', 'r1e', 'b1s', 'b1e', 'b2s', 'b2e',
                 #    'b3s', 's1', 's1o', 's2', 's2o', 'b3e', 'b4s', 's1', 's1o', 's2',
@@ -1,7 +1,5 @@
-import os
-
-import pandas as pd
 from degpy.session import Session
+from degpy.export import export_session, EXTENSIONS
 
 
 recordings = [
@@ -39,30 +37,20 @@ recordings = [
 #     return df
 
 
-def write_data_to_csv():
+def write_data(format='parquet'):
 
+    # Stream each recording to a columnar file instead of building a full DataFrame and writing CSV
+    paths = []
     for rec in recordings:
         sess = Session(rec['path'])
-        data = {}
-        for file in os.listdir(rec['path']):
-            if 'LFP' in file:
-                term = sess.get_terminal(file)
-                signal = term.data
-                lfp_name = file.split('.')[0]
-                data[lfp_name] = signal
-
-        data['target'] = term.target
-
-    df = pd.DataFrame(data)
-
-    df.to_csv('{}_data.csv'.format(rec['sess_num']))
+        paths.append(export_session(sess, '{}_data{}'.format(rec['sess_num'], EXTENSIONS[format]), format))
 
-    return df
+    return paths
 
 
 def main():
 
-    write_data_to_csv()
+    write_data()
 
 
 
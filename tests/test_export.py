@@ -0,0 +1,82 @@
+import json
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from degpy.export import export_session
+from degpy.session.session import Session
+from degpy.synthetic import write_session, PROTOCOL_EVENTS
+from degpy.terminal.terminal import decode_labels
+
+
+@pytest.fixture(scope='module')
+def session_path(tmp_path_factory):
+    # Two channels with a partial record
+    path = str(tmp_path_factory.mktemp('data') / 'session')
+    write_session(path, duration_sec=30, n_channels=2, events=PROTOCOL_EVENTS, partial_records=[10])
+    return path
+
+
+def _read_npz(path):
+    with np.load(path) as npz:
+        metadata = json.loads(str(npz['metadata']))
+        channels = dict((name, npz['channels/' + name]) for name in metadata['channels'])
+        return (metadata, npz['timestamp'], channels, decode_labels(npz['target'], npz['target_categories']),
+                decode_labels(npz['encoded_target'], npz['encoded_target_categories']))
+
+
+def _read_hdf5(path):
+    h5py = pytest.importorskip('h5py')
+    with h5py.File(path, 'r') as h5:
+        metadata = json.loads(h5.attrs['degpy'])
+        channels = dict((name, h5['channels/' + name][:]) for name in metadata['channels'])
+        for name in metadata['channels']:
+            assert h5['channels/' + name].attrs['units'] == metadata['data_units']
+        return (metadata, h5['timestamp'][:], channels,
+                decode_labels(h5['target'][:], json.loads(h5['target'].attrs['categories'])),
+                decode_labels(h5['encoded_target'][:], json.loads(h5['encoded_target'].attrs['categories'])))
+
+
+def _read_parquet(path):
+    pq = pytest.importorskip('pyarrow.parquet')
+    table = pq.read_table(path)
+    metadata = json.loads(table.schema.metadata[b'degpy'])
+    channels = dict((name, table.column(name).to_numpy()) for name in metadata['channels'])
+    labels = [np.array(table.column(name).to_pylist(), dtype=object) for name in ('target', 'encoded_target')]
+    for label in labels:
+        label[np.equal(label, None)] = np.nan
+    return (metadata, table.column('timestamp').to_numpy(), channels) + tuple(labels)
+
+
+_READERS = {'npz': _read_npz, 'hdf5': _read_hdf5, 'parquet': _read_parquet}
+
+
+def _assert_labels_equal(labels, expected):
+    pd.testing.assert_series_equal(pd.Series(labels, dtype=object), pd.Series(expected, dtype=object))
+
+
+@pytest.mark.parametrize('format, extension', [('npz', '.npz'), ('hdf5', '.h5'), ('parquet', '.parquet')])
+def test_export_round_trip(session_path, tmp_path, format, extension):
+    reader = _READERS[format]
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        session = Session(session_path)
+        path = export_session(session, str(tmp_path / ('session' + extension)), chunk_records=7, workers=2)
+        metadata, timestamp, channels, target, encoded_target = reader(path)
+
+        assert metadata['channels'] == ['LFP1', 'LFP2']
+        for name, scale in zip(metadata['channels'], metadata['scale']):
+            terminal = session.get_terminal(name + '.ncs')
+            assert channels[name].dtype == np.int16
+            np.testing.assert_allclose(channels[name] * scale, terminal.data, rtol=1e-12)
+        np.testing.assert_array_equal(timestamp, terminal.time_index.times())
+        assert metadata['sampling_rate'] == terminal.sampling_rate
+        _assert_labels_equal(target, terminal.target)
+        _assert_labels_equal(encoded_target, terminal.encoded_target)
+
+
+def test_export_rejects_unknown_format(session_path, tmp_path):
+    with pytest.raises(ValueError):
+        export_session(session_path, str(tmp_path / 'session.csv'))
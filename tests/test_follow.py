@@ -0,0 +1,45 @@
+import warnings
+
+import numpy as np
+
+from degpy.follow import NcsFollower
+from degpy.neuralynx_io import load_ncs
+from degpy.neuralynx_io.neuralynx_io import NCS_RECORD, NCS_SAMPLES_PER_RECORD
+from degpy.synthetic import write_ncs, append_ncs
+
+
+def _load_ncs(path):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return load_ncs(path, invalid_samples='drop')
+
+
+def test_follower_reads_appended_records(tmp_path):
+    path = str(tmp_path / 'LFP1.ncs')
+    follower = NcsFollower(path)
+    assert len(follower.read()['data']) == 0
+
+    write_ncs(path, 20, partial_records=[19])
+    first = follower.read()
+    assert follower.records_read == 20
+    np.testing.assert_array_equal(first['data'], _load_ncs(path)['data'])
+    assert list(first['gaps']) == []
+
+    # Records appended after a pause are read on the next call, which starts a new segment
+    append_ncs(path, 10, gap_sec=1.)
+    second = follower.read()
+    assert len(second['timestamp']) == 10
+    assert list(second['gaps']) == [0]
+    np.testing.assert_array_equal(np.concatenate((first['data'], second['data'])), _load_ncs(path)['data'])
+    np.testing.assert_array_equal(second['record_start'], np.arange(10) * NCS_SAMPLES_PER_RECORD)
+    assert len(follower.read()['data']) == 0
+
+    # A record that is only partly written is left for a later call
+    append_ncs(path, 1)
+    with open(path, 'rb+') as fid:
+        fid.truncate(fid.seek(0, 2) - NCS_RECORD.itemsize // 2)
+    assert len(follower.read()['data']) == 0
+    with open(path, 'ab') as fid:
+        fid.write(b'\0' * (NCS_RECORD.itemsize // 2))
+    assert len(follower.read()['timestamp']) == 1
+    assert follower.records_read == 31
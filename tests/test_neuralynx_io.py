@@ -0,0 +1,143 @@
+import tracemalloc
+import warnings
+
+import numpy as np
+import pytest
+
+from degpy.neuralynx_io import (load_ncs, iter_ncs_chunks, load_ntt, select_spikes, map_records,
+                                validate_ncs_records, Decimator, decimate_ncs_records)
+from degpy.neuralynx_io.neuralynx_io import NCS_RECORD, NCS_SAMPLES_PER_RECORD, ScaledArray
+from degpy.synthetic import write_ncs, write_ntt
+
+
+@pytest.fixture(scope='module')
+def ncs_path(tmp_path_factory):
+    # 300 records with a recording gap and two partial records
+    path = str(tmp_path_factory.mktemp('data') / 'LFP1.ncs')
+    write_ncs(path, 300, gaps={100: 2.0}, partial_records=[50, 200])
+    return path
+
+
+def _load_ncs(path, **kwargs):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return load_ncs(path, **kwargs)
+
+
+def test_mmap_samples_match_load_ncs(ncs_path):
+    data = _load_ncs(ncs_path)['data']
+    ncs = _load_ncs(ncs_path, mmap=True)
+    samples = ncs['data']
+    assert len(samples) == len(data)
+    for key in (slice(None), slice(100, 5000), slice(511, 513), slice(-1000, None), slice(3, 20000, 7),
+                slice(100, 100)):
+        np.testing.assert_array_equal(samples[key], data[key])
+    assert samples[-1] == data[-1]
+    with pytest.raises(IndexError):
+        samples[len(data)]
+    ncs['ncs_file'].close()
+
+
+def test_time_slice_matches_sample_times(tmp_path):
+    path = str(tmp_path / 'LFP1.ncs')
+    write_ncs(path, 40)
+    ncs = _load_ncs(path)
+    samples = _load_ncs(path, mmap=True)['data']
+    times = ncs['time']
+    for t0, t1 in ((times[777] - 1, times[9000] + 1), (times[0], times[512]), (times[-1], times[-1] + 1000),
+                   (0, times[10]), (times[5], times[5])):
+        np.testing.assert_array_equal(samples.time_slice(t0, t1), ncs['data'][(times >= t0) & (times < t1)])
+
+
+@pytest.mark.parametrize('invalid_samples', ['keep', 'drop'])
+@pytest.mark.parametrize('overlap', [0, 100, 7 * NCS_SAMPLES_PER_RECORD])
+def test_iter_ncs_chunks_overlap(ncs_path, invalid_samples, overlap):
+    data = _load_ncs(ncs_path, invalid_samples=invalid_samples)['data']
+    records = map_records(ncs_path, NCS_RECORD)
+
+    previous = np.zeros(0)
+    new, timestamps = [], []
+    for chunk, chunk_timestamps in iter_ncs_chunks(ncs_path, chunk_records=7, overlap=overlap,
+                                                   invalid_samples=invalid_samples):
+        # Each chunk starts with the last `overlap` samples of the ones before it. Chunks are views of a reused
+        # buffer, so what is kept is copied.
+        carried = min(overlap, len(previous))
+        np.testing.assert_array_equal(chunk[:carried], previous[len(previous) - carried:])
+        new.append(chunk[carried:].copy())
+        timestamps.append(chunk_timestamps.copy())
+        previous = np.concatenate((previous, chunk[carried:]))
+    np.testing.assert_array_equal(np.concatenate(new), data)
+    np.testing.assert_array_equal(np.concatenate(timestamps), records['TimeStamp'])
+
+    with pytest.raises(ValueError):
+        next(iter_ncs_chunks(ncs_path, chunk_records=7, overlap=7 * NCS_SAMPLES_PER_RECORD + 1))
+
+
+def test_load_ntt_and_select_spikes(tmp_path):
+    path = str(tmp_path / 'TT1.ntt')
+    write_ntt(path, 500, n_cells=4)
+    spikes = load_ntt(path)
+    read = load_ntt(path, mmap=False)
+    assert spikes['waveforms'].shape == (500, 32, 4)
+    assert spikes['waveforms'].dtype == np.int16
+    for key in ('timestamp', 'cell_number', 'sc_number', 'params', 'waveforms'):
+        np.testing.assert_array_equal(spikes[key], read[key])
+    assert np.all(np.diff(spikes['timestamp'].astype(np.int64)) >= 0)
+
+    timestamps = spikes['timestamp']
+    t0, t1 = timestamps[100], timestamps[400]
+    in_range = (timestamps >= t0) & (timestamps < t1)
+    for cell_numbers in (None, 2, [1, 3]):
+        selected = select_spikes(spikes, cell_numbers, t0, t1)
+        mask = in_range if cell_numbers is None else in_range & np.isin(spikes['cell_number'], cell_numbers)
+        np.testing.assert_array_equal(selected['index'], np.flatnonzero(mask))
+        for key in ('timestamp', 'cell_number', 'waveforms'):
+            np.testing.assert_array_equal(selected[key], spikes[key][mask])
+    assert len(select_spikes(spikes, t0=t1, t1=t0)['timestamp']) == 0
+
+
+def test_decimation_restarts_at_segments(ncs_path):
+    records = np.array(map_records(ncs_path, NCS_RECORD))
+    q = 8
+    starts = validate_ncs_records(records).segment_starts()
+    assert list(starts) == [51, 100, 201]
+
+    # Each segment decimated on its own, from its valid samples only
+    expected = np.zeros(len(records) * NCS_SAMPLES_PER_RECORD // q)
+    bounds = np.concatenate(([0], starts, [len(records)]))
+    for first, stop in zip(bounds[:-1], bounds[1:]):
+        count = (stop - first - 1) * NCS_SAMPLES_PER_RECORD + int(records['NumValidSamples'][stop - 1])
+        count = -(-count // q) * q
+        decimator = Decimator(q)
+        segment = records['Samples'][first:stop].reshape(-1)[:count]
+        out = np.concatenate((decimator.feed(segment), decimator.flush()))
+        expected[first * NCS_SAMPLES_PER_RECORD // q:][:len(out)] = out
+
+    for chunk_records in (4096, 37, 1):
+        samples = np.zeros(len(expected), np.float32)
+        validation = decimate_ncs_records(records, q, samples, np.zeros(len(records), np.uint64),
+                                          chunk_records=chunk_records)
+        np.testing.assert_array_equal(samples, expected.astype(np.float32))
+    assert list(validation.valid_samples[[50, 200]]) == [32, 32]
+
+
+@pytest.mark.parametrize('reduction', [np.sum, np.mean, np.std, np.var, np.min, np.max])
+def test_scaled_array_reductions_stay_compact(monkeypatch, reduction):
+    monkeypatch.setattr('degpy.neuralynx_io.neuralynx_io.SCALED_CHUNK_SAMPLES', 1 << 16)
+    raw = np.random.RandomState(0).randint(-2 ** 15, 2 ** 15, 1 << 21).astype(np.int16)
+    scaled = ScaledArray(raw, -0.25, 'uV')
+    expected = reduction(raw * -0.25)
+
+    tracemalloc.start()
+    try:
+        result = reduction(scaled)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    np.testing.assert_allclose(result, expected, rtol=1e-12)
+    assert peak < raw.size * np.dtype(np.float64).itemsize / 4
+
+    # Other numpy functions get the scaled samples
+    np.testing.assert_array_equal(np.diff(scaled[:10]), np.diff(raw[:10] * -0.25))
+    np.testing.assert_array_equal(np.cumsum(scaled.reshape(-1, 2), axis=1),
+                                  np.cumsum(raw.reshape(-1, 2) * -0.25, axis=1))
@@ -0,0 +1,71 @@
+import os
+
+import pytest
+
+from degpy.scraper.scraper import Scraper
+from degpy.synthetic import write_dataset
+
+
+@pytest.fixture
+def data_root(tmp_path):
+    root = str(tmp_path / 'data')
+    write_dataset(root, degu_ids=('080602',), sessions_per_degu=2, duration_sec=10, n_channels=2)
+    return root
+
+
+def _copies(dest):
+    return sorted(name for name in os.listdir(dest) if not name.endswith('.part'))
+
+
+def test_move_files_skips_up_to_date_files(data_root, tmp_path):
+    dest = str(tmp_path / 'copies')
+    first = Scraper.move_files(data_root, dest, progress=False)
+    assert (first.copied, first.skipped, first.failed) == (6, 0, 0)
+    assert len(_copies(dest)) == 6
+    assert first.bytes_copied == sum(os.path.getsize(os.path.join(dest, name)) for name in _copies(dest))
+
+    for checksum in (False, True):
+        again = Scraper.move_files(data_root, dest, checksum=checksum, progress=False)
+        assert (again.copied, again.skipped, again.failed, again.bytes_copied) == (0, 6, 0, 0)
+
+
+@pytest.mark.parametrize('checksum', [False, True])
+def test_move_files_resumes_part_files(data_root, tmp_path, checksum):
+    dest = str(tmp_path / 'copies')
+    Scraper.move_files(data_root, dest, progress=False)
+    name = [name for name in _copies(dest) if name.endswith('LFP1.ncs')][0]
+    dst = os.path.join(dest, name)
+    with open(dst, 'rb') as fid:
+        content = fid.read()
+
+    # An interrupted copy: the first half of the file in '<name>.part', plus an orphan from older versions
+    os.remove(dst)
+    with open(dst + '.part', 'wb') as fid:
+        fid.write(content[:len(content) // 2])
+    open(dst + '.1234.part', 'wb').close()
+
+    report = Scraper.move_files(data_root, dest, checksum=checksum, progress=False)
+    assert (report.copied, report.skipped, report.failed) == (1, 5, 0)
+    assert report.bytes_copied == len(content) - len(content) // 2
+    with open(dst, 'rb') as fid:
+        assert fid.read() == content
+    assert sorted(os.listdir(dest)) == _copies(dest)
+
+
+def test_move_files_restarts_corrupt_part_files(data_root, tmp_path):
+    dest = str(tmp_path / 'copies')
+    Scraper.move_files(data_root, dest, progress=False)
+    name = _copies(dest)[0]
+    dst = os.path.join(dest, name)
+    with open(dst, 'rb') as fid:
+        content = fid.read()
+    os.remove(dst)
+    with open(dst + '.part', 'wb') as fid:
+        fid.write(b'\0' * (len(content) // 2))
+
+    # With checksum=True a part that does not match the source is overwritten
+    report = Scraper.move_files(data_root, dest, checksum=True, progress=False)
+    assert (report.copied, report.bytes_copied) == (1, len(content))
+    with open(dst, 'rb') as fid:
+        assert fid.read() == content
+    assert not os.path.exists(dst + '.part')
@@ -0,0 +1,59 @@
+import os
+import warnings
+
+import numpy as np
+import pytest
+
+from degpy.neuralynx_io import map_records
+from degpy.neuralynx_io.neuralynx_io import HEADER_LENGTH, NCS_RECORD
+from degpy.session.session import Session
+from degpy.synthetic import write_session, PROTOCOL_EVENTS
+
+
+@pytest.fixture(scope='module')
+def session_path(tmp_path_factory):
+    # Three channels with a recording gap and two partial records
+    path = str(tmp_path_factory.mktemp('data') / 'session')
+    write_session(path, duration_sec=300, n_channels=3, events=PROTOCOL_EVENTS, gaps={100: 2.0},
+                  partial_records=[50, 200])
+    return path
+
+
+def _drop_record(file_path, record):
+    # Rewrite an .ncs file without one of its records
+    records = np.array(map_records(file_path, NCS_RECORD))
+    with open(file_path, 'rb') as fid:
+        header = fid.read(HEADER_LENGTH)
+    with open(file_path, 'wb') as fid:
+        fid.write(header)
+        np.delete(records, record).tofile(fid)
+
+
+def test_bandpower_matches_terminals(session_path):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        session = Session(session_path)
+        result = session.bandpower()
+        for i, channel in enumerate(result['channels']):
+            table = session.get_terminal(channel + '.ncs').bandpower_table(exposures=result['exposures'])
+            np.testing.assert_allclose(result['bandpower'][i], table.values, rtol=1e-9)
+
+
+def test_bandpower_skips_missing_records(session_path, tmp_path):
+    path = str(tmp_path / 'session')
+    os.makedirs(path)
+    for file in os.listdir(session_path):
+        with open(os.path.join(session_path, file), 'rb') as src, open(os.path.join(path, file), 'wb') as dst:
+            dst.write(src.read())
+    _drop_record(os.path.join(path, 'LFP2.ncs'), 300)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        session = Session(path)
+        channels = session.load_channels()
+        assert np.isnan(channels['data'][1]).any()
+        result = session.bandpower(channels=channels)
+        table = session.get_terminal('LFP2.ncs').bandpower_table(exposures=result['exposures'])
+
+    assert np.isfinite(result['bandpower']).all()
+    np.testing.assert_allclose(result['bandpower'][1], table.values, rtol=0.05)
@@ -0,0 +1,158 @@
+import os
+import tracemalloc
+import warnings
+
+import numpy as np
+import pytest
+from scipy.signal import periodogram
+
+from degpy.neuralynx_io import load_nev
+from degpy.synthetic import write_session, PROTOCOL_EVENTS
+from degpy.terminal.terminal import Terminal, BANDS, integrate_band, label_samples, label_segments
+
+
+def _terminal(path, channel='LFP1.ncs', **kwargs):
+    nev = load_nev(os.path.join(path, 'Events.nev'))
+    return Terminal(os.path.join(path, channel), list(nev['event_strings']), list(nev['events']['TimeStamp']),
+                    **kwargs)
+
+
+@pytest.fixture(scope='module')
+def session_path(tmp_path_factory):
+    # A recording gap and two partial records
+    path = str(tmp_path_factory.mktemp('data') / 'session')
+    write_session(path, duration_sec=120, n_channels=1, events=PROTOCOL_EVENTS, gaps={100: 2.0},
+                  partial_records=[50, 200])
+    return path
+
+
+def _dense_labels(sample_times, event_timestamps, events):
+    # Reference labelling: each event relabels every sample after it, so later events win ties
+    categories = np.unique(events)
+    codes = np.full(len(sample_times), -1)
+    for timestamp, event in zip(event_timestamps, events):
+        codes[sample_times > timestamp] = np.searchsorted(categories, event)
+    return codes, categories
+
+
+def test_label_samples_match_dense_labels():
+    rng = np.random.RandomState(0)
+    sample_times = np.cumsum(rng.randint(1, 5, 5000))
+    event_timestamps = np.sort(rng.choice(sample_times, 40))
+    event_timestamps = np.concatenate(([sample_times[0] - 10], event_timestamps, event_timestamps[5:7],
+                                       [sample_times[-1] + 10]))
+    event_timestamps.sort()
+    events = rng.choice(['b1s', 'b1e', 's1i', 's1o', 'r1s'], len(event_timestamps))
+
+    for times, timestamps, names in ((sample_times, event_timestamps, events),
+                                     (sample_times, event_timestamps[1:-1], events[1:-1]),
+                                     (sample_times, event_timestamps[:0], events[:0])):
+        codes, categories = label_samples(times, timestamps, names)
+        expected_codes, expected_categories = _dense_labels(times, timestamps, names)
+        np.testing.assert_array_equal(categories, expected_categories)
+        np.testing.assert_array_equal(codes, expected_codes)
+
+        # One segment per event that starts before the last sample, plus the unlabelled start
+        starts, segment_codes, _ = label_segments(times, timestamps, names)
+        assert starts[0] == 0 and np.all(np.diff(starts) > 0)
+        assert len(starts) <= len(timestamps) + 1
+
+
+def test_time_index_labels_match_sample_times(session_path):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        terminal = _terminal(session_path)
+        time_index = terminal.time_index
+    nev = load_nev(os.path.join(session_path, 'Events.nev'))
+    event_timestamps, events = nev['events']['TimeStamp'], np.array(nev['event_strings'])
+
+    codes, categories = label_samples(time_index, event_timestamps, events)
+    expected_codes, expected_categories = _dense_labels(time_index.times(), event_timestamps, events)
+    np.testing.assert_array_equal(categories, expected_categories)
+    np.testing.assert_array_equal(codes, expected_codes)
+
+
+def test_binary_target_matrix_matches_dense(session_path):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        terminal = _terminal(session_path)
+        columns, matrix = terminal.get_target_binary_matrix()
+        encoded_target = np.asarray(terminal.encoded_target)
+
+    # A column is set where it is one of the sample's nested exposures
+    expected = np.array([[column in str(label).split('-') for column in columns] for label in encoded_target],
+                        dtype=np.uint8)
+    assert matrix.shape == expected.shape
+    assert len(matrix.run_codes) < len(matrix) // 1000
+    np.testing.assert_array_equal(matrix.toarray(), expected)
+    np.testing.assert_array_equal(np.asarray(matrix), expected)
+    np.testing.assert_array_equal(matrix.packbits(), np.packbits(expected, axis=1))
+    for j, column in enumerate(columns):
+        np.testing.assert_array_equal(matrix.column(column), expected[:, j].astype(bool))
+    np.testing.assert_array_equal(terminal.get_target_binary_matrix(dense=True)[1], expected)
+    with pytest.raises(ValueError):
+        matrix.__array__(copy=False)
+
+
+@pytest.mark.parametrize('invalid_samples', ['keep', 'drop'])
+@pytest.mark.parametrize('decimate', [None, 4])
+def test_window_features_match_periodogram(session_path, invalid_samples, decimate):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        terminal = _terminal(session_path, invalid_samples=invalid_samples, decimate=decimate)
+        result = terminal.window_features(chunk_records=16)
+        data = np.asarray(terminal.data, dtype=np.float64)
+
+    sampling_rate = float(terminal.sampling_rate)
+    window = int(round(2 * sampling_rate))
+    starts = result['window_start']
+    assert len(starts) == (len(terminal.time_index) - window) // int(round(0.5 * sampling_rate)) + 1
+    np.testing.assert_array_equal(result['window_time'], terminal.time_index.sample_to_time(starts))
+
+    valid = result['valid']
+    assert 0 < valid.sum() < len(valid)
+    assert np.isnan(result['features'][~valid]).all()
+    expected = np.array([[integrate_band(*periodogram(data[start:start + window], sampling_rate, window='hann'),
+                                         band, False) for band in BANDS.values()] for start in starts[valid]])
+    np.testing.assert_allclose(result['features'][valid], expected, rtol=1e-5)
+    np.testing.assert_array_equal(terminal.window_features(chunk_records=1000)['features'], result['features'])
+
+
+def test_window_features_memory_bounded_by_chunk(tmp_path):
+    # Peak memory depends on the chunk size, not on the length of the recording
+    peaks = []
+    for duration_sec in (200, 800):
+        path = write_session(str(tmp_path / str(duration_sec)), duration_sec=duration_sec, n_channels=1)
+        terminal = _terminal(path)
+        tracemalloc.start()
+        try:
+            terminal.window_features(chunk_records=32)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+        finally:
+            tracemalloc.stop()
+        assert 'data' not in terminal.__dict__
+
+    signal_bytes = 800 * 2000 * np.dtype(np.float64).itemsize
+    assert peaks[1] < signal_bytes / 4
+    assert peaks[1] < 1.25 * peaks[0]
+
+
+def test_raw_bandpower_scales_in_chunks(monkeypatch, tmp_path):
+    # With raw=True the Welch PSDs scale the int16 counts a piece at a time
+    monkeypatch.setattr('degpy.terminal.terminal.WELCH_CHUNK_SAMPLES', 1 << 14)
+    session_path = write_session(str(tmp_path / 'session'), duration_sec=600, n_channels=1, gaps={100: 2.0})
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        expected = _terminal(session_path).bandpower_table()
+        terminal = _terminal(session_path, raw=True)
+        np.testing.assert_allclose(np.asarray(terminal.bandpower_table(), dtype=np.float64),
+                                   np.asarray(expected, dtype=np.float64), rtol=1e-9)
+
+        terminal._psds.clear()
+        tracemalloc.start()
+        try:
+            terminal.bandpower_table()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    assert peak < terminal.data.size * np.dtype(np.float64).itemsize / 4